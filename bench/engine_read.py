@@ -0,0 +1,89 @@
+# エンジンの標準出力を読み出すスレッド(UsiEngine.read_worker)の速さを、
+# 1行ずつreadline()していた以前の方法と比較する。
+#
+# 実行方法 : (リポジトリのrootで)
+#   python -m bench.engine_read
+#   python -m bench.engine_read --lines 5000000 --level Full
+#
+# テスト用のUSIエンジンもどき(tests/fake_usi_engine.py)に、1回の"go"で大量の"info"行を出力させて、
+# "bestmove"が返ってくるまでの時間と、その間に別スレッド(対局スレッドの代わり)が回せたループの回数を計測する。
+
+import argparse
+import os
+import threading
+import time
+
+from src.engine.engine import UsiEngine
+from src.engine.enums import UsiEngineState, UsiInfoCaptureLevel
+
+FAKE_ENGINE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "tests", "fake_usi_engine.py"
+)
+
+
+# 以前のread_worker。text modeで1行ずつreadline()して、1行ごとにプロセスが生きているかを調べる。
+class TextLineUsiEngine(UsiEngine):
+    def read_worker(self):
+        while True:
+            line = self.proc.stdout.readline()
+            if line:
+                self.dispatch_message(line.strip())
+            retcode = self.proc.poll()
+            if not line and retcode is not None:
+                self.exit_state = 0
+                break
+        self.change_state(UsiEngineState.Disconnected)
+
+
+# lines行の"info"を出力させて、"bestmove"が返ってくるまでの時間[s]と、その間に別スレッドが回せたループの回数を返す。
+def measure(engine: UsiEngine, lines: int, level: UsiInfoCaptureLevel):
+    engine.info_capture_level = level
+    engine.set_engine_options({"InfoLines": str(lines), "ResignPly": "1000"})
+    engine.connect(FAKE_ENGINE_PATH)
+    engine.wait_ready(60)
+    engine.usi_position("startpos")
+
+    stop = threading.Event()
+    loops = [0]
+
+    def spin():
+        while not stop.is_set():
+            loops[0] += 1
+
+    thread = threading.Thread(target=spin)
+    thread.start()
+    start = time.time()
+    engine.usi_go_and_wait_bestmove("btime 0 wtime 0 byoyomi 1000")
+    elapsed = time.time() - start
+    stop.set()
+    thread.join()
+    engine.disconnect()
+    return elapsed, loops[0]
+
+
+def main():
+    parser = argparse.ArgumentParser("bench.engine_read")
+    parser.add_argument(
+        "--lines", type=int, default=2000000, help="info lines per go command"
+    )
+    parser.add_argument(
+        "--level",
+        type=str,
+        default="FinalOnly",
+        choices=[level.name for level in UsiInfoCaptureLevel],
+        help="info capture level",
+    )
+    args = parser.parse_args()
+    level = UsiInfoCaptureLevel[args.level]
+
+    for name, engine in [("text", TextLineUsiEngine()), ("bytes", UsiEngine())]:
+        elapsed, loops = measure(engine, args.lines, level)
+        print(
+            "{0:<5} : {1:.3f}s ({2:,.0f} lines/s) , other thread {3:,.0f} loops/s".format(
+                name, elapsed, args.lines / elapsed, loops / elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# エンジンを大量に起動するのにかかる時間を、shell経由と直接起動で比較する。
+#
+# 実行方法 : (リポジトリのrootで)
+#   python -m bench.engine_spawn
+#   python -m bench.engine_spawn --engines 200 --engine_path path/to/YaneuraOu
+#
+# エンジンを指定しなければ、テスト用のUSIエンジンもどき(tests/fake_usi_engine.py)を用いる。
+
+import argparse
+import os
+import time
+
+from src.engine.engine import UsiEngine
+
+FAKE_ENGINE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "tests", "fake_usi_engine.py"
+)
+
+
+# n個のエンジンを起動して、connect()にかかった時間と、すべての"readyok"が返ってくるまでの時間を返す。
+def spawn(engine_path: str, n: int, with_shell: bool):
+    engines = []
+    start = time.time()
+    for _ in range(n):
+        engine = UsiEngine()
+        engine.spawn_with_shell = with_shell
+        engine.connect(engine_path)
+        engines.append(engine)
+    connected = time.time() - start
+
+    for engine in engines:
+        engine.wait_ready(60)
+    ready = time.time() - start
+
+    processes = count_processes()
+    for engine in engines:
+        engine.disconnect()
+    return connected, ready, processes
+
+
+# このプロセスの子プロセスの数。(/proc/[pid]/task/[pid]/childrenから数える。取得できなければNone)
+def count_processes():
+    pid = os.getpid()
+    try:
+        with open("/proc/{0}/task/{0}/children".format(pid)) as f:
+            return len(f.read().split())
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser("bench.engine_spawn")
+    parser.add_argument("--engines", type=int, default=100, help="number of engines")
+    parser.add_argument(
+        "--engine_path", type=str, default=FAKE_ENGINE_PATH, help="engine path"
+    )
+    args = parser.parse_args()
+
+    for with_shell in [True, False]:
+        connected, ready, processes = spawn(
+            args.engine_path, args.engines, with_shell
+        )
+        print(
+            "{0:<6} : connect {1:.3f}s ({2:.2f}ms/engine) , all readyok {3:.3f}s , "
+            "child processes {4}".format(
+                "shell" if with_shell else "direct",
+                connected,
+                connected * 1000 / args.engines,
+                ready,
+                processes,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
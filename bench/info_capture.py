@@ -0,0 +1,55 @@
+# UsiEngine.info_capture_levelごとに、1局分の"info"行の解釈にかかるCPU時間を計測する。
+#
+# 実行方法 : (リポジトリのrootで)
+#   python -m bench.info_capture
+
+import time
+
+from bench.info_stream import generate_game
+from src.engine.engine import UsiEngine
+from src.engine.enums import UsiEngineState, UsiInfoCaptureLevel
+from src.engine.service import UsiThinkResult
+
+
+# 1局分のメッセージをUsiEngine.dispatch_message()に流し込み、消費したCPU時間[s]を返す。
+def run_game(level: UsiInfoCaptureLevel, game) -> float:
+    # エンジンには接続せず、受信処理だけを行う。
+    usi = UsiEngine()
+    usi.info_capture_level = level
+    usi.engine_state = UsiEngineState.WaitBestmove
+
+    start = time.process_time()
+    for lines in game:
+        usi.think_result = UsiThinkResult()
+        usi.last_info_line = None
+        usi.engine_state = UsiEngineState.WaitBestmove
+        for line in lines:
+            usi.dispatch_message(line)
+        usi.dispatch_message("bestmove 7g7f ponder 3c3d")
+    return time.process_time() - start
+
+
+def main():
+    game = generate_game()
+    lines = sum(len(move) for move in game)
+    print("plies = {0} , info lines = {1}".format(len(game), lines))
+
+    base = None
+    for level in [
+        UsiInfoCaptureLevel.Full,
+        UsiInfoCaptureLevel.FinalOnly,
+        UsiInfoCaptureLevel.NoCapture,
+    ]:
+        # 何回か計測して、いちばん速かったものを採用する。
+        cpu = min(run_game(level, game) for _ in range(5))
+        if base is None:
+            base = cpu
+        print(
+            "{0:10} : {1:8.2f} [ms/game] , saved {2:6.2f} [ms/game] ({3:5.1f}%)".format(
+                level.name, cpu * 1000, (base - cpu) * 1000, (base - cpu) / base * 100
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
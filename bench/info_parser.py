@@ -0,0 +1,111 @@
+# "info"行の解釈の速度を、以前のScannerによる実装(legacy_parse_info)と比較する。
+#
+# 実行方法 : (リポジトリのrootで)
+#   python -m bench.info_parser
+#   python -m bench.info_parser --file engine_log.txt
+# --fileを指定すると、やねうら王の出力を記録したファイルのうち"info"で始まる行を用いる。
+# 指定しなければ、bench/info_stream.pyで生成したものを用いる。
+
+import argparse
+import time
+
+from bench.info_stream import generate_game
+from src.engine.enums import UsiBound, UsiEvalSpecialValue
+from src.engine.eval import UsiEvalValue
+from src.engine.info_parser import parse_info
+from src.engine.scanner import Scanner
+from src.engine.service import UsiThinkPV
+
+
+# 以前のUsiEngine.handle_info()の解釈部分。比較用。
+def legacy_parse_info(message: str):
+    scanner = Scanner(message.split(), 1)
+    pv = UsiThinkPV()
+
+    multipv = 1
+    while not scanner.is_eof():
+        try:
+            token = scanner.get_token()
+            if token == "string":
+                return None
+            elif token == "depth":
+                pv.depth = scanner.get_token()
+            elif token == "seldepth":
+                pv.seldepth = scanner.get_token()
+            elif token == "nodes":
+                pv.nodes = scanner.get_token()
+            elif token == "nps":
+                pv.nps = scanner.get_token()
+            elif token == "hashfull":
+                pv.hashfull = scanner.get_token()
+            elif token == "time":
+                pv.time = scanner.get_token()
+            elif token == "pv":
+                pv.pv = scanner.rest_string()
+            elif token == "multipv":
+                multipv = scanner.get_integer()
+            elif token == "score":
+                token = scanner.get_token()
+                if token == "mate":
+                    is_minus = scanner.peek_token()[0] == "-"
+                    ply = scanner.get_integer()
+                    if ply is None:
+                        ply = UsiEvalSpecialValue.ValueMaxMatePly
+                    if not is_minus:
+                        pv.eval = UsiEvalValue.mate_in_ply(ply)
+                    else:
+                        pv.eval = UsiEvalValue.mated_in_ply(-int(ply))
+                elif token == "cp":
+                    pv.eval = UsiEvalValue(scanner.get_integer())
+
+                token = scanner.peek_token()
+                if token == "upperbound":
+                    pv.bound = UsiBound.BoundUpper
+                    scanner.get_token()
+                elif token == "lowerbound":
+                    pv.bound = UsiBound.BoundLower
+                    scanner.get_token()
+                else:
+                    pv.bound = UsiBound.BoundExact
+            else:
+                raise ValueError("ParseError")
+        except:
+            pass
+    return multipv, pv
+
+
+# linesをすべて解釈するのにかかった時間から、1秒あたりの解釈行数を返す。
+def lines_per_second(parse, lines) -> float:
+    best = None
+    # 何回か計測して、いちばん速かったものを採用する。
+    for _ in range(5):
+        start = time.perf_counter()
+        for line in lines:
+            parse(line)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(lines) / best
+
+
+def main():
+    parser = argparse.ArgumentParser("bench.info_parser")
+    parser.add_argument("--file", type=str, default=None, help="engine output log")
+    args = parser.parse_args()
+
+    if args.file is None:
+        lines = [line for move in generate_game() for line in move]
+    else:
+        with open(args.file, encoding="utf-8") as f:
+            lines = [line.strip() for line in f if line.startswith("info")]
+
+    print("info lines = {0}".format(len(lines)))
+    before = lines_per_second(legacy_parse_info, lines)
+    after = lines_per_second(parse_info, lines)
+    print("before (Scanner)     : {0:12,.0f} [lines/s]".format(before))
+    print("after  (parse_info)  : {0:12,.0f} [lines/s]".format(after))
+    print("speedup              : {0:.2f}x".format(after / before))
+
+
+if __name__ == "__main__":
+    main()
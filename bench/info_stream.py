@@ -0,0 +1,65 @@
+# ベンチマーク用に、やねうら王が出力する"info"行を模倣したものを生成する。
+#
+# やねうら王は1手ごとに、深さ1から順に以下のような行を出力する。
+#   info depth 1 seldepth 1 score cp 60 nodes 38 nps 38000 time 1 pv 2g2f
+#   info depth 12 seldepth 16 score cp 58 upperbound nodes 51273 nps 1709100 hashfull 3 time 30 pv 2g2f 8c8d
+#   info string ...
+# 浅い深さでは1手あたり数百～数千行になる。
+
+import random
+from typing import List
+
+MOVES = [
+    "7g7f", "3c3d", "2g2f", "8c8d", "2f2e", "8d8e", "6i7h", "4a3b", "2e2d", "2c2d",
+    "2h2d", "8e8f", "8g8f", "8b8f", "5i5h", "5a5b", "3i3h", "7a7b", "1g1f", "1c1d",
+]
+
+
+# 1手分の"info"行の集合を生成する。
+# max_depth : 最大の読みの深さ
+# lines_per_depth : 1つの深さあたりの行数(aspiration searchでfail high/lowが繰り返されるのを模倣)
+def generate_move(rng: random.Random, max_depth: int, lines_per_depth: int) -> List[str]:
+    lines = []
+    nodes = 0
+    eval_ = rng.randint(-300, 300)
+    for depth in range(1, max_depth + 1):
+        for i in range(lines_per_depth):
+            nodes += rng.randint(1000, 30000) * depth
+            time = max(nodes // 1700000, 1)
+            eval_ += rng.randint(-30, 30)
+            if i != lines_per_depth - 1:
+                bound = " upperbound" if i % 2 == 0 else " lowerbound"
+            else:
+                bound = ""
+            pv = " ".join(rng.choice(MOVES) for _ in range(min(depth, 1 + depth // 2) + 1))
+            lines.append(
+                "info depth {0} seldepth {1} score cp {2}{3} nodes {4} nps {5} hashfull {6} time {7} pv {8}".format(
+                    depth,
+                    depth + rng.randint(0, 8),
+                    eval_,
+                    bound,
+                    nodes,
+                    nodes * 1000 // time,
+                    min(nodes // 100000, 1000),
+                    time,
+                    pv,
+                )
+            )
+        if depth % 8 == 0:
+            lines.append("info string hash probe {0}".format(depth))
+    # 詰みを見つけたときの形式も混ぜておく。
+    if rng.random() < 0.05:
+        lines.append(
+            "info depth {0} seldepth {1} score mate 7 nodes {2} nps 1700000 time {3} pv 2d2c+ 3a2b 2c2b".format(
+                max_depth, max_depth + 3, nodes, max(nodes // 1700000, 1)
+            )
+        )
+    return lines
+
+
+# plies手分の"info"行の集合を生成する。1手ごとのlistを返す。
+def generate_game(
+    plies: int = 160, max_depth: int = 20, lines_per_depth: int = 3, seed: int = 1
+) -> List[List[str]]:
+    rng = random.Random(seed)
+    return [generate_move(rng, max_depth, lines_per_depth) for _ in range(plies)]
@@ -0,0 +1,77 @@
+# 棋譜の読み込み速度を、テキスト形式(sfen)とバイナリ形式(kifu_binary)で比較する。
+#
+# 実行方法 : (リポジトリのrootで)
+#   python -m bench.kifu_binary
+#   python -m bench.kifu_binary --games 1000000
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+
+from src.engine.game_result import GameResult
+from src.engine.kifu import GameKifu
+from src.engine.kifu_binary import MOVE_TO_CODE, KifuBinaryReader, text_to_binary
+from src.engine.kifu_sink import KifuSink, read_kifus
+
+
+# ランダムな指し手からなる棋譜をn局生成して、sfen形式のファイルに書き出す。
+def write_text_kifus(path: str, n: int, seed: int = 1):
+    rand = random.Random(seed)
+    all_moves = list(MOVE_TO_CODE.keys())
+    sink = KifuSink(path, "sfen", flush_games=10000)
+    for _ in range(n):
+        kifu = GameKifu()
+        kifu.moves = [rand.choice(all_moves) for _ in range(rand.randint(60, 160))]
+        kifu.game_result = GameResult.BLACK_WIN
+        sink.write(kifu)
+    sink.close()
+
+
+def main():
+    parser = argparse.ArgumentParser("bench.kifu_binary")
+    parser.add_argument("--games", type=int, default=100000, help="number of games")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        text_path = os.path.join(tempdir, "kifu.sfen")
+        binary_path = os.path.join(tempdir, "kifu.bin")
+        write_text_kifus(text_path, args.games)
+
+        start = time.time()
+        text_to_binary(text_path, binary_path)
+        print("convert          : {0:.2f}s".format(time.time() - start))
+        print(
+            "file size        : text {0:,} bytes , binary {1:,} bytes".format(
+                os.path.getsize(text_path), os.path.getsize(binary_path)
+            )
+        )
+
+        # 初手の出現頻度を数える。
+        start = time.time()
+        counter = Counter(
+            kifu.moves[0] for kifu in read_kifus(text_path, "sfen") if kifu.moves
+        )
+        print("text scan        : {0:.2f}s".format(time.time() - start))
+
+        reader = KifuBinaryReader(binary_path)
+        start = time.time()
+        counter2 = Counter()
+        for i in range(len(reader)):
+            codes = reader.get_move_codes(i)
+            if len(codes) > 0:
+                counter2[codes[0]] += 1
+        print("binary scan      : {0:.2f}s".format(time.time() - start))
+        assert sum(counter.values()) == sum(counter2.values())
+
+        start = time.time()
+        for kifu in reader:
+            pass
+        print("binary decode    : {0:.2f}s".format(time.time() - start))
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# 全エンジンのレーティングの最尤推定(rating_fit)にかかる時間を計測する。
+#
+# 実行方法 : (リポジトリのrootで)
+#   python -m bench.rating_fit
+#   python -m bench.rating_fit --engines 100 --games 1000000
+
+import argparse
+import random
+import time
+
+from src.engine.rating_fit import GameResultTable, fit_ratings
+
+
+def main():
+    parser = argparse.ArgumentParser("bench.rating_fit")
+    parser.add_argument("--engines", type=int, default=40, help="number of engines")
+    parser.add_argument("--games", type=int, default=500000, help="number of games")
+    parser.add_argument("--loop", type=int, default=250, help="games per iteration")
+    args = parser.parse_args()
+
+    # 真のレーティングを決めて、ayaneru-gateと同じくloop局ずつ対局させた結果を作る。
+    rand = random.Random(1)
+    names = ["engine{0}".format(i) for i in range(args.engines)]
+    true_ratings = {name: 1500 + rand.uniform(-400, 400) for name in names}
+    table = GameResultTable()
+    for _ in range(max(args.games // args.loop, 1)):
+        player1, player2 = rand.sample(names, 2)
+        diff = true_ratings[player1] - true_ratings[player2]
+        p = 1 / (1 + 10 ** (-diff / 400))
+        win = sum(rand.random() < p for _ in range(args.loop))
+        table.add(player1, player2, win, 0, args.loop - win)
+
+    fixed = {names[0]: true_ratings[names[0]]}
+    start = time.time()
+    ratings = fit_ratings(table, fixed_ratings=fixed)
+    elapsed = time.time() - start
+
+    errors = [abs(ratings[name][0] - true_ratings[name]) for name in names]
+    intervals = [ratings[name][1] for name in names[1:]]
+    print("games            : {0:,}".format(table.total_games()))
+    print("pairs            : {0:,}".format(len(table.results)))
+    print("fit              : {0:.3f}s".format(elapsed))
+    print("max error        : {0:.1f}".format(max(errors)))
+    print("mean 95% CI      : +-{0:.1f}".format(sum(intervals) / len(intervals)))
+
+
+if __name__ == "__main__":
+    main()
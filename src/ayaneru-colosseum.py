@@ -32,9 +32,16 @@
 
 # --loop
 # 対局回数
+# ちょうどこの数だけ対局を開始して、対局中のものもすべて終局するまで待つ。(途中で打ち切って捨てる対局はない)
 
 # --cores
-# CPUのコア数
+# CPUのコア数。"auto"を指定すると、このプロセスが使えるCPUの数を自動で調べる。
+
+# --memory
+# エンジンに使わせてよいメモリ[MB]。
+# 指定するか、--cores autoのときは、エンジンを1つずつ起動してメモリ使用量を計測し、
+# 並列対局数を、CPUの数だけでなくメモリにも収まるように決める。
+# --cores autoで--memoryを指定しなければ、空きメモリ(/proc/meminfoのMemAvailable)の9割とする。
 
 # --thread1 , thread2
 # エンジン1P側のスレッド数、エンジン2P側のスレッド数
@@ -45,17 +52,84 @@
 # --flip_turn
 # 1局ごとに先後入れ替えるのか(デフォルト:True)
 
+# --paired
+# 開始局面を重複なく選んで、それぞれ先後を入れ替えて2局ずつ対局させる。(デフォルト:False)
+# 2局1組の結果(pentanomial)からレーティングの信頼区間を求めるので、少ない対局数で同じ信頼度が得られる。
+# このとき--flip_turnは用いない。--loopは偶数にしておくとよい。
+
+# --processes
+# 対局サーバーを分割して動かすプロセス数。0なら分割しない(デフォルト:0)
+# 並列対局数が多いときに、pythonのGILがボトルネックになるのを防ぐ。
+
 # --book_file
 # 定跡ファイル("startpos moves ..."や"sfen ... moves ..."のような書式で書かれているものとする)
 
 # --start_gameply
 # 定跡ファイルの開始手数。0を指定すると末尾の局面から開始。1を指定すると初期局面。
 
+# --kifu_file
+# 対局棋譜を書き出すファイル(homeからの相対path)。指定しなければ書き出さない。
+# 終局するごとに追記していくので、対局回数が多くてもメモリを消費しない。
+
+# --kifu_format
+# 対局棋譜の形式。"jsonl"(試合結果などを含む) か "sfen"(棋譜のみ)。(デフォルト:jsonl)
+
+# --cpu_affinity
+# 対局サーバーごとに、互いに重ならないCPU(物理コア単位。足りなければ論理コア単位)を割り当てて、エンジンをそこでだけ動かす。(デフォルト:False)
+# 他の対局のエンジンとCPUを奪い合わなくなるので、思考時間あたりの探索量が安定する。(Linuxのみ)
+# CPUが足りなくて割り当てられなかった対局サーバーは、割り当てずに動かす。
+
+# --adaptive
+# 対局中に並列数を増減させる。(デフォルト:False)
+# 1手に使った時間が秒読みを大きく超過したり時間切れになったりしたら並列数を減らし、
+# 超過のない対局が続いたら(--coresなどで決めた並列数を上限として)増やす。
+# 共有マシンや熱による性能低下で、時間切れが起きるのを防ぐ。
+
+# --min_servers
+# --adaptiveのときの並列数の下限。(デフォルト:1)
+
+# --watchdog
+# 1手ごとに、その手で使える時間(残り持ち時間 + 秒読み + inc)に加えてこの秒数だけ待っても"bestmove"が返ってこないエンジンは、
+# 応答しなくなったものとして強制終了させて起動しなおす。0なら無制限に待つ。(デフォルト:10)
+
+# --hang_loss
+# 応答しなくなったエンジンがあった対局を、その側の負けとして集計する。(デフォルト:False)
+# 指定しなければ、その対局は無効にして集計せずに対局しなおす。
+
+# --recycle_games
+# エンジンをこの対局数ごとに起動しなおす。0なら起動しなおさない。(デフォルト:0)
+# 長時間の対局で、エンジンのメモリリークやhashの断片化によって探索速度が落ちていくのを防ぐ。
+# 起動しなおしている間も、他の対局サーバーは対局を続ける。
+
+# --recycle_rss
+# エンジンの物理メモリ使用量が、最初の対局の終局時からこの量[MB]以上増えたら起動しなおす。0なら見ない。(デフォルト:0)
+
+# --sprt
+# 逐次確率比検定(SPRT)で、結論が出たら対局を打ち切る。(デフォルト:False)
+# engine1がengine2より、レーティング差elo0(H0)とelo1(H1)のどちらに近いかを1局ごとに判定する。
+# このとき--loopは対局数の上限となる。
+# 例 : --sprt --elo0 0 --elo1 5 : engine1が5以上強くなったか(H1)、強くなっていないか(H0)
+
+# --elo0 , --elo1
+# SPRTのH0 , H1のレーティング差(デフォルト:0 , 5)
+
+# --alpha , --beta
+# SPRTの第一種の過誤の確率 , 第二種の過誤の確率(デフォルト:0.05 , 0.05)
+
 import argparse
 import os
-import time
 
+from src.engine.book import OpeningBook
+from src.engine.concurrency import (
+    ConcurrencyController,
+    ConcurrencyPlanner,
+    parse_cores,
+)
+from src.engine.enums import WatchdogPolicy
+from src.engine.kifu_sink import KIFU_FORMATS, KifuSink
+from src.engine.rating import Sprt
 from src.engine.server_multi import MultiAyaneruServer
+from src.engine.server_sharded import ShardedMultiAyaneruServer
 from src.settings import get_settings
 
 settings = get_settings()
@@ -94,7 +168,15 @@ def AyaneruColosseum():
 
     # CPUコア数
     parser.add_argument(
-        "--cores", type=int, default=8, help="cpu cores(number of logical thread)"
+        "--cores",
+        type=str,
+        default="8",
+        help="cpu cores(number of logical thread) or 'auto'",
+    )
+
+    # エンジンに使わせてよいメモリ
+    parser.add_argument(
+        "--memory", type=int, default=None, help="memory[MB] for engines"
     )
 
     # エンジンに割り当てるスレッド数
@@ -114,6 +196,21 @@ def AyaneruColosseum():
         "--flip_turn", type=bool, default=True, help="flip turn every game"
     )
 
+    # paired
+    parser.add_argument(
+        "--paired",
+        action="store_true",
+        help="play each opening twice with colors swapped",
+    )
+
+    # 対局サーバーを分割するプロセス数
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="number of processes to run game servers(0 = run in this process)",
+    )
+
     # book_file
     parser.add_argument("--book_file", type=str, default=None, help="book filepath")
 
@@ -122,6 +219,74 @@ def AyaneruColosseum():
         "--start_gameply", type=int, default=24, help="start game ply in the book"
     )
 
+    # kifu_file
+    parser.add_argument(
+        "--kifu_file", type=str, default=None, help="kifu filepath to write"
+    )
+
+    # kifu_format
+    parser.add_argument(
+        "--kifu_format",
+        type=str,
+        default="jsonl",
+        choices=KIFU_FORMATS,
+        help="kifu file format",
+    )
+
+    # cpu_affinity
+    parser.add_argument(
+        "--cpu_affinity",
+        action="store_true",
+        help="pin each game server's engines to its own cpus",
+    )
+
+    # 並列数を対局中に増減させるか
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="grow or shrink the number of game servers by move time overshoot",
+    )
+    parser.add_argument(
+        "--min_servers",
+        type=int,
+        default=1,
+        help="minimum number of game servers with --adaptive",
+    )
+
+    # 応答しなくなったエンジンの監視
+    parser.add_argument(
+        "--watchdog",
+        type=float,
+        default=10.0,
+        help="seconds to wait beyond the move time budget before restarting an engine",
+    )
+    parser.add_argument(
+        "--hang_loss",
+        action="store_true",
+        help="count a game with a hung engine as its loss instead of replaying it",
+    )
+
+    # エンジンを定期的に起動しなおすか
+    parser.add_argument(
+        "--recycle_games",
+        type=int,
+        default=0,
+        help="restart each engine after this many games (0 = never)",
+    )
+    parser.add_argument(
+        "--recycle_rss",
+        type=int,
+        default=0,
+        help="restart an engine when its RSS has grown by this many MB (0 = never)",
+    )
+
+    # SPRT
+    parser.add_argument("--sprt", action="store_true", help="stop games early by SPRT")
+    parser.add_argument("--elo0", type=float, default=0, help="SPRT elo0")
+    parser.add_argument("--elo1", type=float, default=5, help="SPRT elo1")
+    parser.add_argument("--alpha", type=float, default=0.05, help="SPRT alpha")
+    parser.add_argument("--beta", type=float, default=0.05, help="SPRT beta")
+
     args = parser.parse_args()
 
     # --- コマンドラインのparseここまで ---
@@ -135,10 +300,27 @@ def AyaneruColosseum():
     print("hash2          : {0}".format(args.hash2))
     print("loop           : {0}".format(args.loop))
     print("cores          : {0}".format(args.cores))
+    print("memory         : {0}".format(args.memory))
+    print("processes      : {0}".format(args.processes))
     print("time           : {0}".format(args.time))
     print("flip_turn      : {0}".format(args.flip_turn))
+    print("paired         : {0}".format(args.paired))
     print("book file      : {0}".format(args.book_file))
     print("start_gameply  : {0}".format(args.start_gameply))
+    print("kifu file      : {0}".format(args.kifu_file))
+    print("kifu format    : {0}".format(args.kifu_format))
+    print("cpu affinity   : {0}".format(args.cpu_affinity))
+    print("adaptive       : {0}".format(args.adaptive))
+    print("watchdog       : {0}".format(args.watchdog))
+    print("hang_loss      : {0}".format(args.hang_loss))
+    print("recycle_games  : {0}".format(args.recycle_games))
+    print("recycle_rss    : {0}".format(args.recycle_rss))
+    if args.sprt:
+        print(
+            "sprt           : elo0 {0} , elo1 {1} , alpha {2} , beta {3}".format(
+                args.elo0, args.elo1, args.alpha, args.beta
+            )
+        )
 
     # directory
 
@@ -149,22 +331,28 @@ def AyaneruColosseum():
     eval2 = os.path.join(home, args.eval2)
 
     # マルチあやねるサーバーをそのまま用いる
-    server = MultiAyaneruServer()
-
-    # 1対局に要するスレッド数
-    # (先後、同時に思考しないので大きいほう)
-    thread_total = max(args.thread1, args.thread2)
-    # 何並列で対局するのか？ 2スレほど余らせておかないとtimeupになるかもしれん。
-    # メモリが足りるかは知らん。メモリ足りないとこれまたメモリスワップでtimeupになる。
-    cores = max(args.cores - 2, 1)
-    game_server_num = int(cores / thread_total)
+    # processesが指定されていれば、対局サーバーを複数のプロセスに分割する。
+    if args.processes > 0:
+        server = ShardedMultiAyaneruServer()
+        server.processes = args.processes
+    else:
+        server = MultiAyaneruServer()
+    server.cpu_affinity = args.cpu_affinity
+    if args.adaptive:
+        server.concurrency_controller = ConcurrencyController(args.min_servers)
+    server.watchdog_margin = args.watchdog if args.watchdog > 0 else None
+    if args.hang_loss:
+        server.watchdog_policy = WatchdogPolicy.Loss
+    if args.recycle_games > 0:
+        server.recycle_games = args.recycle_games
+    if args.recycle_rss > 0:
+        server.recycle_rss_growth = args.recycle_rss
+    if args.sprt:
+        server.sprt = Sprt(args.elo0, args.elo1, args.alpha, args.beta)
 
     # エンジンとのやりとりを標準出力に出力する
     # server.debug_print = True
 
-    # あやねるサーバーを起動
-    server.init_server(game_server_num)
-
     # エンジンオプション
     options_common = {
         "NetworkDelay": "0",
@@ -174,39 +362,69 @@ def AyaneruColosseum():
         "BookFile": "no_book",
     }
     options1p = {
+        **options_common,
         "Hash": str(args.hash1),
         "Threads": str(args.thread1),
         "EvalDir": eval1,
     }
     options2p = {
+        **options_common,
         "Hash": str(args.hash2),
         "Threads": str(args.thread2),
         "EvalDir": eval2,
     }
 
+    # 1対局に要するスレッド数
+    # (先後、同時に思考しないので大きいほう)
+    thread_total = max(args.thread1, args.thread2)
+    # 何並列で対局するのか？ 2スレほど余らせておかないとtimeupになるかもしれん。
+    # メモリ足りないとメモリスワップでtimeupになるので、メモリを指定されていればそれにも収まるようにする。
+    cores = parse_cores(args.cores)
+    memory = args.memory if args.memory is not None else (None if cores is None else 0)
+    planner = ConcurrencyPlanner(cores, memory)
+    game_server_num = planner.plan(
+        [(engine1, options1p), (engine2, options2p)], thread_total
+    )
+    print(planner.plan_info)
+
+    # あやねるサーバーを起動
+    server.init_server(game_server_num)
+
     # 1P,2P側のエンジンそれぞれを設定して初期化する。
-    server.init_engine(0, engine1, {**options_common, **options1p})
-    server.init_engine(1, engine2, {**options_common, **options2p})
+    server.init_engine(0, engine1, options1p)
+    server.init_engine(1, engine2, options2p)
 
     # 持ち時間設定。
     server.set_time_setting(args.time)
 
     # flip_turnを反映させる
     server.flip_turn_every_game = args.flip_turn
+    server.paired_openings = args.paired
 
     # 定跡
 
     # テスト用の定跡ファイル
     # args.book_file = "book/records2016_10818.sfen"
+    # 定跡ファイルは読み込まずにmmapしておき、対局開始ごとにそこから1局面を取り出す。
     if args.book_file is None:
-        start_sfens = ["startpos"]
+        server.start_sfens = ["startpos"]
     else:
-        book_filepath = os.path.join(home, args.book_file)
-        with open(book_filepath) as f:
-            start_sfens = f.readlines()
-    server.start_sfens = start_sfens
+        server.book = OpeningBook(
+            os.path.join(home, args.book_file), args.start_gameply
+        )
     server.start_gameply = args.start_gameply
 
+    # loop回数だけ対局を開始する。それ以上開始しないので、loop局終わった時点で対局中のものはない。
+    server.max_games = args.loop
+
+    # 対局棋譜の書き出し先
+    # ファイルに書き出すなら、メモリ上には保持しない。
+    kifu_sink = None
+    if args.kifu_file is not None:
+        kifu_sink = KifuSink(os.path.join(home, args.kifu_file), args.kifu_format)
+        server.kifu_sink = kifu_sink
+        server.game_kifus_limit = 0
+
     # 対局スレッド数、秒読み設定などを短縮文字列化する。
     if args.thread1 == args.thread2:
         game_setting_str = "t{0}".format(args.thread1)
@@ -220,7 +438,12 @@ def AyaneruColosseum():
     )
 
     # これで対局が開始する
+    # (すべてのエンジンの"readyok"を待ってから開始する。起動に失敗したエンジンの対局サーバーは取り除かれる。)
     server.game_start()
+    if args.processes == 0:
+        print(server.startup_info())
+    if args.cpu_affinity:
+        print(server.cpu_affinity_report)
 
     # loop回数試合終了するのを待つ
     last_total_games = 0
@@ -233,18 +456,27 @@ def AyaneruColosseum():
             last_total_games = server.total_games
             print(game_setting_str + "." + server.game_info())
 
-    while server.total_games < loop:
+    # 1局終わるごとに起こしてもらう。
+    # SPRTで結論が出たら、loop回数に達していなくてもそこで終わる。
+    for n in range(1, loop + 1):
+        server.wait_for_games(n)
         output_info()
-        time.sleep(1)
-    output_info()
+        if server.is_finished():
+            print("SPRT : {0} accepted".format(server.sprt.accepted))
+            break
 
     server.game_stop()
+    # 並列数をどう増減させたか(子プロセスに分割したときは、子プロセス側にしか残らない)
+    if args.adaptive and args.processes == 0:
+        print(server.concurrency_controller.info())
 
     # 対局棋譜の出力
     # for kifu in server.game_kifus:
     #     print("game sfen = {0} , flip_turn = {1} , game_result = {2}".format(kifu.sfen , kifu.flip_turn , str(kifu.game_result)))
 
     server.terminate()
+    if kifu_sink is not None:
+        kifu_sink.close()
 
 
 if __name__ == "__main__":
@@ -21,6 +21,10 @@
 # rating:1900          // rating_fixを指定したときのこのソフトのレーティング
 # その他の値は、必須項目ではないです。下のEngineInfoクラスの定義を参考にどうぞ。
 # rating_fixをFalseにしていると対局終了ごとに、この"engine_define.txtに更新されたratingが書き戻されます。
+#
+# レーティングは、これまでのすべての対局結果から(Bradley–Terryモデルで)全エンジンまとめて最尤推定したものです。
+# rating_fixのエンジンが基準になります。対局結果は home/game_results.txt に追記していき、
+# 次回起動したときも読み込んで用いるので、このファイルを消すとレーティングの計算はやり直しになります。
 
 # === 本スクリプトの引数の意味 ===
 
@@ -50,31 +54,106 @@
 # 例 : --time "time1p 10000 time2p 10000 inc1p 5000 inc2p 1000" : 10秒 + 先手1手ごとに5秒、後手1手ごとに1秒加算
 
 # --iteration
-# 対局のイテレーション回数
+# 対局のイテレーション回数(対局させる2つのソフトの組の数)
+# 各対局サーバーは、組を1つ受け持ってloop回対局したら次の組に移るので、複数の組の対局が同時に進む。
+# (1つの組の対局が終わるのを待たずに、空いた対局サーバーから次の組を開始するので、CPUが遊ばない)
+# 組の対局が終わるごとに、レーティングを推定し直す。
+# 1局終わるごとに、対局中の組の途中経過をログに出力する。
+
+# --refit_games
+# この対局数ごとに、まだ対局が終わっていない組の途中までの戦績も加えて、暫定のレーティングを推定して出力する。(デフォルト:100)
+# 暫定のレーティングはエンジン設定ファイルには書き戻さない。0なら、組の対局が終わったときだけ推定する。
 
 # --loop
 # 2つのソフトの対局回数
 # loop×iteration の回数だけ、対局がなされる。
 
 # --cores
-# CPUのコア数
+# CPUのコア数。"auto"を指定すると、このプロセスが使えるCPUの数を自動で調べる。
+
+# --memory
+# エンジンに使わせてよいメモリ[MB]。
+# 指定するか、--cores autoのときは、エンジンを1つずつ起動してメモリ使用量を計測し、
+# 並列対局数を、CPUの数だけでなくメモリにも収まるように決める。(計測はエンジンごとに1回だけ)
+# --cores autoで--memoryを指定しなければ、空きメモリ(/proc/meminfoのMemAvailable)の9割とする。
 
 # --flip_turn
 # 1局ごとに先後入れ替えるのか(デフォルト:False)
 
+# --paired
+# 開始局面を重複なく選んで、それぞれ先後を入れ替えて2局ずつ対局させる。(デフォルト:False)
+# 2局1組の結果(pentanomial)からレーティングの信頼区間を求めるので、少ない対局数で同じ信頼度が得られる。
+# このとき--flip_turnは用いない。--loopは偶数にしておくとよい。
+
+# --processes
+# 対局サーバーを分割して動かすプロセス数。0なら分割しない(デフォルト:0)
+# 並列対局数が多いときに、pythonのGILがボトルネックになるのを防ぐ。
+
 # --book_file
 # 定跡ファイル("startpos moves ..."や"sfen ... moves ..."のような書式で書かれているものとする)
 
 # --start_gameply
 # 定跡ファイルの開始手数。0を指定すると末尾の局面から開始。1を指定すると初期局面。
 
+# --pool_memory
+# イテレーションをまたいで使い回すエンジンのメモリ使用量の上限[MB]。(デフォルト:物理メモリの半分)
+# 対局が終わったエンジンは終了させずに残しておき、次のイテレーションで同じエンジンが選ばれたらそれを用いる。
+# 上限を超えたら、最も長く使われていないエンジンから終了させる。0を指定すると使い回さない。
+# processesを指定したときは使い回さない。
+
+# --kifu_format
+# 対局棋譜の形式。"jsonl"(試合結果などを含む) か "sfen"(棋譜のみ)。(デフォルト:jsonl)
+# 対局棋譜は、home/log/kifu{日時}.jsonl のようなファイルに終局するごとに追記していく。
+
+# --cpu_affinity
+# 対局サーバーごとに、互いに重ならないCPU(物理コア単位。足りなければ論理コア単位)を割り当てて、エンジンをそこでだけ動かす。(デフォルト:False)
+# 他の対局のエンジンとCPUを奪い合わなくなるので、思考時間あたりの探索量が安定する。(Linuxのみ)
+# CPUが足りなくて割り当てられなかった対局サーバーは、割り当てずに動かす。
+
+# --adaptive
+# 対局中に並列数を増減させる。(デフォルト:False)
+# 1手に使った時間が秒読みを大きく超過したり時間切れになったりしたら並列数を減らし、
+# 超過のない対局が続いたら(--coresなどで決めた並列数を上限として)増やす。
+# 共有マシンや熱による性能低下で、時間切れが起きるのを防ぐ。
+
+# --min_servers
+# --adaptiveのときの並列数の下限。(デフォルト:1)
+
+# --watchdog
+# 1手ごとに、その手で使える時間(残り持ち時間 + 秒読み + inc)に加えてこの秒数だけ待っても"bestmove"が返ってこないエンジンは、
+# 応答しなくなったものとして強制終了させて起動しなおす。0なら無制限に待つ。(デフォルト:10)
+
+# --hang_loss
+# 応答しなくなったエンジンがあった対局を、その側の負けとして集計する。(デフォルト:False)
+# 指定しなければ、その対局は無効にして集計せずに対局しなおす。
+
+# --recycle_games
+# エンジンをこの対局数ごとに起動しなおす。0なら起動しなおさない。(デフォルト:0)
+# 長時間の対局で、エンジンのメモリリークやhashの断片化によって探索速度が落ちていくのを防ぐ。
+# 起動しなおしている間も、他の対局サーバーは対局を続ける。
+
+# --recycle_rss
+# エンジンの物理メモリ使用量が、最初の対局の終局時からこの量[MB]以上増えたら起動しなおす。0なら見ない。(デフォルト:0)
+
 import argparse
 import os
 import random
-import time
-
+from datetime import datetime
+
+from src.engine.book import OpeningBook
+from src.engine.concurrency import (
+    ConcurrencyController,
+    ConcurrencyPlanner,
+    parse_cores,
+)
+from src.engine.engine_match import EngineMatch
+from src.engine.engine_pool import UsiEnginePool, get_physical_memory
+from src.engine.enums import WatchdogPolicy
+from src.engine.kifu_sink import KIFU_FORMATS, KifuSink
 from src.engine.log import Log
+from src.engine.rating_fit import GameResultTable, fit_ratings
 from src.engine.server_multi import MultiAyaneruServer
+from src.engine.server_sharded import ShardedMultiAyaneruServer
 
 
 # エンジンに関する情報構造体
@@ -224,9 +303,25 @@ def AyaneruGate():
     # 対局回数
     parser.add_argument("--loop", type=int, default=10, help="number of games")
 
+    # 暫定のレーティングを推定する対局数
+    parser.add_argument(
+        "--refit_games",
+        type=int,
+        default=100,
+        help="provisional rating every N games (0 = only when a pairing ends)",
+    )
+
     # CPUコア数
     parser.add_argument(
-        "--cores", type=int, default=8, help="cpu cores(number of logical threads)"
+        "--cores",
+        type=str,
+        default="8",
+        help="cpu cores(number of logical threads) or 'auto'",
+    )
+
+    # エンジンに使わせてよいメモリ
+    parser.add_argument(
+        "--memory", type=int, default=None, help="memory[MB] for engines"
     )
 
     # flip_turn
@@ -234,6 +329,21 @@ def AyaneruGate():
         "--flip_turn", type=bool, default=True, help="flip turn every game"
     )
 
+    # paired
+    parser.add_argument(
+        "--paired",
+        action="store_true",
+        help="play each opening twice with colors swapped",
+    )
+
+    # 対局サーバーを分割するプロセス数
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="number of processes to run game servers(0 = run in this process)",
+    )
+
     # book_file
     parser.add_argument(
         "--book_file",
@@ -247,18 +357,97 @@ def AyaneruGate():
         "--start_gameply", type=int, default=24, help="start game ply in the book"
     )
 
+    # 使い回すエンジンのメモリ使用量の上限
+    parser.add_argument(
+        "--pool_memory",
+        type=int,
+        default=None,
+        help="memory budget[MB] for engines kept across iterations(0 = don't keep)",
+    )
+
+    # kifu_format
+    parser.add_argument(
+        "--kifu_format",
+        type=str,
+        default="jsonl",
+        choices=KIFU_FORMATS,
+        help="kifu file format",
+    )
+
+    # cpu_affinity
+    parser.add_argument(
+        "--cpu_affinity",
+        action="store_true",
+        help="pin each game server's engines to its own cpus",
+    )
+
+    # 並列数を対局中に増減させるか
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="grow or shrink the number of game servers by move time overshoot",
+    )
+    parser.add_argument(
+        "--min_servers",
+        type=int,
+        default=1,
+        help="minimum number of game servers with --adaptive",
+    )
+
+    # 応答しなくなったエンジンの監視
+    parser.add_argument(
+        "--watchdog",
+        type=float,
+        default=10.0,
+        help="seconds to wait beyond the move time budget before restarting an engine",
+    )
+    parser.add_argument(
+        "--hang_loss",
+        action="store_true",
+        help="count a game with a hung engine as its loss instead of replaying it",
+    )
+
+    # エンジンを定期的に起動しなおすか
+    parser.add_argument(
+        "--recycle_games",
+        type=int,
+        default=0,
+        help="restart each engine after this many games (0 = never)",
+    )
+    parser.add_argument(
+        "--recycle_rss",
+        type=int,
+        default=0,
+        help="restart an engine when its RSS has grown by this many MB (0 = never)",
+    )
+
     args = parser.parse_args()
 
+    if args.pool_memory is None:
+        physical_memory = get_physical_memory()
+        args.pool_memory = physical_memory // 2 if physical_memory is not None else 0
+
     # --- コマンドラインのparseここまで ---
 
     print("home           : {0}".format(args.home))
     print("iteration      : {0}".format(args.iteration))
     print("loop           : {0}".format(args.loop))
+    print("refit_games    : {0}".format(args.refit_games))
     print("cores          : {0}".format(args.cores))
+    print("memory         : {0}".format(args.memory))
+    print("processes      : {0}".format(args.processes))
     print("time           : {0}".format(args.time))
     print("flip_turn      : {0}".format(args.flip_turn))
+    print("paired         : {0}".format(args.paired))
     print("book file      : {0}".format(args.book_file))
     print("start_gameply  : {0}".format(args.start_gameply))
+    print("pool_memory    : {0}".format(args.pool_memory))
+    print("kifu format    : {0}".format(args.kifu_format))
+    print("adaptive       : {0}".format(args.adaptive))
+    print("watchdog       : {0}".format(args.watchdog))
+    print("hang_loss      : {0}".format(args.hang_loss))
+    print("recycle_games  : {0}".format(args.recycle_games))
+    print("recycle_rss    : {0}".format(args.recycle_rss))
 
     # directory
 
@@ -266,6 +455,20 @@ def AyaneruGate():
     log = Log(os.path.join(home, "log"))
     log.print("iteration start", output_datetime=True)
 
+    # 対局棋譜の書き出し先。全イテレーションで1つのファイルに追記していく。
+    log_folder = os.path.join(home, "log")
+    os.makedirs(log_folder, exist_ok=True)
+    kifu_sink = KifuSink(
+        os.path.join(
+            log_folder,
+            "kifu{0}.{1}".format(
+                datetime.now().strftime("%Y-%m-%d %H-%M-%S"), args.kifu_format
+            ),
+        ),
+        args.kifu_format,
+    )
+    log.print("kifu file : {0}".format(kifu_sink.path), also_print=True)
+
     # エンジンの列挙
 
     engines_folder = os.path.join(home, "engines")
@@ -296,15 +499,32 @@ def AyaneruGate():
         print("Error! : non fixed rating engine < 2")
         raise ValueError()
 
+    # これまでのすべての対局結果。エンジンフォルダ名で区別する。
+    game_results_path = os.path.join(home, "game_results.txt")
+    game_results = GameResultTable()
+    game_results.load(game_results_path)
+    log.print(
+        "game results : {0} games in {1}".format(
+            game_results.total_games(), game_results_path
+        ),
+        also_print=True,
+    )
+
+    # 最後に推定したレーティングの95%信頼区間の幅。エンジンフォルダ名 -> 幅
+    rating_errors = {}
+
     # それぞれのエンジンのレーティングを表示する。
     def output_engine_rating():
-        nonlocal log, engine_infos
+        nonlocal log, engine_infos, rating_errors
         log.print("== engine rating list ==", also_print=True)
         for info in engine_infos:
+            rating = str(info.rating)
+            if info.engine_folder in rating_errors:
+                rating += " +-{0:.1f}".format(rating_errors[info.engine_folder])
             log.print(
                 "engine : {0} , rating = {1} , rating_fix = {2} , threads = {3}".format(
                     info.engine_display_name,
-                    info.rating,
+                    rating,
                     info.rating_fix,
                     info.engine_threads,
                 ),
@@ -313,21 +533,38 @@ def AyaneruGate():
 
     output_engine_rating()
 
-    # サーバーを一つ起動して、任意の2エンジンで100対局ほど繰り返して、レーティングを変動させる。
-    # あとは、それをloop回数だけ繰り返す。
-
-    for it in range(args.iteration):
-        log.print("iteration : {0}".format(it), output_datetime=True)
-
-        # マルチあやねるサーバーの起動
-        server = MultiAyaneruServer()
-
-        # エンジンとのやりとりを標準出力に出力する
-        # server.debug_print = True
-
-        # 2つのエンジンを選択
-        info1 = None
-        info2 = None
+    # 定跡
+    # 定跡ファイルは読み込まずにmmapしておき、全イテレーションで共有する。
+    book = None
+    if args.book_file is not None:
+        book = OpeningBook(os.path.join(home, args.book_file), args.start_gameply)
+
+    # エンジンのpool
+    # イテレーションごとにエンジンを起動し直すと、評価関数の読み込みに時間がかかるので使い回す。
+    engine_pool = None
+    if args.processes == 0 and args.pool_memory > 0:
+        engine_pool = UsiEnginePool(args.pool_memory)
+
+    # 並列対局数を決めるためのもの
+    # エンジンのメモリ使用量の計測結果は、全イテレーションで共有する。
+    cores = parse_cores(args.cores)
+    memory = args.memory if args.memory is not None else (None if cores is None else 0)
+    planner = ConcurrencyPlanner(cores, memory)
+    # 計測に用いたエンジンは、そのまま対局に使い回す。
+    planner.engine_pool = engine_pool
+
+    # エンジンオプション
+    options_common = {
+        "NetworkDelay": "0",
+        "NetworkDelay2": "0",
+        "MaxMovesToDraw": "320",
+        "MinimumThinkingTime": "0",
+        "BookFile": "no_book",
+    }
+
+    # 対局させる2つのエンジンを選択する。
+    def choose_engines():
+        nonlocal engine_infos
         while True:
             num_of_engines = len(engine_infos)
             p1 = random.randint(0, num_of_engines - 1)
@@ -348,154 +585,248 @@ def AyaneruGate():
                 continue
 
             # 条件を満たしたので抜ける
-            break
-
-        # 今回対局するエンジン名を出力
-
-        log.print(
-            "engine : {0} vs {1}".format(
-                info1.engine_display_name, info2.engine_display_name
-            ),
-            also_print=True,
+            return info1, info2
+
+    # 次に対局させるエンジンの組を返す。iteration個の組を返したら、あとはNone。
+    # (対局監視用のスレッドや、エンジンを入れ替えるスレッドから、1つずつ呼び出される)
+    match_count = 0
+
+    def match_source():
+        nonlocal match_count
+        if match_count >= args.iteration:
+            return None
+        match_count += 1
+
+        info1, info2 = choose_engines()
+        match = EngineMatch(
+            [
+                (info1.engine_exe_fullpath(home), options_common),
+                (info2.engine_exe_fullpath(home), options_common),
+            ],
+            args.loop,
         )
+        match.tag = (info1, info2)
+        return match
 
-        # エンジンの設定
-
-        engine1 = info1.engine_exe_fullpath(home)
-        engine2 = info2.engine_exe_fullpath(home)
-
+    # 対局スレッド数、秒読み設定などを短縮文字列化する。
+    def game_setting_str(info1: EngineInfo, info2: EngineInfo) -> str:
         thread1 = info1.engine_threads
         thread2 = info2.engine_threads
-
-        # 1対局に要するスレッド数
-        # (先後、同時に思考しないので大きいほう)
-        thread_total = max(thread1, thread2)
-        # 何並列で対局するのか？ 2スレほど余らせておかないとtimeupになるかもしれん。
-        # メモリが足りるかは知らん。メモリ足りないとこれまたメモリスワップでtimeupになる。
-        cores = max(args.cores - 2, 1)
-        game_server_num = int(cores / thread_total)
-
-        # あやねるサーバーを起動
-        server.init_server(game_server_num)
-
-        # エンジンオプション
-        options_common = {
-            "NetworkDelay": "0",
-            "NetworkDelay2": "0",
-            "MaxMovesToDraw": "320",
-            "MinimumThinkingTime": "0",
-            "BookFile": "no_book",
-        }
-        # 1P,2P側のエンジンそれぞれを設定して初期化する。
-        server.init_engine(0, engine1, options_common)
-        server.init_engine(1, engine2, options_common)
-
-        # 持ち時間設定。
-        server.set_time_setting(args.time)
-
-        # flip_turnを反映させる
-        server.flip_turn_every_game = args.flip_turn
-
-        # 定跡
-
-        if args.book_file is None:
-            start_sfens = ["startpos"]
-        else:
-            book_filepath = os.path.join(home, args.book_file)
-            with open(book_filepath) as f:
-                start_sfens = f.readlines()
-        server.start_sfens = start_sfens
-        server.start_gameply = args.start_gameply
-
-        # 対局スレッド数、秒読み設定などを短縮文字列化する。
         if thread1 == thread2:
-            game_setting_str = "t{0}".format(thread1)
+            s = "t{0}".format(thread1)
         else:
-            game_setting_str = "t{0},{1}".format(thread1, thread2)
-        game_setting_str += (
+            s = "t{0},{1}".format(thread1, thread2)
+        s += (
             args.time.replace("byoyomi", "b")
             .replace("time", "t")
             .replace("inc", "i")
             .replace(" ", "")
         )
+        return s
 
-        # loop回数試合終了するのを待つ
-        last_total_games = 0
-        loop = args.loop
-
-        # ゲーム数が増えていたら、途中結果を出力する。
-        def output_info():
-            nonlocal last_total_games, server, log
-            if last_total_games != server.total_games:
-                last_total_games = server.total_games
-                log.print(game_setting_str + "." + server.game_info())
-
-        # これで対局が開始する
-        server.game_start()
-
-        while server.total_games < loop:
-            output_info()
-            time.sleep(1)
-        output_info()
-
-        server.game_stop()
-
-        # 対局棋譜の出力(ログとしてフォルダに書き出しておく)
-        for kifu in server.game_kifus:
-            log.print(
-                "game sfen = {0} , flip_turn = {1} , game_result = {2}".format(
-                    kifu.sfen, kifu.flip_turn, str(kifu.game_result)
-                ),
-                also_print=False,
-            )
-
-        # 対局が終わったのでレーティングの移動を行う
-        elo = server.game_rating()
-
-        # 1P側は2P側よりどれだけ勝るか。
-        # 完勝のときは+無限大扱いでいいと思う。(以下でclipするので)
-        rating_diff = elo.rating
-
-        # レーティングの移動量の絶対値の上限は、対局回数に比例させておく。
-        # (少ない対局回数で思いっきり変動してしまうのを防ぐため)
-        rating_diff = min(max(rating_diff, -loop), loop)
-
-        player1_add = 0
-        player2_add = 0
-        if info1.rating_fix:
-            player2_add = -rating_diff
-        elif info2.rating_fix:
-            player1_add = +rating_diff
-        else:
-            player1_add = +int(rating_diff / 2)
-            player2_add = -int(rating_diff / 2)
+    # 1対局に要するスレッド数
+    # (先後、同時に思考しないので大きいほう。どの組を対局させても足りるように、すべてのエンジンの最大値にしておく)
+    thread_total = max(info.engine_threads for info in engine_infos)
+
+    # 何並列で対局するのか？ 2スレほど余らせておかないとtimeupになるかもしれん。
+    # メモリ足りないとメモリスワップでtimeupになるので、メモリを指定されていればそれにも収まるようにする。
+    # どの組を対局させても収まるように、メモリ使用量の多いほうから2つのエンジンで見積もる。
+    engine_configs = [
+        (info.engine_exe_fullpath(home), options_common) for info in engine_infos
+    ]
+    if planner.memory > 0:
+        engine_configs.sort(key=lambda config: -planner.probe(*config))
+    game_server_num = planner.plan(engine_configs[:2], thread_total)
+    log.print(planner.plan_info, also_print=True)
+
+    # マルチあやねるサーバーの起動
+    # processesが指定されていれば、対局サーバーを複数のプロセスに分割する。
+    if args.processes > 0:
+        server = ShardedMultiAyaneruServer()
+        server.processes = args.processes
+    else:
+        server = MultiAyaneruServer()
+        server.engine_pool = engine_pool
+    server.cpu_affinity = args.cpu_affinity
+    server.cpu_threads = thread_total
+    if args.adaptive:
+        server.concurrency_controller = ConcurrencyController(args.min_servers)
+    server.watchdog_margin = args.watchdog if args.watchdog > 0 else None
+    if args.hang_loss:
+        server.watchdog_policy = WatchdogPolicy.Loss
+    if args.recycle_games > 0:
+        server.recycle_games = args.recycle_games
+    if args.recycle_rss > 0:
+        server.recycle_rss_growth = args.recycle_rss
+
+    # エンジンとのやりとりを標準出力に出力する
+    # server.debug_print = True
+
+    # あやねるサーバーを起動
+    server.init_server(game_server_num)
+
+    # 対局サーバーごとに、match_sourceから得た組のエンジンを対局させる。
+    server.match_source = match_source
+
+    # 持ち時間設定。
+    server.set_time_setting(args.time)
+
+    # flip_turnを反映させる
+    server.flip_turn_every_game = args.flip_turn
+    server.paired_openings = args.paired
+
+    # 定跡
+    server.book = book
+    server.start_gameply = args.start_gameply
+
+    # 対局棋譜はファイルに書き出すので、メモリ上には保持しない。
+    server.kifu_sink = kifu_sink
+    server.game_kifus_limit = 0
+
+    # これで対局が開始する
+    # (すべてのエンジンの"readyok"を待ってから開始する。起動に失敗したエンジンの対局サーバーは取り除かれる。)
+    server.game_start()
+    if args.processes == 0:
+        log.print(server.startup_info(), also_print=True)
+    if args.cpu_affinity:
+        log.print(server.cpu_affinity_report, also_print=True)
+
+    # レーティング固定のエンジンを基準にして、tableの対局結果から全エンジンのレーティングを推定する。
+    def estimate_ratings(table: GameResultTable):
+        return fit_ratings(
+            table,
+            {info.engine_folder: info.rating for info in engine_infos},
+            {
+                info.engine_folder: info.rating
+                for info in engine_infos
+                if info.rating_fix
+            },
+        )
 
+    # 組の対局が終わったので、その結果を加えて全エンジンのレーティングを推定し直す。
+    def output_match_result(match: EngineMatch):
+        info1, info2 = match.tag
         log.print(
-            "Player1 : {0} , rating {1} -> {2}".format(
-                info1.engine_display_name, info1.rating, info1.rating + player1_add
+            "iteration : {0} , engine : {1} vs {2}".format(
+                match.match_id,
+                info1.engine_display_name,
+                info2.engine_display_name,
             ),
+            output_datetime=True,
             also_print=True,
         )
         log.print(
-            "Player2 : {0} , rating {1} -> {2}".format(
-                info2.engine_display_name, info2.rating, info2.rating + player2_add
-            ),
+            game_setting_str(info1, info2) + "." + match.game_rating().pretty_string,
             also_print=True,
         )
 
-        info1.rating += player1_add
-        info2.rating += player2_add
+        game_results.append(
+            game_results_path,
+            info1.engine_folder,
+            info2.engine_folder,
+            match.player1_win,
+            match.draw_games,
+            match.player2_win,
+        )
+        ratings = estimate_ratings(game_results)
+        for info in engine_infos:
+            rating, error = ratings[info.engine_folder]
+            rating = info.rating if info.rating_fix else int(round(rating))
+            rating_errors[info.engine_folder] = error
+            if info is info1 or info is info2:
+                log.print(
+                    "Player{0} : {1} , rating {2} -> {3} +-{4:.1f}".format(
+                        1 if info is info1 else 2,
+                        info.engine_display_name,
+                        info.rating,
+                        rating,
+                        error,
+                    ),
+                    also_print=True,
+                )
+
+            # レーティングが変動したのなら、エンジン設定ファイルに書き戻す
+            if rating != info.rating:
+                info.rating = rating
+                info.write_engine_define(home)
+
+    # 対局中の組のうち、対局数が増えていたものの途中経過を出力する。
+    # 組の番号 -> 前回出力したときの対局数
+    last_match_games = {}
+
+    def output_progress():
+        for match, win, draw, lose in server.running_matches():
+            games = win + draw + lose
+            if last_match_games.get(match.match_id, 0) == games:
+                continue
+            last_match_games[match.match_id] = games
+            info1, info2 = match.tag
+            log.print(
+                "iteration : {0} , {1}.{2} - {3} - {4} ({5}/{6})".format(
+                    match.match_id,
+                    game_setting_str(info1, info2),
+                    win,
+                    draw,
+                    lose,
+                    games,
+                    match.games,
+                )
+            )
+
+    # まだ対局が終わっていない組の途中までの戦績も加えて、暫定のレーティングを推定して出力する。
+    # (エンジン設定ファイルには書き戻さない)
+    def output_provisional_rating(total_games: int):
+        table = GameResultTable()
+        for (player1, player2), counts in game_results.results.items():
+            table.add(player1, player2, *counts)
+        for match, win, draw, lose in server.running_matches():
+            info1, info2 = match.tag
+            table.add(info1.engine_folder, info2.engine_folder, win, draw, lose)
+        ratings = estimate_ratings(table)
+        log.print(
+            "== provisional rating ({0} games) ==".format(total_games),
+            output_datetime=True,
+            also_print=True,
+        )
+        for info in engine_infos:
+            if info.rating_fix:
+                continue
+            rating, error = ratings[info.engine_folder]
+            log.print(
+                "engine : {0} , rating = {1} +-{2:.1f}".format(
+                    info.engine_display_name, int(round(rating)), error
+                ),
+                also_print=True,
+            )
 
-        # レーティングが変動したのなら、エンジン設定ファイルに書き戻す
-        if player1_add != 0:
-            info1.write_engine_define(home)
-        if player2_add != 0:
-            info2.write_engine_define(home)
+    # 1局終わるごとに起こしてもらって、途中経過を出力する。
+    # 組の対局が終わっていれば、その結果を加えてレーティングを推定し直す。
+    for n in range(1, args.iteration * args.loop + 1):
+        server.wait_for_games(n)
+        output_progress()
+        for match in server.pop_finished_matches():
+            output_match_result(match)
+        if args.refit_games > 0 and n % args.refit_games == 0:
+            output_provisional_rating(n)
+
+    # すべての組の対局が終わっているはずだが、念のため待っておく。
+    server.wait_for_matches(args.iteration)
+    for match in server.pop_finished_matches():
+        output_match_result(match)
+
+    # 対局棋譜は、game_stop()のときにkifu_sinkからすべて書き出される。
+    server.game_stop()
+    # 並列数をどう増減させたか(子プロセスに分割したときは、子プロセス側にしか残らない)
+    if args.adaptive and args.processes == 0:
+        log.print(server.concurrency_controller.info(), also_print=True)
 
     # iteration回数だけ繰り返したので終了する。
     output_engine_rating()
     log.print("iteration end", also_print=True, output_datetime=True)
     server.terminate()
+    if engine_pool is not None:
+        engine_pool.close()
+    kifu_sink.close()
     log.close()
 
 
@@ -0,0 +1,114 @@
+import mmap
+import random
+import re
+from array import array
+from typing import Optional
+
+# 指し手1つ分(空白 + 指し手)
+MOVE_TOKEN_RE = re.compile(rb"\s+\S+")
+
+# 行の先頭で読み飛ばす文字(空白とUTF-8のBOM)
+LEADING_CHARS = b" \t\r\xef\xbb\xbf"
+
+
+# 定跡ファイル(開始局面の集合)
+# "startpos moves ..."や"sfen ... moves ..."が1行に1局面書かれているファイルを読み込む。
+#
+# ファイルはmmapしておき、各行の開始位置と長さだけをindexとして保持する。
+# 長さは、start_gameplyの手数の局面までで切り詰めたものにしておくので、
+# get_sfen()はファイルの該当箇所をそのまま切り出すだけで済む。
+class OpeningBook:
+    # path : 定跡ファイルのpath
+    # start_gameply : 開始手数。この手数の局面までで切り詰める。0を指定すると末尾の局面から。
+    #                 (MultiAyaneruServer.start_gameplyと同じ)
+    def __init__(self, path: str, start_gameply: int = 0):
+
+        # --- public readonly members ---
+
+        # 定跡ファイルのpath
+        self.path = path
+
+        # 開始手数
+        self.start_gameply = start_gameply
+
+        # --- private members ---
+
+        # 各局面の、ファイル上の開始位置と(切り詰めたあとの)長さ
+        self.offsets = array("Q")
+        self.lengths = array("I")
+
+        # 定跡ファイルのハンドルと、それをmmapしたもの
+        self.file = None
+        self.mmap: Optional[mmap.mmap] = None
+
+        self.file = open(path, "rb")
+        # 空のファイルはmmapできない。
+        if self.file.seek(0, 2) > 0:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.build_index()
+
+    # 各行の開始位置と長さを調べる。
+    def build_index(self):
+        mm = self.mmap
+        size = len(mm)
+        # 切り詰めたときに残す指し手の数。Noneなら切り詰めない。
+        keep_moves = (
+            max(self.start_gameply - 1, 0) if self.start_gameply != 0 else None
+        )
+
+        begin = 0
+        while begin < size:
+            end = mm.find(b"\n", begin)
+            if end == -1:
+                end = size
+            line = mm[begin:end]
+
+            # 前後の空白は取り除く。(ファイル先頭のBOMも)
+            sfen = line.lstrip(LEADING_CHARS)
+            offset = begin + len(line) - len(sfen)
+            sfen = sfen.rstrip()
+            begin = end + 1
+            if len(sfen) == 0:
+                continue
+
+            length = len(sfen)
+            if keep_moves is not None:
+                index = sfen.find(b" moves")
+                if index != -1:
+                    length = index + 6
+                    for _ in range(keep_moves):
+                        match = MOVE_TOKEN_RE.match(sfen, length)
+                        if match is None:
+                            break
+                        length = match.end()
+
+            self.offsets.append(offset)
+            self.lengths.append(length)
+
+    # 定跡の局面数
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    # i番目の局面を、start_gameplyの手数までで切り詰めたsfenで返す。
+    # 例 : "startpos moves 7g7f 3c3d"
+    def get_sfen(self, i: int) -> str:
+        offset = self.offsets[i]
+        return self.mmap[offset : offset + self.lengths[i]].decode("utf-8")
+
+    # ランダムに1つ局面を選んで、get_sfen()と同じ形で返す。
+    def random_sfen(self) -> str:
+        if len(self.offsets) == 0:
+            raise ValueError("book is empty : " + self.path)
+        return self.get_sfen(random.randrange(len(self.offsets)))
+
+    # ファイルを閉じる。
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,267 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+from src.engine.cpu_affinity import get_available_cpus
+from src.engine.engine import UsiEngine
+from src.engine.engine_pool import (
+    EngineKey,
+    UsiEnginePool,
+    get_engine_memory,
+    get_hash_size,
+    get_physical_memory,
+    make_engine_key,
+)
+
+# 並列対局数(対局サーバーの数)を、CPUとメモリの両方に収まるように決めるためのモジュール。
+
+# 並列対局に使わずに余らせておくCPUの数(論理コア)
+# 2スレほど余らせておかないとtimeupになるかもしれん。
+RESERVED_CORES = 2
+
+# メモリを自動で調べたときに、OSやこのプロセスのために余らせておく割合
+MEMORY_MARGIN = 0.1
+
+
+# 並列対局数を決めるクラス。
+# 1つの対局サーバーは先後2つのエンジンを持つので、エンジンのメモリ使用量の合計が空きメモリに収まるようにする。
+# エンジンのメモリ使用量は、実際にエンジンを1つ起動して("readyok"が返ってきたあとの)物理メモリ使用量を計測する。
+# (評価関数の読み込みやHashの確保は"isready"に対して行われるので)
+#
+# 使い方)
+#   planner = ConcurrencyPlanner(cores=None, memory=None)  # 両方とも自動で調べる
+#   server_num = planner.plan([(engine1, options1), (engine2, options2)], threads=2)
+#   print(planner.plan_info)
+class ConcurrencyPlanner:
+    # cores : 使えるCPUの数(論理コア)。Noneなら、このプロセスが使えるCPUの数。
+    # memory : エンジンに使わせてよいメモリ[MB]。Noneなら、/proc/meminfoのMemAvailableから余裕を引いたもの。
+    #          0なら、メモリは考慮しない。(エンジンの計測も行わない)
+    def __init__(self, cores: Optional[int] = None, memory: Optional[int] = None):
+
+        # --- public members ---
+
+        # 使えるCPUの数(論理コア)
+        self.cores = cores if cores is not None else len(get_available_cpus())
+
+        # エンジンに使わせてよいメモリ[MB]
+        if memory is None:
+            available = get_available_memory()
+            memory = (
+                int(available * (1 - MEMORY_MARGIN)) if available is not None else 0
+            )
+        self.memory = memory
+
+        # エンジンの計測で、"readyok"を待つ最大時間[s]
+        self.probe_timeout = 60.0
+
+        # エンジンの計測に用いるUsiEnginePool。
+        # 設定されていれば、計測に用いたエンジンは終了させずにここに返却するので、そのまま対局に使い回される。
+        self.engine_pool: Optional[UsiEnginePool] = None
+
+        # --- public readonly members ---
+
+        # 計測したエンジン1つあたりのメモリ使用量[MB]。key -> メモリ使用量
+        self.memory_per_key: Dict[EngineKey, int] = {}
+
+        # 最後にplan()したときの内訳
+        self.plan_info = ""
+
+    # engine_pathのエンジンをengine_optionsで起動して、メモリ使用量[MB]を計測する。
+    # 同じ実行ファイル・同じオプションのエンジンは、一度だけ計測する。
+    # Hashの確保が遅延される(実際に使うまで物理メモリが割り当てられない)ことがあるので、Hashの値より小さくはしない。
+    def probe(self, engine_path: str, engine_options: Optional[dict] = None) -> int:
+        key = make_engine_key(engine_path, engine_options)
+        memory = self.memory_per_key.get(key)
+        if memory is not None:
+            return memory
+
+        if self.engine_pool is not None:
+            engine = self.engine_pool.lease(engine_path, engine_options)
+        else:
+            engine = UsiEngine()
+            if engine_options is not None:
+                engine.set_engine_options(engine_options)
+            engine.connect(engine_path)
+
+        if engine.wait_ready(self.probe_timeout):
+            memory = get_engine_memory(engine)
+            if self.engine_pool is not None:
+                self.engine_pool.release(engine)
+            else:
+                engine.disconnect()
+        else:
+            # 起動できなかったなら、計測はあきらめてHashの値だけで見積もる。
+            memory = 0
+            engine.kill()
+            if self.engine_pool is not None:
+                self.engine_pool.release(engine)
+
+        memory = max(memory, get_hash_size(engine_options))
+        self.memory_per_key[key] = memory
+        return memory
+
+    # 並列対局数を決める。
+    # engines : 1つの対局サーバーで用いるエンジンの(実行ファイルのpath , オプション)のlist。(先後の2つ)
+    # threads : 1つの対局サーバーで必要なスレッド数(先後のエンジンのThreadsの大きいほう)
+    # 返し値 : 並列対局数。CPUとメモリのどちらかが足りなくても、最低1。
+    def plan(self, engines: List[Tuple[str, Optional[dict]]], threads: int) -> int:
+        cores = max(self.cores - RESERVED_CORES, 1)
+        cpu_limit = cores // max(threads, 1)
+        info = "cpu {0} cores / {1} threads -> {2}".format(cores, threads, cpu_limit)
+
+        server_num = cpu_limit
+        if self.memory > 0:
+            server_memory = sum(
+                self.probe(path, options) for path, options in engines
+            )
+            memory_limit = self.memory // max(server_memory, 1)
+            info += " , memory {0}MB / {1}MB per server -> {2}".format(
+                self.memory, server_memory, memory_limit
+            )
+            server_num = min(server_num, memory_limit)
+
+        server_num = max(server_num, 1)
+        self.plan_info = "concurrency : {0} servers ({1})".format(server_num, info)
+        return server_num
+
+
+# 空きメモリ[MB]。/proc/meminfoのMemAvailableから求める。
+# 取得できない環境では物理メモリの総量で代用し、それも取得できなければNone。
+def get_available_memory() -> Optional[int]:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    # "MemAvailable:   12345678 kB"
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return get_physical_memory()
+
+
+# コマンドラインの--coresの値を解釈する。
+# "auto"ならNone(使えるCPUの数を自動で調べる)、それ以外は数値。
+def parse_cores(text: str) -> Optional[int]:
+    if text == "auto":
+        return None
+    return int(text)
+
+
+# 対局中に並列数を増減させるクラス。
+# 負荷が高すぎて(共有マシンや熱による性能低下など)エンジンが時間どおりに指せなくなったら並列数を減らし、
+# 余裕があれば増やす。MultiAyaneruServer.concurrency_controllerに設定して用いる。
+#
+# 判定は対局が終わるごとに行う。並列数を変えたあとは、変える前に開始した対局の結果は判定に用いない。
+#   ・時間切れか、1手あたりの超過時間がshrink_overshootを超えた対局があれば、1つ減らす。
+#   ・超過時間がgrow_overshoot以下の対局が(grow_games × 並列数)局続いたら、1つ増やす。
+#     減らすたびにgrow_gamesを倍にするので、増やしては減らすのを繰り返すことは少なくなる。
+# 並列数は、min_serversとmax_servers(対局サーバーの数)の間で変化させる。
+class ConcurrencyController:
+    # min_servers : 並列数の下限
+    # max_servers : 並列数の上限。Noneなら対局サーバーの数。
+    def __init__(self, min_servers: int = 1, max_servers: Optional[int] = None):
+
+        # --- public members ---
+
+        # 並列数の下限と上限
+        self.min_servers = min_servers
+        self.max_servers = max_servers
+
+        # 開始時の並列数。Noneなら上限から始める。
+        self.initial_servers: Optional[int] = None
+
+        # 1手あたりの超過時間[ms]がこれを超えたら並列数を減らす。
+        # (AyaneruServerは秒読み含めて2秒超過すると時間切れにするので、それより十分小さくしておく)
+        self.shrink_overshoot = 500
+
+        # 1手あたりの超過時間[ms]がこれ以下の対局が続いたら並列数を増やす。
+        self.grow_overshoot = 100
+
+        # 並列数を増やすのに必要な、超過のない対局の数(並列数あたり)
+        self.grow_games = 2
+
+        # --- public readonly members ---
+
+        # 現在の並列数
+        self.active = 0
+
+        # 時間切れになった対局の数
+        self.timeups = 0
+
+        # 並列数を減らした回数、増やした回数
+        self.shrinks = 0
+        self.grows = 0
+
+        # --- private members ---
+
+        # 最後に並列数を変えた時刻
+        self.last_change_time = 0.0
+
+        # 最後に並列数を変えてから続いている、超過のない対局の数
+        self.clean_games = 0
+
+        # 上限(start()のときに対局サーバーの数で決まる)
+        self.upper = 0
+
+    # 対局開始時に呼び出される。
+    # server_num : 対局サーバーの数
+    # 返し値 : 開始時の並列数
+    def start(self, server_num: int) -> int:
+        upper = server_num
+        if self.max_servers is not None:
+            upper = min(upper, self.max_servers)
+        self.upper = max(upper, 1)
+        lower = min(max(self.min_servers, 1), self.upper)
+        initial = self.initial_servers if self.initial_servers is not None else upper
+        self.active = min(max(initial, lower), self.upper)
+        self.last_change_time = time.time()
+        self.clean_games = 0
+        return self.active
+
+    # 対局が終わるごとに呼び出される。
+    # start_time : その対局を開始した時刻
+    # max_overshoot : その対局で、1手あたりの超過時間の最大値[ms]
+    # timeup : その対局が時間切れで終わったか
+    # 返し値 : 並列数を減らすなら-1、増やすなら1、そのままなら0。
+    def on_game_over(
+        self, start_time: float, max_overshoot: int, timeup: bool
+    ) -> int:
+        if timeup:
+            self.timeups += 1
+
+        # 並列数を変える前に開始した対局は、変える前の負荷で指されているので用いない。
+        if start_time < self.last_change_time:
+            return 0
+
+        if timeup or max_overshoot > self.shrink_overshoot:
+            self.clean_games = 0
+            if self.active <= max(self.min_servers, 1):
+                return 0
+            self.grow_games *= 2
+            self.shrinks += 1
+            return self.change(-1)
+
+        if max_overshoot > self.grow_overshoot:
+            self.clean_games = 0
+            return 0
+
+        self.clean_games += 1
+        if (
+            self.clean_games >= self.grow_games * self.active
+            and self.active < self.upper
+        ):
+            self.grows += 1
+            return self.change(1)
+        return 0
+
+    # 並列数をdeltaだけ変える。
+    def change(self, delta: int) -> int:
+        self.active += delta
+        self.last_change_time = time.time()
+        self.clean_games = 0
+        return delta
+
+    # 現在の状態を文字列化して返す。
+    def info(self) -> str:
+        return (
+            "concurrency : active {0} / {1} , shrink {2} , grow {3} , timeup {4}"
+        ).format(self.active, self.upper, self.shrinks, self.grows, self.timeups)
@@ -0,0 +1,185 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+# 対局サーバーごとに、エンジンを動かすCPUを割り当てるためのモジュール。
+# Linuxのos.sched_setaffinity()と/sys/devices/system/cpuのtopology情報を用いる。
+# それ以外の環境では何もしない。
+
+CPU_SYSFS_PATH = "/sys/devices/system/cpu"
+
+
+# このプロセスが使えるCPU(論理コア)の番号
+def get_available_cpus() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+# "0-3,8,10-11"のようなCPU番号のlistの表記を解釈する。
+def parse_cpu_list(text: str) -> List[int]:
+    cpus: List[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            begin, end = part.split("-", 1)
+            cpus.extend(range(int(begin), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+# CPU番号のlistを"0-3,8"のように表記する。(parse_cpu_list()の逆変換)
+def format_cpu_list(cpus: List[int]) -> str:
+    ranges: List[str] = []
+    cpus = sorted(cpus)
+    i = 0
+    while i < len(cpus):
+        j = i
+        while j + 1 < len(cpus) and cpus[j + 1] == cpus[j] + 1:
+            j += 1
+        ranges.append(str(cpus[i]) if i == j else "{0}-{1}".format(cpus[i], cpus[j]))
+        i = j + 1
+    return ",".join(ranges)
+
+
+# 物理コアごとに、そこに属する論理コア(SMTのsibling)をまとめたlistを返す。
+# 使えるCPUのみを含む。topology情報が読めない環境では、論理コア1つずつを物理コアとみなす。
+# 返し値 : [(package id , [論理コアの番号 , ...]) , ...] 。package id , 論理コアの番号順。
+def get_cpu_topology(
+    cpus: Optional[List[int]] = None, sysfs_path: str = CPU_SYSFS_PATH
+) -> List[Tuple[int, List[int]]]:
+    if cpus is None:
+        cpus = get_available_cpus()
+    available = set(cpus)
+
+    cores: Dict[Tuple[int, int], List[int]] = {}
+    for cpu in cpus:
+        topology = os.path.join(sysfs_path, "cpu{0}".format(cpu), "topology")
+        try:
+            with open(os.path.join(topology, "thread_siblings_list")) as f:
+                siblings = [c for c in parse_cpu_list(f.read()) if c in available]
+            with open(os.path.join(topology, "physical_package_id")) as f:
+                package = int(f.read())
+        except (OSError, ValueError):
+            siblings = [cpu]
+            package = 0
+        # 物理コアは、そこに属する最小の論理コアの番号で識別する。
+        cores.setdefault((package, min(siblings)), sorted(siblings))
+    return [(package, cores[(package, first)]) for package, first in sorted(cores)]
+
+
+# 対局サーバーごとに、互いに重ならないCPUの集合を割り当てる。
+# server_num : 対局サーバーの数
+# threads : 1つの対局サーバーで必要なスレッド数(先後のエンジンのThreadsの大きいほう)
+# 物理コア単位で割り当てて、SMTのsiblingは同じ対局サーバーにまとめる。
+# ただし、対局サーバーの数は論理コアの数から決めているので、物理コア単位では足りないときは
+# 論理コア単位で割り当てる。(このときも、threadsが足りるならsiblingは同じ対局サーバーにまとめる)
+# 番号の若いCPUは割り込み処理やこのプロセス自身が使うので、番号の大きいほうから割り当てる。
+# また、1つの対局サーバーが複数のpackage(CPUソケット)にまたがらないようにする。
+# 返し値 : 対局サーバーごとのCPUの集合。CPUが足りなくて割り当てられなかった対局サーバーはNone。
+def plan_cpu_sets(
+    server_num: int,
+    threads: int,
+    topology: Optional[List[Tuple[int, List[int]]]] = None,
+) -> List[Optional[List[int]]]:
+    if topology is None:
+        topology = get_cpu_topology()
+
+    plan = assign_cpu_sets(server_num, threads, topology)
+    if None in plan:
+        # 論理コア1つずつを物理コアとみなして割り当てなおす。
+        # siblingは並べておくので、番号の大きいほうから取ればsiblingがまとまる。
+        logical = [
+            (package, [cpu]) for package, siblings in topology for cpu in siblings
+        ]
+        logical_plan = assign_cpu_sets(server_num, threads, logical)
+        if logical_plan.count(None) < plan.count(None):
+            plan = logical_plan
+    return plan
+
+
+# topologyの"物理コア"単位で、対局サーバーごとに互いに重ならないCPUの集合を割り当てる。(plan_cpu_sets()の本体)
+def assign_cpu_sets(
+    server_num: int, threads: int, topology: List[Tuple[int, List[int]]]
+) -> List[Optional[List[int]]]:
+    # packageごとに、番号の大きい物理コアから使う。
+    packages: Dict[int, List[List[int]]] = {}
+    for package, siblings in topology:
+        packages.setdefault(package, []).append(siblings)
+    for cores in packages.values():
+        cores.reverse()
+
+    plan: List[Optional[List[int]]] = []
+    for _ in range(server_num):
+        cpu_set = None
+        # 残りのコアが多いpackageから割り当てる。
+        for package in sorted(packages, key=lambda p: -len(packages[p])):
+            cores = packages[package]
+            taken: List[int] = []
+            used = 0
+            while used < len(cores) and len(taken) < threads:
+                taken += cores[used]
+                used += 1
+            if len(taken) >= threads:
+                del cores[:used]
+                cpu_set = sorted(taken)
+                break
+        plan.append(cpu_set)
+    return plan
+
+
+# get_cpu_topology()の結果を"16 cpus , 8 cores(SMT 2) , 1 packages"のように文字列化する。
+def describe_topology(topology: List[Tuple[int, List[int]]]) -> str:
+    cpus = sum(len(siblings) for _, siblings in topology)
+    smt = max((len(siblings) for _, siblings in topology), default=1)
+    packages = len(set(package for package, _ in topology))
+    return "{0} cpus , {1} cores(SMT {2}) , {3} packages".format(
+        cpus, len(topology), smt, packages
+    )
+
+
+# 指定したプロセスと、そのプロセスが属するprocess groupのすべてのプロセス・スレッドを、cpusでだけ動くようにする。
+# (エンジンが子プロセスを起動していたり、shell経由で起動されていたりするので、process groupごと設定する。)
+# 返し値 : 設定できたならTrue。sched_setaffinity()が使えない環境ではFalse。
+def set_process_group_affinity(pid: int, cpus: List[int]) -> bool:
+    if not hasattr(os, "sched_setaffinity"):
+        return False
+
+    pids = [pid]
+    try:
+        pgid = os.getpgid(pid)
+        # このプロセス自身と同じprocess groupなら、そのプロセスだけにしておく。
+        if pgid != os.getpgid(0):
+            pids = get_process_group_pids(pgid)
+    except OSError:
+        pass
+
+    result = False
+    for p in pids:
+        # 起動済みのスレッドにも設定する。(このあと生成されるスレッドは設定を引き継ぐ)
+        try:
+            tids = [int(t) for t in os.listdir("/proc/{0}/task".format(p))]
+        except OSError:
+            tids = [p]
+        for tid in tids:
+            try:
+                os.sched_setaffinity(tid, cpus)
+                result = True
+            except OSError:
+                pass
+    return result
+
+
+# process groupに属するプロセスのpidを、/procから探して返す。
+def get_process_group_pids(pgid: int) -> List[int]:
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            if os.getpgid(int(name)) == pgid:
+                pids.append(int(name))
+        except OSError:
+            pass
+    return pids
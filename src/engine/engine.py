@@ -1,17 +1,197 @@
+import atexit
 import os
+import signal
 import subprocess
 import threading
+import time
 from queue import Queue
-from typing import Dict, Optional, Union, cast
+from typing import Dict, List, Optional, Set, Union, cast
+
+from src.engine.enums import Turn, UsiEngineState, UsiInfoCaptureLevel
+from src.engine.info_parser import parse_info
+from src.engine.service import UsiThinkHistory, UsiThinkResult
+from src.engine.stderr_buffer import StderrBuffer
+
+# エンジンの標準出力を一度に読み出す最大の量[bytes]
+READ_BUFFER_SIZE = 1 << 16
+
+# 新しいsession(process group)で起動したエンジンのpid(= pgid)
+# shell経由で起動したエンジンは、shellの子プロセスごとkill()で終了させられるように新しいsessionで起動するが、
+# そうするとCtrl+CのSIGINTがエンジンに届かず、このプロセスが異常終了したときにエンジンが取り残される。
+# そこで、このプロセスが終了するときに、残っているものをprocess groupごと強制終了させる。
+session_pids: Set[int] = set()
+session_pids_lock = threading.Lock()
+
+
+# session_pidsに残っているエンジンを、process groupごと強制終了させる。(atexitで呼び出される)
+def kill_sessions():
+    with session_pids_lock:
+        pids = list(session_pids)
+        session_pids.clear()
+    for pid in pids:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+atexit.register(kill_sessions)
+
+
+# UsiEngine , AsyncUsiEngineで共通の、エンジン側から送られてきたメッセージを解釈する部分。
+# 派生クラス側で、debug_print , error_print , instance_id , last_received_line , engine_state , think_result ,
+# info_capture_level , record_think_history , last_info_line , connect_time , ready_latency の各メンバと、
+# print() , change_state()を用意すること。
+class UsiEngineBase:
+    # エンジン側から送られてきたメッセージを解釈する。
+    def dispatch_message(self, message: str):
+        # デバッグ用に受け取ったメッセージを出力するのか？
+        if self.debug_print or (self.error_print and message.find("Error") > -1):
+            self.print("[{0}:>] {1}".format(self.instance_id, message))
+
+        # 最後に受信した文字列はここに積む約束になっている。
+        self.last_received_line = message
+
+        # 先頭の文字列で判別する。
+        index = message.find(" ")
+        if index == -1:
+            token = message
+        else:
+            token = message[0:index]
+
+        # --- handleするメッセージ
+
+        # 1行待ちであったなら、これでハンドルしたことにして返る。
+        if self.engine_state == UsiEngineState.WaitOneLine:
+            self.change_state(UsiEngineState.WaitCommand)
+            return
+        # "isready"に対する応答
+        elif token == "readyok":
+            self.handle_readyok()
+            self.change_state(UsiEngineState.WaitCommand)
+        # "go"に対する応答
+        elif token == "bestmove":
+            self.flush_info()
+            self.handle_bestmove(message)
+            self.change_state(UsiEngineState.WaitCommand)
+        # エンジンの読み筋に対する応答
+        elif token == "info":
+            level = self.info_capture_level
+            if level == UsiInfoCaptureLevel.Full:
+                self.handle_info(message)
+            elif level == UsiInfoCaptureLevel.FinalOnly:
+                # 解釈は"bestmove"を受信するまで遅延させる。
+                # "info string"はコメントなので、保持している読み筋を上書きしないようにする。
+                if not message.startswith("info string"):
+                    self.last_info_line = message
+        # 詰め将棋エンジンに対する応答
+        elif token=="checkmate":
+            self.flush_info()
+            self.handle_checkmate(message)
+            self.change_state(UsiEngineState.WaitCommand)
+
+    # "readyok"を受信したときに、connect()からの経過時間を記録する。
+    def handle_readyok(self):
+        if self.ready_latency is None and self.connect_time is not None:
+            self.ready_latency = time.time() - self.connect_time
+
+    # エンジン側から送られてきた1行(bytesのまま。改行は含まない)を解釈する。
+    # 探索の浅いうちは"info"行が大量に送られてくるので、info_capture_levelで解釈しないものは
+    # decodeせずに済ませる。(このときlast_received_lineは更新しない)
+    # それ以外の行はdecodeしてdispatch_message()に渡す。
+    def dispatch_line(self, line: bytes):
+        if (
+            line.startswith(b"info ")
+            and not self.debug_print
+            and not (self.error_print and b"Error" in line)
+            and self.engine_state != UsiEngineState.WaitOneLine
+        ):
+            level = self.info_capture_level
+            if level == UsiInfoCaptureLevel.NoCapture:
+                return
+            if level == UsiInfoCaptureLevel.FinalOnly:
+                # 最後の1行だけが解釈されるので、decodeは"bestmove"を受信するまで遅延させる。
+                if not line.startswith(b"info string"):
+                    self.last_info_line = line
+                return
+        self.dispatch_message(line.decode("utf-8", errors="replace").strip())
+
+    # エンジン側から送られてきた、改行で終わる複数の行(bytesのまま)を解釈する。
+    # すべて"info"行で、info_capture_levelで1行ずつ解釈する必要がなければ、行に分割せずにまとめて済ませる。
+    # (FinalOnlyなら最後の1行だけを保持すればよい)
+    def dispatch_block(self, block: bytes):
+        level = self.info_capture_level
+        if (
+            level != UsiInfoCaptureLevel.Full
+            and not self.debug_print
+            and not (self.error_print and b"Error" in block)
+            and self.engine_state != UsiEngineState.WaitOneLine
+            and block.startswith(b"info ")
+            and block.count(b"\ninfo ") + 1 == block.count(b"\n")
+        ):
+            if level == UsiInfoCaptureLevel.NoCapture:
+                return
+            last = block[block.rfind(b"\n", 0, -1) + 1 : -1]
+            if not last.startswith(b"info string"):
+                self.last_info_line = last
+                return
+
+        lines = block.split(b"\n")
+        lines.pop()
+        for line in lines:
+            self.dispatch_line(line)
+
+    # info_capture_level == FinalOnlyのときに保持しておいた最後の"info"行を解釈する。
+    # dispatch_line()で保持したものはbytesのままなので、ここでdecodeする。
+    def flush_info(self):
+        line = self.last_info_line
+        if line is not None:
+            self.last_info_line = None
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", errors="replace").strip()
+            self.handle_info(line)
+
+    # エンジンから送られてきた"bestmove"を処理する。
+    def handle_bestmove(self, message: str):
+        messages = message.split()
+        if len(messages) >= 4 and messages[2] == "ponder":
+            self.think_result.ponder = messages[3]
+
+        if len(messages) >= 2:
+            self.think_result.bestmove = messages[1]
+        else:
+            # 思考内容返ってきてない。どうなってんの…。
+            self.think_result.bestmove = "none"
+
+    # エンジンから送られてきた"info ..."を処理する。
+    def handle_info(self, message: str):
+
+        # まだ"go"を発行していないのか？
+        if self.think_result is None:
+            return
+
+        # 解析していく
+        # "info string.."はコメントなのでNoneが返ってくる。
+        parsed = parse_info(message)
+        if parsed is None:
+            return
+        multipv, pv = parsed
+
+        if multipv >= 1:
+            # 配列の要素数が足りないなら、追加しておく。
+            while len(self.think_result.pvs) < multipv:
+                self.think_result.pvs.append(None)
+            self.think_result.pvs[multipv - 1] = pv
 
-from src.engine.enums import Turn, UsiEngineState, UsiEvalSpecialValue, UsiBound
-from src.engine.eval import UsiEvalValue, UsiEvalSpecialValue
-from src.engine.scanner import Scanner
-from src.engine.service import UsiThinkResult, UsiThinkPV
+        if self.think_result.history is not None:
+            self.think_result.history.append(multipv, pv)
+
+    def handle_checkmate(self, message: str):
+        self.think_result.checkmate = message.replace("checkmate ", "")
 
 
 # USIプロトコルを用いて思考エンジンとやりとりするためのwrapperクラス
-class UsiEngine:
+class UsiEngine(UsiEngineBase):
     def __init__(self):
 
         # --- public members ---
@@ -25,6 +205,26 @@ class UsiEngine:
 
         self.think_result = None  # UsiThinkResult
 
+        # エンジンから送られてきた"info"をどこまで解釈するか。
+        # 読み筋が不要ならNoCaptureやFinalOnlyにしておくと、解釈にかかるCPU時間を節約できる。
+        self.info_capture_level = UsiInfoCaptureLevel.Full
+
+        # Trueにすると、解釈したすべての読み筋をthink_result.historyに記録する。
+        # (MultiPVの数が多いときなどに用いる。info_capture_level == Fullにしておくこと。)
+        self.record_think_history = False
+
+        # Trueにすると、エンジンをshell経由で起動する。(以前の挙動。バッチファイルなどをエンジンとして用いるとき用)
+        # Falseなら実行ファイルを直接起動するので、余計なshellのプロセスがなく、proc.pidがエンジンのPIDになり、
+        # 起動に失敗したらconnect()が例外をraiseする。connect()の前に設定すること。
+        self.spawn_with_shell = False
+
+        # エンジンの標準エラー出力を、最後の何行まで保持しておくか。connect()の前に設定すること。
+        # (標準エラー出力は常に読み出しておき、エンジンがpipeへの書き込みでblockしないようにしてある)
+        self.stderr_lines = 200
+
+        # エンジンの標準エラー出力をすべて追記するファイルのpath。Noneなら書き出さない。connect()の前に設定すること。
+        self.stderr_log_path: Optional[str] = None
+
         # --- readonly members ---
         # (外部からこれらの変数は書き換えないでください)
 
@@ -41,14 +241,28 @@ class UsiEngine:
         # エラーがなく終了したのであれば0が入る。(readonly)
         self.exit_state: Optional[Union[int, str]] = None
 
+        # connect()を呼び出した時刻
+        self.connect_time: Optional[float] = None
+
+        # connect()から"readyok"が返ってくるまでにかかった時間[s]。返ってくるまではNone。
+        self.ready_latency: Optional[float] = None
+
+        # エンジンの標準エラー出力の最後のstderr_lines行。connect()したときに作り直される。
+        # エンジンが異常終了したり応答しなくなったりしたあとも、disconnect()してから参照できる。
+        self.stderr_buffer: Optional[StderrBuffer] = None
+
         # --- private members ---
 
         # エンジンのプロセスハンドル
         self.proc: Optional[subprocess.Popen] = None
 
+        # エンジンを新しいsession(process group)で起動したか。(shell経由で起動したときのみ)
+        self.new_session = False
+
         # エンジンとやりとりするスレッド
         self.read_thread: threading.Thread = None
         self.write_thread: threading.Thread = None
+        self.stderr_thread: threading.Thread = None
 
         # エンジンに設定するオプション項目。
         # 例 : {"Hash":"128","Threads":"8"}
@@ -57,6 +271,10 @@ class UsiEngine:
         # 最後にエンジン側から受信した1行
         self.last_received_line: Optional[str] = None
 
+        # info_capture_level == FinalOnlyのときに、最後に受信した"info"行
+        # (read_worker()からはbytesのまま保持される)
+        self.last_info_line: Optional[Union[str, bytes]] = None
+
         # エンジンにコマンドを送信するためのqueue(送信スレッドとのやりとりに用いる)
         self.send_queue = Queue()
 
@@ -89,7 +307,7 @@ class UsiEngine:
 
     # エンジンに接続する
     # enginePath : エンジンPathを指定する。
-    # エンジンが存在しないときは例外がでる。
+    # エンジンが存在しないときや、起動(exec)に失敗したときは例外がでる。(OSError)
     def connect(self, engine_path: str):
         self.disconnect()
 
@@ -98,6 +316,8 @@ class UsiEngine:
         self.engine_state = None
         self.exit_state = None
         self.engine_path = engine_path
+        self.connect_time = time.time()
+        self.ready_latency = None
 
         # write workerに対するコマンドqueue
         self.send_queue = Queue()
@@ -109,22 +329,48 @@ class UsiEngine:
         self.engine_fullpath = os.path.join(os.getcwd(), self.engine_path)
         self.change_state(UsiEngineState.WaitConnecting)
 
-        # subprocess.Popen()では接続失敗を確認する手段がないくさいので、
+        # shell経由だと、起動に失敗してもshellが起動した時点で成功したことになってしまうので、
         # 事前に実行ファイルが存在するかを調べる。
+        # (直接起動するときも、フォルダがなければPopen()の例外はcwdを指すので、ここで実行ファイルのpathを示しておく)
         if not os.path.exists(self.engine_fullpath):
             self.change_state(UsiEngineState.Disconnected)
             self.exit_state = "Connection Error"
             raise FileNotFoundError(self.engine_fullpath + " not found.")
 
-        self.proc = subprocess.Popen(
-            self.engine_fullpath,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            encoding="utf-8",
-            cwd=os.path.dirname(self.engine_fullpath),
-        )
+        # 直接起動するときは、argvのlistで渡す。
+        # (Linuxでは、preexec_fnを指定しなければvfork()で起動されるので、エンジンのメモリ使用量によらず速い。
+        #  posix_spawn()はcwdを指定できないので用いない。)
+        # execに失敗したときは、子プロセスから通知されてPopen()がOSErrorをraiseする。
+        args = self.engine_fullpath if self.spawn_with_shell else [self.engine_fullpath]
+
+        # shell経由で起動するときは、エンジンはshellの子プロセスになるので、kill()でshellごと終了させられるように
+        # 新しいsession(process group)にしておく。(POSIXのみ)
+        # このときCtrl+CのSIGINTはエンジンに届かないので、このプロセスの終了時にkill_sessions()で終了させる。
+        # 直接起動するときは、proc.kill()で済むので、これまでどおりこのプロセスと同じprocess groupで起動する。
+        # (Ctrl+Cでエンジンも終了する)
+        self.new_session = self.spawn_with_shell and os.name == "posix"
+        try:
+            self.proc = subprocess.Popen(
+                args,
+                shell=self.spawn_with_shell,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                stdin=subprocess.PIPE,
+                encoding="utf-8",
+                cwd=os.path.dirname(self.engine_fullpath),
+                close_fds=True,
+                start_new_session=self.new_session,
+            )
+        except OSError as e:
+            self.change_state(UsiEngineState.Disconnected)
+            self.exit_state = "Connection Error"
+            # どのエンジンの起動に失敗したのかがわかるようにしておく。
+            e.filename = self.engine_fullpath
+            raise
+
+        if self.new_session:
+            with session_pids_lock:
+                session_pids.add(self.proc.pid)
 
         # self.send_command("usi")
         # "usi"コマンドを先行して送っておく。
@@ -139,6 +385,13 @@ class UsiEngine:
         self.write_thread = threading.Thread(target=self.write_worker)
         self.write_thread.start()
 
+        # 標準エラー出力を読み出し続けるスレッド
+        self.stderr_buffer = StderrBuffer(self.stderr_lines, self.stderr_log_path)
+        self.stderr_thread = threading.Thread(
+            target=self.stderr_buffer.drain, args=(self.proc.stderr.buffer,)
+        )
+        self.stderr_thread.start()
+
     # エンジンのconnect()が呼び出されたあとであるか
     def is_connected(self) -> bool:
         return self.proc is not None
@@ -163,17 +416,66 @@ class UsiEngine:
             self.write_thread.join()
             self.write_thread = None
 
+        if self.stderr_thread is not None:
+            self.stderr_thread.join()
+            self.stderr_thread = None
+        if self.stderr_buffer is not None:
+            self.stderr_buffer.close()
+
         # GCが呼び出されたときに回収されるはずだが、UnitTestでresource leakの警告が出るのが許せないので
         # この時点でclose()を呼び出しておく。
         if self.proc is not None:
-            self.proc.stdin.close()
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                # 強制終了させたエンジンに送れなかったコマンドが残っていた。
+                pass
             self.proc.stdout.close()
             self.proc.stderr.close()
             self.proc.terminate()
+            with session_pids_lock:
+                session_pids.discard(self.proc.pid)
 
         self.proc = None
         self.change_state(UsiEngineState.Disconnected)
 
+    # 応答しなくなったエンジンのプロセスを強制終了させてから、disconnect()する。
+    # disconnect()は"quit"を送信してエンジンが終了するのを待つので、応答しないエンジンに対しては用いることができない。
+    def kill(self):
+        if self.proc is not None:
+            try:
+                if self.new_session:
+                    os.killpg(self.proc.pid, signal.SIGKILL)
+                else:
+                    self.proc.kill()
+            except ProcessLookupError:
+                pass
+            # 起動しなおす前に、強制終了させたプロセスを回収しておく。
+            # (読み書きスレッドはdisconnect()のなかでjoinする)
+            self.proc.wait()
+        self.disconnect()
+
+    # エンジンの標準エラー出力のうち、保持している最後の行を古い順に返す。
+    def get_stderr(self) -> List[str]:
+        if self.stderr_buffer is None:
+            return []
+        return self.stderr_buffer.get_lines()
+
+    # [SYNC] "readyok"が返ってくるのを待つ。
+    # timeout : 最大の待ち時間[s]。Noneなら無制限に待つ。
+    # 返し値 : "readyok"が返ってきたならTrue。timeoutしたか、エンジンが終了してしまったならFalse。
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        with self.state_changed_cv:
+            self.state_changed_cv.wait_for(
+                lambda: self.ready_latency is not None
+                or self.engine_state == UsiEngineState.Disconnected,
+                timeout,
+            )
+            return (
+                self.ready_latency is not None
+                and self.engine_state != UsiEngineState.Disconnected
+            )
+
     # 指定したUsiEngineStateになるのを待つ
     # disconnectedになってしまったら例外をraise
     def wait_for_state(self, state: UsiEngineState):
@@ -219,21 +521,31 @@ class UsiEngine:
     # self.think_result.bestmove != Noneになったらそれがエンジン側から返ってきた最善手なので、それを以て、go_commandが完了したとみなせる。
     def usi_go(self, options: str):
         self.think_result = UsiThinkResult()
+        if self.record_think_history:
+            self.think_result.history = UsiThinkHistory()
+        self.last_info_line = None
         self.send_command("go " + options)
 
     # [SYNC]
     # go_command()を呼び出して、そのあとbestmoveが返ってくるまで待つ。
     # 思考結果はself.think_resultから取り出せる。
-    def usi_go_and_wait_bestmove(self, options: str):
+    # timeout : 最大の待ち時間[s]。Noneなら無制限に待つ。
+    # 返し値 : bestmoveが返ってきたならTrue。timeoutしたか、エンジンが終了してしまったならFalse。
+    def usi_go_and_wait_bestmove(
+        self, options: str, timeout: Optional[float] = None
+    ) -> bool:
         self.usi_go(options)
-        self.wait_bestmove()
+        return self.wait_bestmove(timeout)
 
     # [SYNC]
     # go_command()を呼び出して、そのあとcheckmateが返ってくるまで待つ。
     # 思考結果はself.think_resultから取り出せる。
-    def usi_go_and_wait_checkmate(self, options: str):
+    # timeout , 返し値 : usi_go_and_wait_bestmove()と同じ。
+    def usi_go_and_wait_checkmate(
+        self, options: str, timeout: Optional[float] = None
+    ) -> bool:
         self.usi_go(options)
-        self.wait_checkmate()
+        return self.wait_checkmate(timeout)
 
     # [ASYNC]
     # エンジンに対してstopを送信する。
@@ -245,48 +557,84 @@ class UsiEngine:
     # [SYNC]
     # bestmoveが返ってくるのを待つ
     # self.think_result.bestmoveからbestmoveを取り出すことができる。
-    def wait_bestmove(self):
+    # エンジンが終了してしまったときも待つのをやめる。(応答しなくなったエンジンで止まってしまわないように)
+    # timeout : 最大の待ち時間[s]。Noneなら無制限に待つ。
+    # 返し値 : bestmoveが返ってきたならTrue。timeoutしたか、エンジンが終了してしまったならFalse。
+    def wait_bestmove(self, timeout: Optional[float] = None) -> bool:
         with self.state_changed_cv:
-            self.state_changed_cv.wait_for(
+            return self.state_changed_cv.wait_for(
                 lambda: self.think_result.bestmove is not None
-            )
+                or self.engine_state == UsiEngineState.Disconnected,
+                timeout,
+            ) and (self.think_result.bestmove is not None)
 
     # [SYNC]
     # checkmateが返ってくるのを待つ
     # self.think_result.checkmateから詰み筋を取り出すことができる。
-    def wait_checkmate(self):
+    # timeout , 返し値 : wait_bestmove()と同じ。
+    def wait_checkmate(self, timeout: Optional[float] = None) -> bool:
         with self.state_changed_cv:
-            self.state_changed_cv.wait_for(
+            return self.state_changed_cv.wait_for(
                 lambda: self.think_result.checkmate is not None
-            )
+                or self.engine_state == UsiEngineState.Disconnected,
+                timeout,
+            ) and (self.think_result.checkmate is not None)
 
     # --- エンジンに対するコマンド、ここまで ---
 
     # [SYNC] エンジンに対して1行送って、すぐに1行返ってくるので、それを待って、この関数の返し値として返す。
-    def send_command_and_getline(self, command: str) -> str:
+    # timeout : 1行返ってくるまでの最大の待ち時間[s]。Noneなら無制限に待つ。
+    # timeoutしたか、エンジンが終了してしまったなら例外をraise
+    def send_command_and_getline(
+        self, command: str, timeout: Optional[float] = None
+    ) -> str:
         self.wait_for_state(UsiEngineState.WaitCommand)
         self.last_received_line = None
         with self.state_changed_cv:
             self.send_command(command)
 
             # エンジン側から一行受信するまでblockingして待機
-            self.state_changed_cv.wait_for(lambda: self.last_received_line is not None)
+            self.state_changed_cv.wait_for(
+                lambda: self.last_received_line is not None
+                or self.engine_state == UsiEngineState.Disconnected,
+                timeout,
+            )
+            if self.last_received_line is None:
+                raise ValueError("no response from engine : " + command)
             return cast(str, self.last_received_line)
 
     # エンジンとのやりとりを行うスレッド(read方向)
+    # 1行ずつreadline()してdecodeするのではなく、bytesのまままとめて読み出して、改行で終わる部分をまとめて解釈する。
+    # (エンジンが"info"行を大量に送ってきたときに、1行ごとの処理が対局スレッドとGILを奪い合わないように)
+    # プロセスが生きているかは、EOFに達したときにだけ調べればよい。
     def read_worker(self):
+        fd = self.proc.stdout.fileno()
+        rest = b""
         while True:
-            line = self.proc.stdout.readline()
-            # プロセスが終了した場合、line = Noneのままreadline()を抜ける。
-            if line:
-                self.dispatch_message(line.strip())
-
-            # プロセスが生きているかのチェック
-            retcode = self.proc.poll()
-            if not line and retcode is not None:
-                self.exit_state = 0
-                # エラー以外の何らかの理由による終了
+            try:
+                chunk = os.read(fd, READ_BUFFER_SIZE)
+            except OSError:
+                chunk = b""
+            if not chunk:
                 break
+            end = chunk.rfind(b"\n") + 1
+            if end == 0:
+                rest += chunk
+                continue
+            self.dispatch_block(rest + chunk[:end])
+            rest = chunk[end:]
+
+        # 改行で終わっていない最後の行
+        if rest:
+            self.dispatch_line(rest)
+
+        # プロセスが終了したか、標準出力を閉じた。
+        # エラー以外の何らかの理由による終了
+        self.proc.poll()
+        self.exit_state = 0
+
+        # エンジンが終了したので、待機しているものがいれば起こす。
+        self.change_state(UsiEngineState.Disconnected)
 
     # エンジンとやりとりを行うスレッド(write方向)
     def write_worker(self):
@@ -303,11 +651,8 @@ class UsiEngine:
                 message = self.send_queue.get()
 
                 # 先頭の文字列で判別する。
-                messages = message.split()
-                if len(messages):
-                    token = messages[0]
-                else:
-                    token = ""
+                # "position"コマンドは長いので、全体をsplit()はしない。
+                token = message.split(" ", 1)[0]
 
                 # stopコマンドではあるが、goコマンドを送信していないなら送信しない。
                 if token == "stop":
@@ -368,142 +713,6 @@ class UsiEngine:
             self.engine_state = state
             self.state_changed_cv.notify_all()
 
-    # エンジン側から送られてきたメッセージを解釈する。
-    def dispatch_message(self, message: str):
-        # デバッグ用に受け取ったメッセージを出力するのか？
-        if self.debug_print or (self.error_print and message.find("Error") > -1):
-            self.print("[{0}:>] {1}".format(self.instance_id, message))
-
-        # 最後に受信した文字列はここに積む約束になっている。
-        self.last_received_line = message
-
-        # 先頭の文字列で判別する。
-        index = message.find(" ")
-        if index == -1:
-            token = message
-        else:
-            token = message[0:index]
-
-        # --- handleするメッセージ
-
-        # 1行待ちであったなら、これでハンドルしたことにして返る。
-        if self.engine_state == UsiEngineState.WaitOneLine:
-            self.change_state(UsiEngineState.WaitCommand)
-            return
-        # "isready"に対する応答
-        elif token == "readyok":
-            self.change_state(UsiEngineState.WaitCommand)
-        # "go"に対する応答
-        elif token == "bestmove":
-            self.handle_bestmove(message)
-            self.change_state(UsiEngineState.WaitCommand)
-        # エンジンの読み筋に対する応答
-        elif token == "info":
-            self.handle_info(message)
-        # 詰め将棋エンジンに対する応答
-        elif token=="checkmate":
-            self.handle_checkmate(message)
-            self.change_state(UsiEngineState.WaitCommand)
-
-    # エンジンから送られてきた"bestmove"を処理する。
-    def handle_bestmove(self, message: str):
-        messages = message.split()
-        if len(messages) >= 4 and messages[2] == "ponder":
-            self.think_result.ponder = messages[3]
-
-        if len(messages) >= 2:
-            self.think_result.bestmove = messages[1]
-        else:
-            # 思考内容返ってきてない。どうなってんの…。
-            self.think_result.bestmove = "none"
-
-    # エンジンから送られてきた"info ..."を処理する。
-    def handle_info(self, message: str):
-
-        # まだ"go"を発行していないのか？
-        if self.think_result is None:
-            return
-
-        # 解析していく
-        scanner = Scanner(message.split(), 1)
-        pv = UsiThinkPV()
-
-        # multipvの何番目の読み筋であるか
-        multipv = 1
-        while not scanner.is_eof():
-            try:
-                token = scanner.get_token()
-                if token == "string":
-                    return
-                elif token == "depth":
-                    pv.depth = scanner.get_token()
-                elif token == "seldepth":
-                    pv.seldepth = scanner.get_token()
-                elif token == "nodes":
-                    pv.nodes = scanner.get_token()
-                elif token == "nps":
-                    pv.nps = scanner.get_token()
-                elif token == "hashfull":
-                    pv.hashfull = scanner.get_token()
-                elif token == "time":
-                    pv.time = scanner.get_token()
-                elif token == "pv":
-                    pv.pv = scanner.rest_string()
-                elif token == "multipv":
-                    multipv = scanner.get_integer()
-                # 評価値絡み
-                elif token == "score":
-                    token = scanner.get_token()
-                    if token == "mate":
-                        # https://github.com/yaneurao/Ayane/issues/6
-                        # 技巧の場合、
-                        # "info depth 1 nodes 0 time 0 score mate + string Nyugyoku"
-                        # のような文字列が来ることがあるらしい。
-                        is_minus = scanner.peek_token()[0] == "-"
-                        ply = scanner.get_integer()
-                        # 解析失敗したときはNoneが返ってくるので、このとき手数は+2000/-2000という扱いにしておく。
-                        # これはUsiEvalSpecialValueでmate scoreとして判定されるギリギリのスコア。
-                        if ply is None:
-                            ply = UsiEvalSpecialValue.ValueMaxMatePly
-                        if not is_minus:
-                            pv.eval = UsiEvalValue.mate_in_ply(ply)
-                        else:
-                            pv.eval = UsiEvalValue.mated_in_ply(-int(ply))
-                            # ２つ上のifでNoneならint型になるはずなのだが、pylint、ここでplyがNoneの可能性があると勘違いしていて
-                            # NoneTypeに単項マイナスをつけているという警告が出る。仕方ないのでint()と明示する。
-                    elif token == "cp":
-                        pv.eval = UsiEvalValue(scanner.get_integer())
-
-                    # この直後に"upperbound"/"lowerbound"が付与されている可能性がある。
-                    token = scanner.peek_token()
-                    if token == "upperbound":
-                        pv.bound = UsiBound.BoundUpper
-                        scanner.get_token()
-                    elif token == "lowerbound":
-                        pv.bound = UsiBound.BoundLower
-                        scanner.get_token()
-                    else:
-                        pv.bound = UsiBound.BoundExact
-
-                # "info string.."はコメントなのでこの行は丸ごと無視する。
-                else:
-                    raise ValueError("ParseError")
-            except:
-                self.print(
-                    "{0} : ParseError : token = {1}  , line = {2}".format(
-                        self.instance_id, token, scanner.get_original_text()
-                    )
-                )
-
-        if multipv >= 1:
-            # 配列の要素数が足りないなら、追加しておく。
-            while len(self.think_result.pvs) < multipv:
-                self.think_result.pvs.append(None)
-            self.think_result.pvs[multipv - 1] = pv
-
-    def handle_checkmate(self, message: str):
-        self.think_result.checkmate = message.replace("checkmate ", "")
-
     # デストラクタで通信の切断を行う。
     def __del__(self):
         self.disconnect()
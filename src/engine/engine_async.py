@@ -0,0 +1,397 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Union, cast
+
+from src.engine.engine import READ_BUFFER_SIZE, UsiEngineBase
+from src.engine.enums import Turn, UsiEngineState, UsiInfoCaptureLevel
+from src.engine.service import UsiThinkHistory, UsiThinkResult
+from src.engine.stderr_buffer import StderrBuffer
+
+# disconnect()で"quit"を送ってから、エンジンが終了するのを待つ時間の上限[s]。過ぎたら強制終了させる。
+QUIT_TIMEOUT = 10.0
+
+
+# UsiEngineのasyncio版。
+# UsiEngineはエンジン1つにつき読み書き2つのスレッドを生成するが、こちらはスレッドを生成せず、
+# 1つのevent loopの上で多数のエンジンとやりとりできる。
+# メソッドの意味はUsiEngineと同じ。[SYNC]となっているものはawaitして使う。
+class AsyncUsiEngine(UsiEngineBase):
+    def __init__(self):
+
+        # --- public members ---
+
+        # 通信内容をprintで表示する(デバッグ用)
+        self.debug_print = False
+
+        # エンジン側から"Error"が含まれている文字列が返ってきたら、それをprintで表示する。
+        self.error_print = True
+
+        self.think_result = None  # UsiThinkResult
+
+        # エンジンから送られてきた"info"をどこまで解釈するか。(UsiEngineと同じ)
+        self.info_capture_level = UsiInfoCaptureLevel.Full
+
+        # Trueにすると、解釈したすべての読み筋をthink_result.historyに記録する。
+        # (MultiPVの数が多いときなどに用いる。info_capture_level == Fullにしておくこと。)
+        self.record_think_history = False
+
+        # エンジンの標準エラー出力を、最後の何行まで保持しておくか。connect()の前に設定すること。(UsiEngineと同じ)
+        self.stderr_lines = 200
+
+        # エンジンの標準エラー出力をすべて追記するファイルのpath。Noneなら書き出さない。connect()の前に設定すること。
+        self.stderr_log_path: Optional[str] = None
+
+        # --- readonly members ---
+        # (外部からこれらの変数は書き換えないでください)
+
+        # エンジンの格納フォルダ
+        # Connect()を呼び出したときに代入される。(readonly)
+        self.engine_path = None
+        self.engine_fullpath = None
+
+        # エンジンとのやりとりの状態を表現する。(readonly)
+        self.engine_state: Optional[UsiEngineState] = None
+
+        # connect()のあと、エンジンが終了したときの状態
+        # エラーがあったとき、ここにエラーメッセージ文字列が入る
+        # エラーがなく終了したのであれば0が入る。(readonly)
+        self.exit_state: Optional[Union[int, str]] = None
+
+        # connect()を呼び出した時刻
+        self.connect_time: Optional[float] = None
+
+        # connect()から"readyok"が返ってくるまでにかかった時間[s]。返ってくるまではNone。
+        self.ready_latency: Optional[float] = None
+
+        # エンジンの標準エラー出力の最後のstderr_lines行。connect()したときに作り直される。
+        # エンジンが異常終了したあとも、disconnect()してから参照できる。
+        self.stderr_buffer: Optional[StderrBuffer] = None
+
+        # --- private members ---
+
+        # エンジンのプロセスハンドル
+        self.proc: Optional[asyncio.subprocess.Process] = None
+
+        # エンジンからの受信を行うtask
+        self.read_task: Optional[asyncio.Future] = None
+
+        # エンジンの標準エラー出力を読み出し続けるtask
+        self.stderr_task: Optional[asyncio.Future] = None
+
+        # エンジンに設定するオプション項目。
+        # 例 : {"Hash":"128","Threads":"8"}
+        self.options: Dict[str, str] = None
+
+        # 最後にエンジン側から受信した1行
+        self.last_received_line: Optional[str] = None
+
+        # info_capture_level == FinalOnlyのときに、最後に受信した"info"行
+        self.last_info_line: Optional[str] = None
+
+        # engine_stateなどが変化したときのイベント用
+        # 変化するごとにset()する。待つ側は、条件を調べてからclear()して待つ。(1行ごとに生成しなくて済むように使い回す)
+        # event loopの中で生成しないといけないので、connect()のときに生成する。
+        self.state_changed_event: Optional[asyncio.Event] = None
+
+        # このクラスのインスタンスの識別用ID。
+        with AsyncUsiEngine.static_lock_object:
+            self.instance_id = AsyncUsiEngine.static_count
+            AsyncUsiEngine.static_count += 1
+
+    # --- private static members ---
+
+    # 静的メンバ変数とする。AsyncUsiEngineのインスタンスの数を記録する
+    static_count = 0
+
+    # ↑の変数を変更するときのlock object
+    static_lock_object = threading.Lock()
+
+    # engineに渡すOptionを設定する。connectの前に呼び出すこと。
+    # 例) usi.set_engine_options({"Hash":"128","Threads":"8"})
+    def set_engine_options(self, options: Dict[str, str]):
+        self.options = options
+
+    # [SYNC] エンジンに接続する
+    # enginePath : エンジンPathを指定する。
+    # エンジンが存在しないときは例外がでる。
+    # "readyok"が返ってくるのは待たない。(UsiEngine.connect()と同じ)
+    async def connect(self, engine_path: str):
+        await self.disconnect()
+
+        self.state_changed_event = asyncio.Event()
+        self.engine_state = None
+        self.exit_state = None
+        self.engine_path = engine_path
+        self.last_received_line = None
+        self.connect_time = time.time()
+        self.ready_latency = None
+
+        # 実行ファイルの存在するフォルダ
+        self.engine_fullpath = os.path.join(os.getcwd(), self.engine_path)
+        self.change_state(UsiEngineState.WaitConnecting)
+
+        if not os.path.exists(self.engine_fullpath):
+            self.change_state(UsiEngineState.Disconnected)
+            self.exit_state = "Connection Error"
+            raise FileNotFoundError(self.engine_fullpath + " not found.")
+
+        self.proc = await asyncio.create_subprocess_exec(
+            self.engine_fullpath,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.PIPE,
+            cwd=os.path.dirname(self.engine_fullpath),
+        )
+
+        self.change_state(UsiEngineState.Connected)
+
+        # 受信用のtask
+        self.read_task = asyncio.ensure_future(self.read_worker())
+
+        # 標準エラー出力を読み出し続けるtask
+        # (読まずにいると、pipeのbufferが一杯になったところでエンジンが書き込みでblockしてしまう)
+        self.stderr_buffer = StderrBuffer(self.stderr_lines, self.stderr_log_path)
+        self.stderr_task = asyncio.ensure_future(
+            self.stderr_buffer.drain_async(self.proc.stderr)
+        )
+
+        if self.options is not None:
+            for k, v in self.options.items():
+                await self.send_command(f"setoption name {k} value {v}")
+
+        await self.send_command("isready")  # 先行して"isready"を送信
+        self.change_state(UsiEngineState.WaitReadyOk)
+
+    # エンジンのconnect()が呼び出されたあとであるか
+    def is_connected(self) -> bool:
+        return self.proc is not None
+
+    # [SYNC] エンジン用のプロセスにコマンドを送信する(プロセスの標準入力にメッセージを送る)
+    # UsiEngine.write_worker()と同じく、送信できる状態になるまで待ってから送信する。
+    async def send_command(self, message: str):
+        # 先頭の文字列で判別する。
+        # "position"コマンドは長いので、全体をsplit()はしない。
+        token = message.split(" ", 1)[0]
+
+        # stopコマンドではあるが、goコマンドを送信していないなら送信しない。
+        if token == "stop":
+            if self.engine_state != UsiEngineState.WaitBestmove:
+                return
+        elif token == "go":
+            await self.wait_for_state(UsiEngineState.WaitCommand)
+            self.change_state(UsiEngineState.WaitBestmove)
+        elif token in ("position", "usinewgame", "gameover"):
+            await self.wait_for_state(UsiEngineState.WaitCommand)
+        elif token == "moves" or token == "side":
+            await self.wait_for_state(UsiEngineState.WaitCommand)
+            self.change_state(UsiEngineState.WaitOneLine)
+
+        proc = cast(asyncio.subprocess.Process, self.proc)
+        proc.stdin.write((message + "\n").encode("utf-8"))
+        await proc.stdin.drain()
+        if self.debug_print:
+            self.print("[{0}:<] {1}".format(self.instance_id, message))
+
+        if token == "quit":
+            self.change_state(UsiEngineState.Disconnected)
+
+    # [SYNC] エンジン用のプロセスを終了する
+    async def disconnect(self):
+        if self.proc is not None:
+            if self.engine_state != UsiEngineState.Disconnected:
+                try:
+                    await self.send_command("quit")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+            # "quit"に応答しないエンジンは強制終了させる。
+            try:
+                await asyncio.wait_for(self.proc.wait(), QUIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.kill_process()
+                await self.proc.wait()
+
+        if self.read_task is not None:
+            await self.read_task
+            self.read_task = None
+
+        if self.stderr_task is not None:
+            await self.stderr_task
+            self.stderr_task = None
+        if self.stderr_buffer is not None:
+            self.stderr_buffer.close()
+
+        self.proc = None
+        self.change_state(UsiEngineState.Disconnected)
+
+    # [SYNC] 応答しなくなったエンジンのプロセスを強制終了させてから、disconnect()する。(UsiEngine.kill()と同じ)
+    async def kill(self):
+        if self.proc is not None:
+            self.kill_process()
+        await self.disconnect()
+
+    # エンジンのプロセスを強制終了させる。すでに終了していたら何もしない。
+    def kill_process(self):
+        proc = cast(asyncio.subprocess.Process, self.proc)
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+    # エンジンの標準エラー出力のうち、保持している最後の行を古い順に返す。
+    def get_stderr(self) -> List[str]:
+        if self.stderr_buffer is None:
+            return []
+        return self.stderr_buffer.get_lines()
+
+    # [SYNC] predicateがTrueを返すようになるまで待つ。
+    async def wait_for(self, predicate: Callable[[], bool]):
+        while not predicate():
+            await self.wait_changed()
+
+    # [SYNC] 指定したUsiEngineStateになるのを待つ
+    # disconnectedになってしまったら例外をraise
+    async def wait_for_state(self, state: UsiEngineState):
+        while self.engine_state != state:
+            if self.engine_state == UsiEngineState.Disconnected:
+                raise ValueError("engine_state == UsiEngineState.Disconnected.")
+            await self.wait_changed()
+
+    # [SYNC] 次にnotify()されるまで待つ。
+    # 条件を調べてからここまでの間にawaitを挟まないので、clear()してから待っても通知を取りこぼさない。
+    async def wait_changed(self):
+        event = cast(asyncio.Event, self.state_changed_event)
+        event.clear()
+        await event.wait()
+
+    # [SYNC] usi_position()で設定した局面に対する合法手の指し手の集合を得る。
+    # "moves"は、やねうら王でしか使えないUSI拡張コマンド
+    async def get_moves(self) -> str:
+        return await self.send_command_and_getline("moves")
+
+    # [SYNC] usi_position()で設定した局面に対する手番を得る。
+    # "side"は、やねうら王でしか使えないUSI拡張コマンド
+    async def get_side_to_move(self) -> Turn:
+        line = await self.send_command_and_getline("side")
+        return Turn.BLACK if line == "black" else Turn.WHITE
+
+    # --- エンジンに対して送信するコマンド ---
+
+    # 局面をエンジンに送信する。sfen形式。
+    async def usi_position(self, sfen: str):
+        await self.send_command("position " + sfen)
+
+    # エンジンに思考させる。
+    # self.think_result.bestmove != Noneになったらそれがエンジン側から返ってきた最善手。
+    async def usi_go(self, options: str):
+        self.think_result = UsiThinkResult()
+        if self.record_think_history:
+            self.think_result.history = UsiThinkHistory()
+        self.last_info_line = None
+        await self.send_command("go " + options)
+
+    # [SYNC] usi_go()を呼び出して、そのあとbestmoveが返ってくるまで待つ。
+    async def usi_go_and_wait_bestmove(self, options: str):
+        await self.usi_go(options)
+        await self.wait_bestmove()
+
+    # [SYNC] usi_go()を呼び出して、そのあとcheckmateが返ってくるまで待つ。
+    async def usi_go_and_wait_checkmate(self, options: str):
+        await self.usi_go(options)
+        await self.wait_checkmate()
+
+    # エンジンに対してstopを送信する。
+    async def usi_stop(self):
+        await self.send_command("stop")
+
+    # [SYNC] bestmoveが返ってくるのを待つ
+    # 待っている間にエンジンが終了してしまったら例外をraise
+    async def wait_bestmove(self):
+        await self.wait_for(
+            lambda: self.think_result.bestmove is not None
+            or self.engine_state == UsiEngineState.Disconnected
+        )
+        if self.think_result.bestmove is None:
+            raise ValueError("engine_state == UsiEngineState.Disconnected.")
+
+    # [SYNC] checkmateが返ってくるのを待つ
+    # 待っている間にエンジンが終了してしまったら例外をraise
+    async def wait_checkmate(self):
+        await self.wait_for(
+            lambda: self.think_result.checkmate is not None
+            or self.engine_state == UsiEngineState.Disconnected
+        )
+        if self.think_result.checkmate is None:
+            raise ValueError("engine_state == UsiEngineState.Disconnected.")
+
+    # --- エンジンに対するコマンド、ここまで ---
+
+    # [SYNC] エンジンに対して1行送って、すぐに1行返ってくるので、それを待って、この関数の返し値として返す。
+    async def send_command_and_getline(self, command: str) -> str:
+        await self.wait_for_state(UsiEngineState.WaitCommand)
+        self.last_received_line = None
+        await self.send_command(command)
+
+        # エンジン側から一行受信するまで待機
+        await self.wait_for(
+            lambda: self.last_received_line is not None
+            or self.engine_state == UsiEngineState.Disconnected
+        )
+        if self.last_received_line is None:
+            raise ValueError("engine_state == UsiEngineState.Disconnected.")
+        return self.last_received_line
+
+    # エンジンからの受信を行うtask
+    # readline()だとStreamReaderのlimit(64KiB)を超える長い行で例外になるので、
+    # UsiEngine.read_worker()と同じく、まとめて読み出して改行までを解釈する。
+    async def read_worker(self):
+        stdout = cast(asyncio.subprocess.Process, self.proc).stdout
+        rest = b""
+        while True:
+            chunk = await stdout.read(READ_BUFFER_SIZE)
+            # プロセスが終了した場合、空のbytesが返る。
+            if not chunk:
+                break
+            end = chunk.rfind(b"\n") + 1
+            if end == 0:
+                rest += chunk
+                continue
+            self.dispatch_block(rest + chunk[:end])
+            rest = chunk[end:]
+            self.notify()
+
+        # 改行で終わっていない最後の行
+        if rest:
+            self.dispatch_line(rest)
+
+        self.exit_state = 0
+        # 待機しているものがいれば起こす。
+        self.change_state(UsiEngineState.Disconnected)
+
+    # print()。asyncioでは並行して呼び出されることはないのでlockは不要。
+    def print(self, mes: str):
+        print(mes)
+
+    # self.engine_stateを変更する。
+    def change_state(self, state: UsiEngineState):
+        # 切断されたあとでは変更できない
+        if self.engine_state == UsiEngineState.Disconnected:
+            return
+        # goコマンドを送ってWaitBestmoveに変更する場合、現在の状態がWaitCommandでなければならない。
+        if state == UsiEngineState.WaitBestmove:
+            if self.engine_state != UsiEngineState.WaitCommand:
+                raise ValueError(
+                    "{0} : can't send go command when self.engine_state != UsiEngineState.WaitCommand".format(
+                        self.instance_id
+                    )
+                )
+
+        self.engine_state = state
+        self.notify()
+
+    # 待機しているものを起こす。
+    def notify(self):
+        event = self.state_changed_event
+        if event is not None:
+            event.set()
@@ -0,0 +1,92 @@
+from typing import Any, List, Optional, Tuple
+
+from src.engine.game_result import GameResult
+from src.engine.pairing import PairedOpenings
+from src.engine.rating import EloRating, PairEloRating
+
+
+# 対局させるエンジンの組と、その戦績。
+# MultiAyaneruServer.match_sourceから返すと、対局サーバーごとに異なるエンジンの組を同時に対局させることができる。
+# 1つの組のgames局は、1つの対局サーバーで続けて対局させる。(エンジンを入れ替える回数を少なくするため)
+class EngineMatch:
+    # engine_configs : [1P側 , 2P側]の(エンジンの実行ファイルのpath , エンジンオプション)
+    # games : 対局数
+    def __init__(self, engine_configs: List[Tuple[str, dict]], games: int):
+
+        # --- public members ---
+
+        # [1P側 , 2P側]の(エンジンの実行ファイルのpath , エンジンオプション)
+        self.engine_configs = engine_configs
+
+        # 対局数
+        self.games = games
+
+        # 呼び出し側で自由に使ってよい値。(エンジンの名前など)
+        self.tag: Any = None
+
+        # --- public readonly members ---
+
+        # MultiAyaneruServerが振る、組の番号
+        self.match_id: Optional[int] = None
+
+        # 開始した対局数
+        self.started_games = 0
+
+        # 終了した対局数
+        self.total_games = 0
+
+        # player1が勝利したゲーム数
+        self.player1_win = 0
+        # player2が勝利したゲーム数
+        self.player2_win = 0
+        # 先手の勝利したゲーム数
+        self.black_win = 0
+        # 後手の勝利したゲーム数
+        self.white_win = 0
+        # 引き分けたゲーム数
+        self.draw_games = 0
+
+        # MultiAyaneruServer.paired_openings == Trueのときの、開始局面の順番と2局1組の戦績
+        self.pairing: Optional[PairedOpenings] = None
+
+    # games局すべて終了したか。
+    def is_finished(self) -> bool:
+        return self.total_games >= self.games
+
+    # 1局の結果を加える。
+    # flip_turn : その対局で1P側を後手にしたか
+    # pair_id : paired_openings == Trueのときの2局1組の番号
+    def add_result(self, result: GameResult, flip_turn: bool, pair_id=None):
+        if result.is_black_or_white_win():
+            if result.is_player1_win(flip_turn):
+                self.player1_win += 1
+                score = 1.0
+            else:
+                self.player2_win += 1
+                score = 0.0
+            if result == GameResult.BLACK_WIN:
+                self.black_win += 1
+            else:
+                self.white_win += 1
+        else:
+            self.draw_games += 1
+            score = 0.5
+        self.total_games += 1
+
+        if self.pairing is not None and pair_id is not None:
+            self.pairing.add_result(pair_id, score)
+
+    # Eloレーティングを計算して返す。(EloRating型を)
+    def game_rating(self) -> EloRating:
+        if self.pairing is not None:
+            elo = PairEloRating()
+            elo.pentanomial = list(self.pairing.pentanomial)
+        else:
+            elo = EloRating()
+        elo.player1_win = self.player1_win
+        elo.player2_win = self.player2_win
+        elo.black_win = self.black_win
+        elo.white_win = self.white_win
+        elo.draw_games = self.draw_games
+        elo.calc()
+        return elo
@@ -0,0 +1,225 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from src.engine.cpu_affinity import get_process_group_pids
+from src.engine.engine import UsiEngine
+from src.engine.enums import UsiEngineState
+
+# UsiEnginePoolで、エンジンを識別するためのkey。(実行ファイルのpath , オプション)
+EngineKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+# 接続済みのUsiEngineを使い回すためのpool。
+# 評価関数の読み込みなどでエンジンの起動には時間がかかるので、対局が終わったエンジンは終了させずに
+# ここに返却しておき、同じ実行ファイル・同じオプションのエンジンが必要になったときに貸し出す。
+#
+# 使い方)
+#   pool = UsiEnginePool()
+#   engine = pool.lease("engine/YaneuraOu.exe", {"Hash":"128"})  # 接続済みのエンジンが返る
+#   ...
+#   pool.release(engine)  # 使い終わったら返却する
+#   pool.close()          # 最後にすべてのエンジンを終了させる
+class UsiEnginePool:
+    # memory_budget : poolが保持するエンジン(貸し出し中のものを含む)のメモリ使用量の上限[MB]。
+    #                 これを超えると、返却されているエンジンのうち最も長く使われていないものから終了させる。
+    #                 Noneなら無制限。
+    def __init__(self, memory_budget: Optional[int] = None):
+
+        # --- public members ---
+
+        # メモリ使用量の上限[MB]
+        self.memory_budget = memory_budget
+
+        # --- public readonly members ---
+
+        # 新たに起動したエンジンの数
+        self.spawned = 0
+
+        # 返却されたエンジンを再利用した回数
+        self.reused = 0
+
+        # メモリ使用量の上限を超えたために終了させたエンジンの数
+        self.evicted = 0
+
+        # --- private members ---
+
+        # 返却されたエンジン。最も長く使われていないものが先頭。
+        # instance_id -> (key , engine , メモリ使用量[MB])
+        self.idle: "OrderedDict[int, Tuple[EngineKey, UsiEngine, int]]" = OrderedDict()
+
+        # 貸し出し中のエンジン。instance_id -> (key , engine)
+        self.leased: Dict[int, Tuple[EngineKey, UsiEngine]] = {}
+
+        # keyごとに、最後に計測したエンジン1つあたりのメモリ使用量[MB]
+        # 新たにエンジンを起動する前に、その分の空きを作るのに用いる。
+        self.memory_per_key: Dict[EngineKey, int] = {}
+
+        # 対局監視用のスレッドから返却されることがあるのでlockしておく。
+        self.lock_object = threading.Lock()
+
+    # エンジンを1つ借りる。
+    # 同じ実行ファイル・同じオプションのエンジンが返却されていればそれを、なければ新たに起動して接続したものを返す。
+    # 新たに起動した場合、"readyok"が返ってくるのは待たない。(UsiEngine.connect()と同じ)
+    def lease(
+        self, engine_path: str, engine_options: Optional[dict] = None
+    ) -> UsiEngine:
+        key = make_engine_key(engine_path, engine_options)
+        with self.lock_object:
+            # 最近返却されたものから探す。
+            # 返却されている間に終了してしまっていたものは取り除く。
+            found = None
+            dead = []
+            for instance_id in reversed(self.idle):
+                idle_key, engine, _ = self.idle[instance_id]
+                if idle_key != key:
+                    continue
+                if engine.engine_state == UsiEngineState.Disconnected:
+                    dead.append(instance_id)
+                    continue
+                found = instance_id
+                break
+            evicted = [self.idle.pop(instance_id)[1] for instance_id in dead]
+
+            if found is not None:
+                _, engine, _ = self.idle.pop(found)
+                self.leased[found] = (key, engine)
+                self.reused += 1
+            else:
+                # 新たに起動する分の空きを作っておく。
+                evicted += self.evict(self.memory_per_key.get(key, 0))
+
+        # disconnect()は時間がかかることがあるので、lockの外で行う。
+        for e in evicted:
+            e.disconnect()
+        if found is not None:
+            return engine
+
+        engine = UsiEngine()
+        if engine_options is not None:
+            engine.set_engine_options(engine_options)
+        engine.connect(engine_path)
+
+        with self.lock_object:
+            self.leased[engine.instance_id] = (key, engine)
+            self.spawned += 1
+        return engine
+
+    # lease()で借りたエンジンを返却する。
+    # 終了してしまっているエンジンは、poolには戻さずに破棄する。
+    def release(self, engine: UsiEngine):
+        memory = get_engine_memory(engine)
+        with self.lock_object:
+            key, _ = self.leased.pop(engine.instance_id)
+            if engine.engine_state == UsiEngineState.Disconnected:
+                evicted = [engine]
+            else:
+                self.memory_per_key[key] = memory
+                self.idle[engine.instance_id] = (key, engine, memory)
+                evicted = self.evict(0)
+
+        for e in evicted:
+            e.disconnect()
+
+    # メモリ使用量の合計がmemory_budgetからreserve[MB]を引いたものに収まるまで、
+    # 返却されているエンジンを古いものから取り除く。lockしてから呼び出すこと。
+    # 返し値 : 取り除いたエンジン。(時間がかかるので、disconnect()はlockの外で行う)
+    def evict(self, reserve: int) -> List[UsiEngine]:
+        evicted: List[UsiEngine] = []
+        if self.memory_budget is None:
+            return evicted
+
+        total = sum(memory for _, _, memory in self.idle.values()) + sum(
+            self.memory_per_key.get(key, 0) for key, _ in self.leased.values()
+        )
+        while self.idle and total + reserve > self.memory_budget:
+            _, (_, engine, memory) = self.idle.popitem(last=False)
+            total -= memory
+            evicted.append(engine)
+            self.evicted += 1
+        return evicted
+
+    # 返却されているエンジンの数
+    def idle_count(self) -> int:
+        with self.lock_object:
+            return len(self.idle)
+
+    # 返却されているすべてのエンジンを終了させる。
+    # 貸し出し中のエンジンは、借りた側で終了させること。
+    def close(self):
+        with self.lock_object:
+            engines = [engine for _, engine, _ in self.idle.values()]
+            self.idle.clear()
+        for engine in engines:
+            engine.disconnect()
+
+    def __del__(self):
+        self.close()
+
+
+# エンジンを識別するためのkeyを作る。
+def make_engine_key(engine_path: str, engine_options: Optional[dict]) -> EngineKey:
+    options = engine_options if engine_options is not None else {}
+    return (
+        os.path.abspath(engine_path),
+        tuple(sorted((str(k), str(v)) for k, v in options.items())),
+    )
+
+
+# エンジンのメモリ使用量[MB]
+# /proc/[pid]/statusのVmRSSから求める。取得できない環境では、オプションのHashの値で代用する。
+# エンジンが子プロセスを起動していたり、shell経由で起動されていたりするので、process groupに属するプロセスの合計とする。
+def get_engine_memory(engine: UsiEngine) -> int:
+    proc = engine.proc
+    if proc is not None:
+        rss = get_process_group_rss(proc.pid)
+        if rss is not None:
+            return rss
+    return get_hash_size(engine.options)
+
+
+# オプションのHashの値[MB]。指定されていなければ0。
+def get_hash_size(engine_options: Optional[dict]) -> int:
+    options = engine_options if engine_options is not None else {}
+    try:
+        return int(options.get("Hash", 0))
+    except ValueError:
+        return 0
+
+
+# 指定したプロセスが属するprocess groupのプロセスの、物理メモリ使用量の合計[MB]。取得できなければNone。
+# このプロセス自身と同じprocess groupなら、指定したプロセスだけのものとする。
+def get_process_group_rss(pid: int) -> Optional[int]:
+    pids = [pid]
+    try:
+        pgid = os.getpgid(pid)
+        if pgid != os.getpgid(0):
+            pids = get_process_group_pids(pgid)
+    except OSError:
+        pass
+    rss = [get_process_rss(p) for p in pids]
+    rss = [r for r in rss if r is not None]
+    return sum(rss) if rss else None
+
+
+# プロセスの物理メモリ使用量[MB]。取得できなければNone。
+def get_process_rss(pid: int) -> Optional[int]:
+    try:
+        with open("/proc/{0}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    # "VmRSS:    123456 kB"
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+# 物理メモリの総量[MB]。取得できなければNone。
+def get_physical_memory() -> Optional[int]:
+    try:
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        return page_size * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
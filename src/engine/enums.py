@@ -22,6 +22,19 @@ class UsiEngineState(Enum):
     Disconnected = 999  # 終了した
 
 
+# UsiEngineがエンジンから送られてきた"info"をどこまで解釈するかを表現するenum
+class UsiInfoCaptureLevel(Enum):
+    NoCapture = 0  # "info"は読み捨てる。think_result.pvsは空のまま。
+    FinalOnly = 1  # 最後の"info"行だけを保持しておき、"bestmove"を受信したときにそれだけを解釈する。(MultiPV 1用)
+    Full = 2  # すべての"info"行を解釈する。
+
+
+# AyaneruServerで、エンジンが応答しなくなった(時間内にbestmoveを返さなかった)ときの対局の扱いを表現するenum
+class WatchdogPolicy(Enum):
+    VoidGame = 0  # その対局を無効にして、集計せずに対局しなおす。
+    Loss = 1  # 応答しなくなった側の負けとして集計する。
+
+
 # 特殊な評価値(Eval)を表現するenum
 class UsiEvalSpecialValue(IntEnum):
     # 0手詰めのスコア(rootで詰んでいるときのscore)
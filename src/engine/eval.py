@@ -2,7 +2,10 @@ from src.engine.enums import UsiEvalSpecialValue
 
 
 # 評価値(Eval)を表現する型
+# 読み筋ごとに保持するので、__slots__を空にして__dict__を持たないようにしてある。
 class UsiEvalValue(int):
+    __slots__ = ()
+
     # 詰みのスコアであるか
     def is_mate_score(self):
         return (
@@ -0,0 +1,158 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.engine.enums import UsiBound, UsiEvalSpecialValue
+from src.engine.eval import UsiEvalValue
+from src.engine.service import UsiThinkPV
+
+
+# エンジンから送られてきた"info ..."の1行を解釈する。
+# 返し値 : (multipvの何番目の読み筋であるか , 読み筋)。"info string ..."のときはNone。
+#
+# 例 : "info depth 12 seldepth 16 score cp 58 upperbound nodes 51273 nps 1709100 time 30 pv 2g2f 8c8d"
+#
+# "pv"以降は読み筋なので分割せずにそのまま切り出し、その手前の部分だけをsplit()して
+# キーワードの表(INFO_FIELDS , INFO_HANDLERS)を引いて解釈する。
+# 表にないキーワードは読み飛ばす。
+def parse_info(message: str) -> Optional[Tuple[int, UsiThinkPV]]:
+    pv = UsiThinkPV()
+
+    # "pv"以降を切り出す。
+    index = message.find(" pv ")
+    if index != -1:
+        pv.pv = message[index + 4 :]
+        message = message[:index]
+    elif message.endswith(" pv"):
+        pv.pv = ""
+        message = message[:-3]
+
+    tokens = message.split()
+    state = InfoParseState()
+    end = len(tokens)
+    i = 1  # tokens[0]は"info"
+    while i < end:
+        token = tokens[i]
+        field = INFO_FIELDS.get(token)
+        if field is not None:
+            # 数値はここで一度だけ整数化する。
+            if i + 1 < end:
+                try:
+                    setattr(pv, field, int(tokens[i + 1]))
+                except ValueError:
+                    pass
+            i += 2
+            continue
+
+        handler = INFO_HANDLERS.get(token)
+        if handler is None:
+            # 知らないキーワード。読み飛ばす。
+            i += 1
+            continue
+
+        i = handler(tokens, i + 1, pv, state)
+        if state.is_comment:
+            return None
+
+    return state.multipv, pv
+
+
+# parse_info()の途中経過
+class InfoParseState:
+    __slots__ = ["multipv", "is_comment"]
+
+    def __init__(self):
+        # multipvの何番目の読み筋であるか
+        self.multipv = 1
+
+        # "info string.."のようなコメント行であったか
+        self.is_comment = False
+
+
+# "score"のあとを解釈する。
+# tokens[i]が"cp"か"mate"を指している。返し値は次に解釈すべきindex。
+def parse_score(tokens: List[str], i: int, pv: UsiThinkPV, state: InfoParseState) -> int:
+    end = len(tokens)
+    if i >= end:
+        return i
+    kind = tokens[i]
+    value = tokens[i + 1] if i + 1 < end else ""
+    i += 2
+
+    if kind == "cp":
+        try:
+            pv.eval = UsiEvalValue(int(value))
+        except ValueError:
+            pass
+    elif kind == "mate":
+        # https://github.com/yaneurao/Ayane/issues/6
+        # 技巧の場合、
+        # "info depth 1 nodes 0 time 0 score mate + string Nyugyoku"
+        # のような文字列が来ることがあるらしい。
+        # 手数が解析できないときは、手数は+2000/-2000という扱いにしておく。
+        # これはUsiEvalSpecialValueでmate scoreとして判定されるギリギリのスコア。
+        is_minus = value.startswith("-")
+        try:
+            ply = abs(int(value))
+        except ValueError:
+            ply = int(UsiEvalSpecialValue.ValueMaxMatePly)
+        if is_minus:
+            pv.eval = UsiEvalValue.mated_in_ply(ply)
+        else:
+            pv.eval = UsiEvalValue.mate_in_ply(ply)
+
+    # この直後に"upperbound"/"lowerbound"が付与されている可能性がある。
+    bound = INFO_BOUNDS.get(tokens[i]) if i < end else None
+    if bound is not None:
+        pv.bound = bound
+        i += 1
+    else:
+        pv.bound = UsiBound.BoundExact
+    return i
+
+
+# "multipv"のあとを解釈する。
+def parse_multipv(tokens: List[str], i: int, pv: UsiThinkPV, state: InfoParseState) -> int:
+    try:
+        state.multipv = int(tokens[i])
+    except (IndexError, ValueError):
+        pass
+    return i + 1
+
+
+# "string"のあとはコメントなので、この行は丸ごと無視する。
+def parse_string(tokens: List[str], i: int, pv: UsiThinkPV, state: InfoParseState) -> int:
+    state.is_comment = True
+    return len(tokens)
+
+
+# 値を1つ取るが使わないキーワード
+def skip_one(tokens: List[str], i: int, pv: UsiThinkPV, state: InfoParseState) -> int:
+    return i + 1
+
+
+# 値を整数化してUsiThinkPVのメンバに格納するキーワード。(キーワード -> メンバ名)
+INFO_FIELDS: Dict[str, str] = {
+    "depth": "depth",
+    "seldepth": "seldepth",
+    "nodes": "nodes",
+    "nps": "nps",
+    "hashfull": "hashfull",
+    "time": "time",
+}
+
+# 解釈に手続きが必要なキーワード。(キーワード -> 解釈する関数)
+INFO_HANDLERS: Dict[
+    str, Callable[[List[str], int, UsiThinkPV, InfoParseState], int]
+] = {
+    "score": parse_score,
+    "multipv": parse_multipv,
+    "string": parse_string,
+    "currmove": skip_one,
+    "currmovenumber": skip_one,
+    "cpuload": skip_one,
+}
+
+# "score"の直後に来るbound
+INFO_BOUNDS: Dict[str, UsiBound] = {
+    "upperbound": UsiBound.BoundUpper,
+    "lowerbound": UsiBound.BoundLower,
+}
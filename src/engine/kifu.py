@@ -1,13 +1,69 @@
+from typing import List, Tuple
+
+from src.engine.enums import Turn
+
+
 # 対局棋譜、付随情報つき。
 class GameKifu:
     def __init__(self):
         # --- public members ---
 
-        # "startpos moves ..."のような対局棋譜
-        self.sfen = None  # str
+        # 開始局面。"startpos"や"sfen ..."のような形
+        self.start_position = "startpos"  # str
+
+        # 開始局面からの指し手("7g7f"のようなUSI表記)
+        self.moves: List[str] = []
 
         # 1P側を後手にしたのか？
         self.flip_turn = False
 
         # 試合結果
         self.game_result = None  # GameResult
+
+        # 開始局面を先後入れ替えて2局ずつ指したときの、組の番号。組にしていなければNone。
+        # (MultiAyaneruServer.paired_openings)
+        self.pair_id = None
+
+        # 対局させたエンジンの組(EngineMatch)の番号。組ごとに対局させていなければNone。
+        # (MultiAyaneruServer.match_source)
+        self.match_id = None
+
+    # "startpos moves ..."のような対局棋譜
+    # start_position , movesから組み立てる。
+    @property
+    def sfen(self) -> str:
+        return build_sfen(self.start_position, self.moves)
+
+    # sfenを代入すると、start_position , movesに分解して格納される。
+    @sfen.setter
+    def sfen(self, sfen: str):
+        self.start_position, self.moves = split_sfen(sfen)
+
+
+# "startpos moves 7g7f 3c3d"のような文字列を、開始局面("startpos"や"sfen ...")と指し手のlistに分解する。
+# "moves"がなければ指し手は空のlistになる。
+def split_sfen(sfen: str) -> Tuple[str, List[str]]:
+    index = sfen.find(" moves")
+    if index == -1:
+        return sfen.strip(), []
+    return sfen[:index].strip(), sfen[index + 6 :].split()
+
+
+# split_sfen()の逆変換。"startpos moves 7g7f 3c3d"のような文字列を返す。
+# 指し手がなくても"moves"は付与する。
+def build_sfen(start_position: str, moves: List[str]) -> str:
+    if len(moves) == 0:
+        return start_position + " moves"
+    return start_position + " moves " + " ".join(moves)
+
+
+# 開始局面("startpos"や"sfen ...")からmoves_count手進めた局面の手番を返す。
+# "sfen ..."のときは、sfenの手番のfield("b"か"w")から求める。
+def get_side_to_move(start_position: str, moves_count: int) -> Turn:
+    side = Turn.BLACK
+    if start_position.startswith("sfen"):
+        # "sfen 盤面 手番 手駒 手数"
+        fields = start_position.split(None, 3)
+        if len(fields) >= 3 and fields[2] == "w":
+            side = Turn.WHITE
+    return side.flip() if moves_count % 2 == 1 else side
@@ -0,0 +1,354 @@
+import io
+import mmap
+import struct
+import sys
+from array import array
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from src.engine.game_result import GameResult
+from src.engine.kifu import GameKifu
+from src.engine.kifu_sink import kifu_to_line, read_kifus
+
+# 対局棋譜をバイナリ形式で保存するためのモジュール。
+#
+# ファイルの構成 : (数値はすべてlittle endian)
+#   ファイルヘッダ  : FILE_HEADER (magic , version , 対局数 , 開始局面表の位置 , indexの位置)
+#   対局レコード群  : 1局ごとに GAME_HEADER (開始局面id , flip_turn , game_result , 手数) + 指し手(uint16 × 手数)
+#   開始局面表      : 局面数(uint32) + 局面ごとに 長さ(uint32) + "startpos"や"sfen ..."のutf-8文字列
+#   index           : 各対局レコードの先頭位置(uint64 × 対局数)
+#
+# 指し手は16bitにencodeする。
+#   bit0..6  : 移動先の升(0..80)
+#   bit7..13 : 移動元の升(0..80)。駒打ちのときは81 + 駒種(DROP_PIECES内の順番)
+#   bit14    : 成り
+
+FILE_MAGIC = b"AYKF"
+FILE_VERSION = 1
+
+# magic , version , reserved , 対局数 , 開始局面表の位置 , indexの位置
+FILE_HEADER = struct.Struct("<4sHHQQQ")
+
+# 開始局面id , flip_turn , game_result , 手数
+GAME_HEADER = struct.Struct("<IBBH")
+
+# game_resultがNoneのときに書き出す値
+RESULT_NONE = 0xFF
+
+# 駒打ちの駒種。"P*5e"のような表記の先頭の文字。
+DROP_PIECES = "PLNSGBR"
+
+
+# 升の表記("7g"など)。index = (筋 - 1) * 9 + 段
+SQUARE_NAMES = [
+    "{0}{1}".format(file, rank) for file in range(1, 10) for rank in "abcdefghi"
+]
+
+
+# 指し手の文字列 <-> 16bitの値 の変換表を作る。
+def build_move_tables() -> Tuple[Dict[str, int], List[Optional[str]]]:
+    move_to_code: Dict[str, int] = {}
+    code_to_move: List[Optional[str]] = [None] * (1 << 15)
+
+    def add(move: str, code: int):
+        move_to_code[move] = code
+        code_to_move[code] = move
+
+    for to, to_name in enumerate(SQUARE_NAMES):
+        for from_, from_name in enumerate(SQUARE_NAMES):
+            if from_ == to:
+                continue
+            code = to | (from_ << 7)
+            add(from_name + to_name, code)
+            add(from_name + to_name + "+", code | (1 << 14))
+        for piece_index, piece in enumerate(DROP_PIECES):
+            add(piece + "*" + to_name, to | ((81 + piece_index) << 7))
+    return move_to_code, code_to_move
+
+
+MOVE_TO_CODE, CODE_TO_MOVE = build_move_tables()
+
+
+# 指し手("7g7f"のようなUSI表記)を16bitの値にする。
+def encode_move(move: str) -> int:
+    code = MOVE_TO_CODE.get(move)
+    if code is None:
+        raise ValueError("can't encode move : " + move)
+    return code
+
+
+# encode_move()の逆変換
+def decode_move(code: int) -> str:
+    move = CODE_TO_MOVE[code] if code < len(CODE_TO_MOVE) else None
+    if move is None:
+        raise ValueError("invalid move code : {0}".format(code))
+    return move
+
+
+# 対局棋譜をバイナリ形式で書き出すクラス。
+# write() , flush() , close()を持つので、MultiAyaneruServer.kifu_sinkに設定することもできる。
+# 開始局面表とindexはclose()のときに書き出すので、close()するまではファイルは読み込めない。
+class KifuBinaryWriter:
+    def __init__(self, path: str):
+
+        # --- public readonly members ---
+
+        # 書き出しているファイルのpath
+        self.path = path
+
+        # これまでにwrite()された棋譜の数
+        self.total_games = 0
+
+        # --- private members ---
+
+        # 開始局面 -> 開始局面id
+        self.position_ids: Dict[str, int] = {}
+
+        # 開始局面id順に並べた開始局面
+        self.positions: List[str] = []
+
+        # 各対局レコードの先頭位置
+        self.offsets: List[int] = []
+
+        # 書き出しているファイルのハンドル
+        self.file: Optional[io.BufferedWriter] = open(path, "wb")
+
+        # ヘッダは最後に書き直す。
+        self.file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, 0, 0, 0, 0))
+        self.position = FILE_HEADER.size
+
+    # 棋譜を1局追加する。
+    def write(self, kifu: GameKifu):
+        position_id = self.position_ids.get(kifu.start_position)
+        if position_id is None:
+            position_id = len(self.positions)
+            self.position_ids[kifu.start_position] = position_id
+            self.positions.append(kifu.start_position)
+
+        moves = kifu.moves
+        if len(moves) > 0xFFFF:
+            raise ValueError("too many moves : {0}".format(len(moves)))
+        result = RESULT_NONE if kifu.game_result is None else int(kifu.game_result)
+
+        try:
+            codes = array("H", map(MOVE_TO_CODE.__getitem__, moves))
+        except KeyError as e:
+            raise ValueError("can't encode move : {0}".format(e.args[0]))
+        if sys.byteorder == "big":
+            codes.byteswap()
+
+        header = GAME_HEADER.pack(
+            position_id, 1 if kifu.flip_turn else 0, result, len(moves)
+        )
+        data = header + codes.tobytes()
+
+        self.offsets.append(self.position)
+        self.file.write(data)
+        self.position += len(data)
+        self.total_games += 1
+
+    # 対局レコードをファイルに書き出す。(開始局面表とindexはclose()まで書き出さない)
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    # 開始局面表とindexを書き出して、ファイルを閉じる。
+    def close(self):
+        if self.file is None:
+            return
+        f = self.file
+
+        positions_offset = self.position
+        f.write(struct.pack("<I", len(self.positions)))
+        for position in self.positions:
+            b = position.encode("utf-8")
+            f.write(struct.pack("<I", len(b)))
+            f.write(b)
+        index_offset = f.tell()
+        # indexは8byte境界に揃えておく。
+        padding = -index_offset % 8
+        f.write(b"\0" * padding)
+        index_offset += padding
+        f.write(struct.pack("<{0}Q".format(len(self.offsets)), *self.offsets))
+
+        f.seek(0)
+        f.write(
+            FILE_HEADER.pack(
+                FILE_MAGIC,
+                FILE_VERSION,
+                0,
+                len(self.offsets),
+                positions_offset,
+                index_offset,
+            )
+        )
+        f.close()
+        self.file = None
+
+    def __del__(self):
+        self.close()
+
+
+# KifuBinaryWriterで書き出したファイルを読み込むクラス。
+# ファイルはmmapするだけなので、巨大なファイルでもすべてを読み込むことはない。
+# 1局ずつ取り出すには kifus[i] , 順番にすべて取り出すには for kifu in kifus: のようにする。
+class KifuBinaryReader:
+    def __init__(self, path: str):
+
+        # --- public readonly members ---
+
+        # 読み込んでいるファイルのpath
+        self.path = path
+
+        # 開始局面id順に並べた開始局面
+        self.positions: List[str] = []
+
+        # --- private members ---
+
+        # 読み込んでいるファイルのハンドルと、それをmmapしたもの
+        self.file: Optional[io.BufferedReader] = None
+        self.mmap: Optional[mmap.mmap] = None
+        self.view: Optional[memoryview] = None
+
+        # 各対局レコードの先頭位置
+        self.offsets: Optional[Sequence[int]] = None
+
+        self.file = open(path, "rb")
+        size = FILE_HEADER.size
+        header = self.file.read(size)
+        if len(header) < size:
+            raise ValueError("invalid kifu file : " + path)
+        (
+            magic,
+            version,
+            _,
+            game_count,
+            positions_offset,
+            index_offset,
+        ) = FILE_HEADER.unpack(header)
+        if magic != FILE_MAGIC or version != FILE_VERSION or positions_offset == 0:
+            raise ValueError("invalid kifu file : " + path)
+
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+
+        count = struct.unpack_from("<I", self.mmap, positions_offset)[0]
+        offset = positions_offset + 4
+        for _ in range(count):
+            length = struct.unpack_from("<I", self.mmap, offset)[0]
+            offset += 4
+            self.positions.append(
+                bytes(self.view[offset : offset + length]).decode("utf-8")
+            )
+            offset += length
+
+        self.offsets = load_uint_array(
+            self.view[index_offset : index_offset + game_count * 8], "Q"
+        )
+
+    # 格納されている対局数
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    # i番目の対局のヘッダ
+    # 返し値 : (開始局面id , flip_turn , game_result(結果がなければNone) , 手数)
+    def get_header(self, i: int) -> Tuple[int, bool, Optional[GameResult], int]:
+        position_id, flip_turn, result, move_count = GAME_HEADER.unpack_from(
+            self.mmap, self.get_offset(i)
+        )
+        return (
+            position_id,
+            flip_turn != 0,
+            None if result == RESULT_NONE else GameResult(result),
+            move_count,
+        )
+
+    # i番目の対局の指し手を、encodeされたまま(uint16のarrayで)返す。
+    # 文字列にしないので、集計などを高速に行いたいときに用いる。
+    def get_move_codes(self, i: int) -> array:
+        offset = self.get_offset(i)
+        move_count = GAME_HEADER.unpack_from(self.mmap, offset)[3]
+        begin = offset + GAME_HEADER.size
+        codes = array("H")
+        codes.frombytes(self.view[begin : begin + move_count * 2])
+        if sys.byteorder == "big":
+            codes.byteswap()
+        return codes
+
+    # i番目の対局をGameKifuにして返す。
+    def get_kifu(self, i: int) -> GameKifu:
+        position_id, flip_turn, result, _ = self.get_header(i)
+        kifu = GameKifu()
+        kifu.start_position = self.positions[position_id]
+        kifu.moves = [CODE_TO_MOVE[code] for code in self.get_move_codes(i)]
+        kifu.flip_turn = flip_turn
+        kifu.game_result = result
+        return kifu
+
+    def __getitem__(self, i: int) -> GameKifu:
+        return self.get_kifu(i)
+
+    def __iter__(self) -> Iterator[GameKifu]:
+        for i in range(len(self)):
+            yield self.get_kifu(i)
+
+    # i番目の対局レコードの先頭位置
+    def get_offset(self, i: int) -> int:
+        if i < 0:
+            i += len(self.offsets)
+        if not 0 <= i < len(self.offsets):
+            raise IndexError("kifu index out of range : {0}".format(i))
+        return self.offsets[i]
+
+    # ファイルを閉じる。
+    def close(self):
+        if isinstance(self.offsets, memoryview):
+            self.offsets.release()
+        self.offsets = None
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __del__(self):
+        self.close()
+
+
+# little endianで格納されている整数の配列を、コピーせずに参照する。
+# (big endianの環境ではコピーして並べ替える)
+# indexのように大きな配列に用いる。
+def load_uint_array(view: memoryview, typecode: str) -> Sequence[int]:
+    if sys.byteorder == "little":
+        return view.cast(typecode)
+    a = array(typecode)
+    a.frombytes(view)
+    a.byteswap()
+    return a
+
+
+# テキスト形式(KifuSinkで書き出したものや定跡ファイル)の棋譜をバイナリ形式に変換する。
+# kifu_format : "jsonl"か"sfen"
+# 返し値 : 変換した対局数
+def text_to_binary(text_path: str, binary_path: str, kifu_format: str = "sfen") -> int:
+    writer = KifuBinaryWriter(binary_path)
+    for kifu in read_kifus(text_path, kifu_format):
+        writer.write(kifu)
+    writer.close()
+    return writer.total_games
+
+
+# text_to_binary()の逆変換
+# 返し値 : 変換した対局数
+def binary_to_text(binary_path: str, text_path: str, kifu_format: str = "sfen") -> int:
+    reader = KifuBinaryReader(binary_path)
+    count = 0
+    with open(text_path, "w", encoding="utf-8") as f:
+        for kifu in reader:
+            f.write(kifu_to_line(kifu, kifu_format))
+            count += 1
+    reader.close()
+    return count
@@ -0,0 +1,137 @@
+import io
+import json
+import threading
+import time
+from typing import Iterator, List, Optional
+
+from src.engine.game_result import GameResult
+from src.engine.kifu import GameKifu
+
+# 棋譜ファイルの形式
+# "jsonl" : 1局ごとに {"sfen": "...", "flip_turn": false, "game_result": "BLACK_WIN"} の1行
+# "sfen"  : 1局ごとに "startpos moves ..." の1行。(試合結果などは書き出さない)
+KIFU_FORMATS = ["jsonl", "sfen"]
+
+
+# 終局した対局の棋譜を、ファイルに逐次書き出すためのクラス。
+# MultiAyaneruServer.kifu_sinkに設定しておくと、終局するごとにwrite()が呼び出される。
+# 書き出しはflush_games局ごと、あるいは前回からflush_interval秒経過するごとにまとめて行う。
+class KifuSink:
+    # path : 書き出すファイルのpath。すでに存在するなら末尾に追記する。
+    # kifu_format : KIFU_FORMATSのいずれか
+    def __init__(
+        self,
+        path: str,
+        kifu_format: str = "jsonl",
+        flush_games: int = 100,
+        flush_interval: float = 10.0,
+    ):
+        # --- public readonly members ---
+
+        # 書き出しているファイルのpath
+        self.path = path
+
+        # 棋譜ファイルの形式
+        self.kifu_format = kifu_format
+
+        # これまでにwrite()された棋譜の数
+        self.total_games = 0
+
+        # --- private members ---
+
+        # この数だけ溜まったら書き出す。
+        self.flush_games = flush_games
+
+        # 前回の書き出しからこの秒数が経過していたら書き出す。
+        self.flush_interval = flush_interval
+
+        # まだ書き出していない行
+        self.pending_lines: List[str] = []
+
+        # 前回書き出した時刻
+        self.last_flush_time = time.time()
+
+        # write()は対局監視用のスレッドから、close()はメインスレッドから呼び出されるのでlockしておく。
+        self.lock_object = threading.Lock()
+
+        # 書き出しているファイルのハンドル
+        self.file: Optional[io.TextIOWrapper] = None
+
+        if kifu_format not in KIFU_FORMATS:
+            raise ValueError("invalid kifu format : " + kifu_format)
+        self.file = open(path, "a", encoding="utf-8")
+
+    # 棋譜を1局追加する。
+    def write(self, kifu: GameKifu):
+        line = kifu_to_line(kifu, self.kifu_format)
+        with self.lock_object:
+            self.pending_lines.append(line)
+            self.total_games += 1
+            if (
+                len(self.pending_lines) >= self.flush_games
+                or time.time() - self.last_flush_time >= self.flush_interval
+            ):
+                self.flush_nolock()
+
+    # 溜まっている棋譜をファイルに書き出す。
+    def flush(self):
+        with self.lock_object:
+            self.flush_nolock()
+
+    # flush()の下請け。lockしてから呼び出すこと。
+    def flush_nolock(self):
+        self.last_flush_time = time.time()
+        if self.file is None or len(self.pending_lines) == 0:
+            return
+        self.file.write("".join(self.pending_lines))
+        self.file.flush()
+        self.pending_lines = []
+
+    # 溜まっている棋譜を書き出して、ファイルを閉じる。
+    def close(self):
+        with self.lock_object:
+            self.flush_nolock()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __del__(self):
+        self.close()
+
+
+# 棋譜を1行の文字列にする。(末尾に改行を含む)
+def kifu_to_line(kifu: GameKifu, kifu_format: str) -> str:
+    if kifu_format == "sfen":
+        return kifu.sfen + "\n"
+    return (
+        json.dumps(
+            {
+                "sfen": kifu.sfen,
+                "flip_turn": kifu.flip_turn,
+                "game_result": kifu.game_result.name,
+            }
+        )
+        + "\n"
+    )
+
+
+# kifu_to_line()の逆変換
+# "sfen"形式のときは、flip_turn , game_resultは初期値のまま。
+def line_to_kifu(line: str, kifu_format: str) -> GameKifu:
+    kifu = GameKifu()
+    if kifu_format == "sfen":
+        kifu.sfen = line
+        return kifu
+    d = json.loads(line)
+    kifu.sfen = d["sfen"]
+    kifu.flip_turn = d["flip_turn"]
+    kifu.game_result = GameResult[d["game_result"]]
+    return kifu
+
+
+# KifuSinkで書き出した棋譜ファイルを読み込む。1局ずつ返す。
+def read_kifus(path: str, kifu_format: str = "jsonl") -> Iterator[GameKifu]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield line_to_kifu(line, kifu_format)
@@ -0,0 +1,97 @@
+import random
+from array import array
+from collections import deque
+from typing import Deque, Dict, Hashable, List, Optional, Tuple
+
+# 開始局面を、先後を入れ替えて2局ずつ対局させるためのモジュール。
+#
+# 開始局面ごとの有利不利は、同じ開始局面を先後入れ替えて指せばほぼ打ち消しあうので、
+# 1局ずつの勝敗(勝ち・引き分け・負けの3値)ではなく、2局1組の得点(5値 = pentanomial)で集計したほうが
+# 分散が小さくなり、同じ信頼度を得るのに必要な対局数が少なくて済む。
+
+# 2局1組での1P側の得点(0 , 0.5 , 1 , 1.5 , 2)の名前。pentanomialの添字の順。
+PENTANOMIAL_NAMES = ["LL", "LD", "DD", "WD", "WW"]
+
+
+# 開始局面を重複なく選んで、それぞれ先後を入れ替えて2局ずつ対局させる順番を決めるクラス。
+# すべての開始局面を使い切ったら、並べ替え直してまた最初から使う。
+# また、2局1組の結果を集計して、pentanomialの形で保持する。
+class PairedOpenings:
+    # opening_count : 開始局面の数
+    def __init__(self, opening_count: int):
+
+        # --- public readonly members ---
+
+        # 開始局面の数
+        self.opening_count = opening_count
+
+        # 2局1組の1P側の得点ごとの組数。
+        # [0点(LL) , 0.5点(LD) , 1点(DD , WL) , 1.5点(WD) , 2点(WW)]
+        self.pentanomial = [0] * 5
+
+        # --- private members ---
+
+        # 開始局面を選ぶ順番(開始局面の番号を並べ替えたもの)と、次に選ぶ位置
+        # 巨大な定跡ファイルでも大丈夫なように、arrayで持つ。(必要になるまで作らない)
+        self.order: Optional[array] = None
+        self.position = 0
+
+        # 先後を入れ替えて2局目を指すのを待っている組。(開始局面の番号 , 組の番号)
+        self.pending: Deque[Tuple[int, int]] = deque()
+
+        # requeue()で戻された対局。(開始局面の番号 , flip_turn , 組の番号)
+        self.requeued: Deque[Tuple[int, bool, int]] = deque()
+
+        # 次に割り当てる組の番号
+        self.next_pair_id = 0
+
+        # 1局目が終わって2局目が終わっていない組の、1局目の1P側の得点。組の番号 -> 得点
+        self.half_results: Dict[Hashable, float] = {}
+
+    # 次に対局させる開始局面を返す。
+    # 返し値 : (開始局面の番号 , flip_turn , 組の番号)
+    #          1局目は1P側が先手(flip_turn = False)、2局目は同じ開始局面で1P側が後手になる。
+    def next_game(self) -> Tuple[int, bool, int]:
+        if self.requeued:
+            return self.requeued.popleft()
+        if self.pending:
+            index, pair_id = self.pending.popleft()
+            return index, True, pair_id
+
+        if self.order is None or self.position >= len(self.order):
+            self.order = array("I", range(self.opening_count))
+            random.shuffle(self.order)
+            self.position = 0
+        index = self.order[self.position]
+        self.position += 1
+
+        pair_id = self.next_pair_id
+        self.next_pair_id += 1
+        self.pending.append((index, pair_id))
+        return index, False, pair_id
+
+    # next_game()で返した対局を、結果を加えずに戻す。(無効になった対局をやり直すとき用)
+    # 次のnext_game()で、同じ開始局面・手番・組の番号で返される。
+    def requeue(self, index: int, flip_turn: bool, pair_id: int):
+        self.requeued.append((index, flip_turn, pair_id))
+
+    # 1局の結果を加える。
+    # pair_id : next_game()で返した組の番号(子プロセスから集めるときは、プロセスごとに区別できるものにする)
+    # score : その対局の1P側の得点(勝ち1 , 引き分け0.5 , 負け0)
+    # 返し値 : これで2局1組が揃ったならTrue。
+    def add_result(self, pair_id: Hashable, score: float) -> bool:
+        first = self.half_results.pop(pair_id, None)
+        if first is None:
+            self.half_results[pair_id] = score
+            return False
+        self.pentanomial[int((first + score) * 2 + 0.5)] += 1
+        return True
+
+    # 揃った組の数
+    def pair_count(self) -> int:
+        return sum(self.pentanomial)
+
+
+# pentanomialを"LL-LD-DD-WD-WW = 1-5-20-7-2"のように文字列化する。
+def pentanomial_to_str(pentanomial: List[int]) -> str:
+    return "-".join(PENTANOMIAL_NAMES) + " = " + "-".join(map(str, pentanomial))
@@ -1,5 +1,7 @@
 import math
 
+from src.engine.pairing import pentanomial_to_str
+
 
 class EloRating:
     def __init__(self):
@@ -136,3 +138,155 @@ class EloRating:
         # 相手側から見た勝率と、相手側から見た信頼下限を出して、その符号を反転させれば良い
         p0 = EloRating.solve_hypothesis_testing(1 - r, n)
         return -EloRating.calc_rating(p0)
+
+
+# 開始局面を先後入れ替えて2局ずつ指したときの、2局1組の結果(pentanomial)からレーティングを求めるEloRating。
+# 同じ開始局面の2局の結果の相関を考慮するので、1局ずつの結果から求めるよりも信頼区間が狭くなる。
+# レーティングは、引き分けを0.5勝として求めた1P側の得点率から計算する。
+# (EloRatingの勝敗数なども従来どおり設定して構わない。勝率などの内訳はそちらから計算する)
+class PairEloRating(EloRating):
+    def __init__(self):
+        super().__init__()
+
+        # --- public members ---
+
+        # 2局1組の1P側の得点(0 , 0.5 , 1 , 1.5 , 2)ごとの組数
+        self.pentanomial = [0] * 5
+
+        # --- public readonly members ---
+
+        # 1P側の得点率(引き分けは0.5勝)
+        self.score = 0
+
+    def calc(self):
+        super().calc()
+
+        pairs = sum(self.pentanomial)
+        if pairs == 0:
+            return
+
+        # 1局あたりの得点の、組ごとの平均とその分散
+        scores = [k / 4 for k in range(5)]
+        self.score = sum(c * s for c, s in zip(self.pentanomial, scores)) / pairs
+        variance = (
+            sum(c * (s - self.score) ** 2 for c, s in zip(self.pentanomial, scores))
+            / pairs
+        )
+
+        # EloRatingと同じく、有意水準0.05(片側)での信頼下限・信頼上限
+        a = 1.644854
+        error = a * math.sqrt(variance / pairs)
+        self.rating = round(EloRating.calc_rating(self.score), 2)
+        self.rating_lowerbound = round(
+            EloRating.calc_rating(max(self.score - error, 0)), 2
+        )
+        self.rating_upperbound = round(
+            EloRating.calc_rating(min(self.score + error, 1)), 2
+        )
+
+        self.pretty_string += " pairs {0} R{1}[{2},{3}]".format(
+            pentanomial_to_str(self.pentanomial),
+            self.rating,
+            self.rating_lowerbound,
+            self.rating_upperbound,
+        )
+
+
+# 逐次確率比検定(SPRT)
+# 1P側が2P側よりどれだけ強いかについて、
+#   帰無仮説 H0 : レーティング差 = elo0
+#   対立仮説 H1 : レーティング差 = elo1
+# のどちらであるかを、1局終わるごとに対数尤度比(LLR)を計算して判定する。
+# LLRが下限を下回ったらH0を、上限を上回ったらH1を採択して、そこで対局を打ち切ることができる。
+# 決まった対局数を指すのに比べて、多くの場合かなり少ない対局数で結論が出る。
+#
+# LLRは、勝ち・引き分け・負けの3値の結果に対する近似式(GSPRT)で計算する。
+# レーティング差は、EloRating.calc_rating()と同じく、勝率から求めるもの(引き分けは0.5勝とする)。
+# cf. https://www.chessprogramming.org/Sequential_Probability_Ratio_Test
+#
+# 使い方はEloRatingと同じく、public membersを設定してcalc()を呼び出す。
+class Sprt:
+    def __init__(self, elo0: float = 0, elo1: float = 5, alpha=0.05, beta=0.05):
+
+        # --- public members ---
+
+        # H0 , H1のレーティング差
+        self.elo0 = elo0
+        self.elo1 = elo1
+
+        # 第一種の過誤(H0が正しいのにH1を採択する)の確率
+        self.alpha = alpha
+
+        # 第二種の過誤(H1が正しいのにH0を採択する)の確率
+        self.beta = beta
+
+        # 1P側の勝利回数 , 2P側の勝利回数 , 引き分けの回数
+        self.player1_win = 0
+        self.player2_win = 0
+        self.draw_games = 0
+
+        # --- public readonly members ---
+
+        # 対数尤度比
+        self.llr = 0.0
+
+        # LLRの下限(これを下回ったらH0を採択) , 上限(これを上回ったらH1を採択)
+        self.lower_bound = math.log(beta / (1 - alpha))
+        self.upper_bound = math.log((1 - beta) / alpha)
+
+        # 採択された仮説。"H0" , "H1" , まだ決まっていなければNone。
+        # 一度決まったら、そのあとcalc()を呼び出しても変化しない。
+        self.accepted = None
+
+        # LLRなどについてユーザーに見やすい形での文字列
+        self.pretty_string = ""
+
+    # public membersを設定して呼び出すと、public readonly membersのところに反映される。
+    def calc(self):
+        self.lower_bound = math.log(self.beta / (1 - self.alpha))
+        self.upper_bound = math.log((1 - self.beta) / self.alpha)
+        self.llr = Sprt.calc_llr(
+            self.player1_win, self.draw_games, self.player2_win, self.elo0, self.elo1
+        )
+
+        if self.accepted is None:
+            if self.llr <= self.lower_bound:
+                self.accepted = "H0"
+            elif self.llr >= self.upper_bound:
+                self.accepted = "H1"
+
+        self.pretty_string = "SPRT[{0},{1}] LLR {2:.2f} [{3:.2f},{4:.2f}]".format(
+            self.elo0, self.elo1, self.llr, self.lower_bound, self.upper_bound
+        )
+        if self.accepted is not None:
+            self.pretty_string += " " + self.accepted + " accepted"
+
+    # 勝ち・引き分け・負けの回数から、H0(レーティング差elo0)に対するH1(レーティング差elo1)の対数尤度比を返す。
+    @staticmethod
+    def calc_llr(
+        win: float, draw: float, lose: float, elo0: float, elo1: float
+    ) -> float:
+        # 勝ちか負けが1つもないと分散が0になって見積もれないので、勝ちと負けに0.5局ずつ足しておく。
+        # (実力差が大きくて全勝するようなときにも、打ち切れるように)
+        if win == 0 or lose == 0:
+            win += 0.5
+            lose += 0.5
+        n = win + draw + lose
+
+        # 1局あたりの得点の平均と分散
+        score = (win + draw * 0.5) / n
+        variance = (
+            win * (1 - score) ** 2 + draw * (0.5 - score) ** 2 + lose * score ** 2
+        ) / n
+        if variance == 0:
+            return 0.0
+
+        # 各仮説での期待得点
+        s0 = Sprt.calc_score(elo0)
+        s1 = Sprt.calc_score(elo1)
+        return n * (s1 - s0) * (2 * score - s0 - s1) / (2 * variance)
+
+    # レーティング差から期待得点(勝率)を返す。EloRating.calc_rating()の逆関数。
+    @staticmethod
+    def calc_score(elo: float) -> float:
+        return 1 / (1 + 10 ** (-elo / 400))
@@ -0,0 +1,194 @@
+import math
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 複数のエンジンの対局結果から、全エンジンのレーティングを最尤推定するためのモジュール。(Bradley–Terryモデル)
+#
+# エンジンiがエンジンjに勝つ確率を 1 / (1 + 10^(-(Ri - Rj) / 400)) とし、
+# これまでのすべての対局結果の尤度が最大になるようなレーティングRを、ニュートン法で求める。
+# 引き分けは0.5勝0.5敗として扱う。
+#
+# 対局結果はエンジンの組ごとに勝ち・引き分け・負けの数に集計してから計算するので、
+# 計算量は対局数によらず、エンジンの数だけで決まる。(数十エンジンなら数十万局でも一瞬で終わる)
+
+# Elo 1点あたりの対数オッズ(ln(10) / 400)
+ELO_SCALE = math.log(10) / 400
+
+# 信頼区間(95%)の幅の、標準誤差に対する倍率
+CONFIDENCE_Z = 1.959964
+
+# 対局したエンジンの組ごとに加える、仮想的な引き分けの数。
+# 全勝・全敗の組があっても、レーティングが無限大に発散しないようにする。
+PRIOR_DRAWS = 1.0
+
+# 各エンジンのレーティングの事前分布(初期値を中心とする正規分布)の標準偏差。
+# 基準となるエンジン(固定レーティング)と対局がつながっていないエンジンがあっても、解が定まるようにする。
+# 対局結果に比べれば十分に弱い制約にしておく。
+PRIOR_SD = 1000.0
+
+
+# エンジンの組ごとに、対局結果を集計しておくクラス。
+# ファイルに1行ずつ追記して保存しておけば、あとから読み込んですべての対局結果を復元できる。
+# ファイルの各行は "エンジン1<TAB>エンジン2<TAB>エンジン1の勝ち数<TAB>引き分け数<TAB>エンジン2の勝ち数"
+class GameResultTable:
+    def __init__(self):
+
+        # --- public readonly members ---
+
+        # (エンジン1 , エンジン2) -> [エンジン1の勝ち数 , 引き分け数 , エンジン2の勝ち数]
+        # keyはエンジン名の小さいほうが先になるようにしてある。
+        self.results: Dict[Tuple[str, str], List[int]] = {}
+
+    # 対局結果を加える。
+    def add(self, player1: str, player2: str, win: int, draw: int, lose: int):
+        if player1 > player2:
+            player1, player2, win, lose = player2, player1, lose, win
+        counts = self.results.setdefault((player1, player2), [0, 0, 0])
+        counts[0] += win
+        counts[1] += draw
+        counts[2] += lose
+
+    # 対局結果をファイルから読み込んで加える。ファイルがなければ何もしない。
+    def load(self, path: str):
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                tokens = line.rstrip("\n").split("\t")
+                if len(tokens) != 5:
+                    continue
+                self.add(tokens[0], tokens[1], *map(int, tokens[2:]))
+
+    # 対局結果を加えて、ファイルにも追記する。
+    def append(
+        self, path: str, player1: str, player2: str, win: int, draw: int, lose: int
+    ):
+        self.add(player1, player2, win, draw, lose)
+        tokens = [player1, player2, str(win), str(draw), str(lose)]
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("\t".join(tokens) + "\n")
+
+    # 対局結果のあるエンジンの名前
+    def players(self) -> List[str]:
+        names = set()
+        for player1, player2 in self.results:
+            names.add(player1)
+            names.add(player2)
+        return sorted(names)
+
+    # 対局数の合計
+    def total_games(self) -> int:
+        return sum(sum(counts) for counts in self.results.values())
+
+
+# GameResultTableの対局結果から、すべてのエンジンのレーティングを最尤推定する。
+# initial_ratings : 各エンジンの初期値(事前分布の中心)。含まれていないエンジンはdefault_rating。
+# fixed_ratings : レーティングを固定するエンジン(rating_fix)。これが基準になる。
+# 返し値 : エンジン名 -> (レーティング , 95%信頼区間の幅(±)) 。固定したエンジンの幅は0。
+def fit_ratings(
+    table: GameResultTable,
+    initial_ratings: Optional[Dict[str, float]] = None,
+    fixed_ratings: Optional[Dict[str, float]] = None,
+    default_rating: float = 1500,
+    max_iterations: int = 100,
+) -> Dict[str, Tuple[float, float]]:
+    initial_ratings = initial_ratings if initial_ratings is not None else {}
+    fixed_ratings = fixed_ratings if fixed_ratings is not None else {}
+
+    names = sorted(set(table.players()) | set(initial_ratings) | set(fixed_ratings))
+    ratings = [
+        fixed_ratings.get(n, initial_ratings.get(n, default_rating)) for n in names
+    ]
+    prior = list(ratings)
+
+    # 推定するエンジン(固定していないもの)の、namesでの位置 -> 推定する変数の番号
+    free = [i for i, n in enumerate(names) if n not in fixed_ratings]
+    variable = {i: k for k, i in enumerate(free)}
+
+    # 組ごとの (i , j , 対局数 , iの得点)
+    index = {n: i for i, n in enumerate(names)}
+    pairs = []
+    for (player1, player2), (win, draw, lose) in table.results.items():
+        games = win + draw + lose
+        if games == 0:
+            continue
+        pairs.append(
+            (
+                index[player1],
+                index[player2],
+                games + PRIOR_DRAWS,
+                win + (draw + PRIOR_DRAWS) * 0.5,
+            )
+        )
+
+    prior_precision = 1 / PRIOR_SD ** 2
+    hessian: List[List[float]] = []
+    for _ in range(max_iterations):
+        # 対数尤度の勾配と、ヘッシアンの符号を反転させたもの(正定値)
+        gradient = [-(ratings[i] - prior[i]) * prior_precision for i in free]
+        hessian = [[0.0] * len(free) for _ in free]
+        for k in range(len(free)):
+            hessian[k][k] = prior_precision
+
+        for i, j, games, score in pairs:
+            p = 1 / (1 + math.exp(-ELO_SCALE * (ratings[i] - ratings[j])))
+            g = ELO_SCALE * (score - games * p)
+            h = ELO_SCALE * ELO_SCALE * games * p * (1 - p)
+            vi = variable.get(i)
+            vj = variable.get(j)
+            if vi is not None:
+                gradient[vi] += g
+                hessian[vi][vi] += h
+            if vj is not None:
+                gradient[vj] -= g
+                hessian[vj][vj] += h
+            if vi is not None and vj is not None:
+                hessian[vi][vj] -= h
+                hessian[vj][vi] -= h
+
+        if not free:
+            break
+        step = solve_cholesky(cholesky(hessian), gradient)
+        for k, i in enumerate(free):
+            ratings[i] += step[k]
+        if max(abs(s) for s in step) < 1e-4:
+            break
+
+    # 信頼区間は、ヘッシアンの逆行列(共分散行列)の対角成分から求める。
+    errors = [0.0] * len(names)
+    if free:
+        factor = cholesky(hessian)
+        for k, i in enumerate(free):
+            unit = [0.0] * len(free)
+            unit[k] = 1.0
+            variance = solve_cholesky(factor, unit)[k]
+            errors[i] = CONFIDENCE_Z * math.sqrt(max(variance, 0.0))
+
+    return {n: (ratings[i], errors[i]) for i, n in enumerate(names)}
+
+
+# 正定値対称行列aをコレスキー分解して、下三角行列lを返す。(a = l × lの転置)
+def cholesky(a: List[List[float]]) -> List[List[float]]:
+    n = len(a)
+    l = [[0.0] * n for _ in range(n)]
+    for i in range(n):
+        row = l[i]
+        for j in range(i + 1):
+            other = l[j]
+            s = a[i][j] - sum(row[k] * other[k] for k in range(j))
+            if i == j:
+                row[i] = math.sqrt(max(s, 1e-300))
+            else:
+                row[j] = s / other[j]
+    return l
+
+
+# cholesky()で分解した行列について、連立一次方程式 a × x = b を解く。
+def solve_cholesky(l: List[List[float]], b: Iterable[float]) -> List[float]:
+    n = len(l)
+    y = list(b)
+    for i in range(n):
+        y[i] = (y[i] - sum(l[i][k] * y[k] for k in range(i))) / l[i][i]
+    for i in reversed(range(n)):
+        y[i] = (y[i] - sum(l[k][i] * y[k] for k in range(i + 1, n))) / l[i][i]
+    return y
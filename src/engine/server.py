@@ -1,11 +1,17 @@
 import time
 import threading
+from queue import Queue
+from typing import List, Optional, Tuple
 
 from src.engine.engine import UsiEngine
-from src.engine.enums import Turn
+from src.engine.enums import Turn, UsiInfoCaptureLevel, WatchdogPolicy
 from src.engine.game_result import GameResult
+from src.engine.kifu import build_sfen, get_side_to_move, split_sfen
 from src.engine.scanner import Scanner
 
+# 応答しなくなったエンジンを起動しなおしたときに、"readyok"が返ってくるのを待つ時間の上限[s]
+RESTART_READY_TIMEOUT = 60.0
+
 
 # 1対1での対局を管理してくれる補助クラス
 class AyaneruServer:
@@ -17,7 +23,7 @@ class AyaneruServer:
         # デフォルトでは先手が1P側、後手が2P側になる。
         # self.flip_turn == Trueのときはこれが反転する。
         # ※　与えた開始局面のsfenが先手番から始まるとは限らないので注意。
-        self.engines = [UsiEngine(), UsiEngine()]
+        self.engines = [self.create_engine(), self.create_engine()]
 
         # デフォルト、0.1秒対局
         self.set_time_setting("byoyomi 100")
@@ -37,13 +43,30 @@ class AyaneruServer:
         # これをgame_start()呼び出し前にTrueにしておくと、エンジンから"Error xxx"と送られてきたときにその内容が標準出力に出力される。
         self.error_print = False
 
+        # エンジンから送られてきた"info"をどこまで解釈するか。game_start()のときにエンジンに設定される。
+        # 自己対局では"bestmove"直前の読み筋しか使わないので、デフォルトではそれだけを解釈する。
+        self.info_capture_level = UsiInfoCaptureLevel.FinalOnly
+
+        # 1手ごとの監視(watchdog)で、その手で使える時間(残り持ち時間 + 秒読み + inc)に加えて待つ時間[s]。
+        # これを過ぎても"bestmove"が返ってこないか、エンジンが異常終了したら、エンジンを終了させて起動しなおし、
+        # その対局はwatchdog_policyに従って終局させる。Noneなら無制限に待つ。
+        self.watchdog_margin: Optional[float] = 10.0
+
+        # 応答しなくなったエンジンがあったときの対局の扱い。
+        # VoidGame : 対局を無効にする(game_resultはSTOP_GAMEになる) , Loss : 応答しなくなった側の負けにする
+        self.watchdog_policy = WatchdogPolicy.VoidGame
+
         # --- publc readonly members
 
         # 現在の手番側
         self.side_to_move = Turn.BLACK
 
-        # 現在の局面のsfen("startpos moves ..."や、"sfen ... move ..."の形)
-        self.sfen = "startpos"
+        # 開始局面("startpos"や、"sfen ..."の形)
+        self.start_position = "startpos"
+
+        # 開始局面からの指し手("7g7f"のようなUSI表記)
+        # 現在の局面のsfenはself.sfenで取得できる。
+        self.moves: List[str] = []
 
         # 初期局面からの手数
         self.game_ply = 1
@@ -52,6 +75,19 @@ class AyaneruServer:
         # ゲームが終了したら、game_result.is_gameover() == Trueになる。
         self.game_result = GameResult.INIT
 
+        # 現在の対局を開始した時刻(time.time()の値)
+        self.game_start_time = 0.0
+
+        # 現在の対局で、1手に使った時間がその手で使える時間(残り持ち時間 + 秒読み)を最も超過した量[ms]。
+        # 超過していなければ0。負荷が高すぎて、エンジンが時間どおりに指せていないかの目安になる。
+        self.max_overshoot = 0
+
+        # 現在の対局が時間切れで終局したか。
+        self.timeup = False
+
+        # 現在の対局で、応答しなくなって起動しなおしたエンジンのplayer番号(0 : 1P側 , 1 : 2P側)。なければNone。
+        self.hung_player: Optional[int] = None
+
         # --- private memebers ---
 
         # 持ち時間残り [1P側 , 2P側] 単位はms。
@@ -67,6 +103,23 @@ class AyaneruServer:
         # 対局用スレッドの強制停止フラグ
         self.stop_thread: threading.Thread = False
 
+        # 対局が終了したときに、このserver自身がputされるqueue。
+        # MultiAyaneruServerが設定して、終局の通知を受け取るのに用いる。
+        # Noneならば通知しない。
+        self.game_over_queue: Optional[Queue] = None
+
+    # 現在の局面のsfen("startpos moves ..."や、"sfen ... moves ..."の形)
+    # self.start_position , self.movesから、エンジンに送るときに一度だけ組み立てる。
+    # (1手ごとに文字列を連結していくと、そのたびに全体をコピーすることになる)
+    @property
+    def sfen(self) -> str:
+        return build_sfen(self.start_position, self.moves)
+
+    # 1P側、2P側のエンジンを生成する。
+    # 派生クラスでUsiEngine以外のエンジンを使いたいときはこれをoverrideする。
+    def create_engine(self) -> UsiEngine:
+        return UsiEngine()
+
     # turn側のplayer番号を取得する。(flip_turnを考慮する。)
     # 返し値
     # 0 : 1P側
@@ -154,39 +207,57 @@ class AyaneruServer:
     # 例 : "startpos" , "startpos moves 7f7g" , "sfen ..." , "sfen ... moves ..."など。
     # start_gameply : start_sfenの開始手数。0を指定すると末尾の局面から。
     def game_start(self, start_sfen: str = "startpos", start_gameply: int = 0):
+        self.setup_game(start_sfen, start_gameply)
+        self.begin_game()
+
+        for engine in self.engines:
+            engine.send_command("usinewgame")  # いまから対局はじまるよー
+
+        # 前回の対局スレッドは、game_over()で終局を通知したあと、終了処理の途中である可能性があるので
+        # ここで終了を待っておく。(すぐに終わるはず)
+        if (
+            self.game_thread is not None
+            and self.game_thread is not threading.current_thread()
+        ):
+            self.game_thread.join()
+
+        # 対局用のスレッドを作成するのがお手軽か..
+        self.game_thread = threading.Thread(target=self.game_worker)
+        self.game_thread.start()
+
+    # game_start()の下請け。開始局面と手番を設定して、エンジンの接続を確認する。
+    # 手番は開始局面のsfenと手数から求めるので、エンジンに問い合わせる必要はない。
+    def setup_game(self, start_sfen: str, start_gameply: int):
 
         # ゲーム対局中ではないか？これは前提条件の違反
         if self.game_result == GameResult.PLAYING:
             raise ValueError("must be gameover.")
 
         # 局面の設定
-        sfen = start_sfen
-        if "moves" not in sfen:
-            sfen += " moves"
+        self.start_position, moves = split_sfen(start_sfen)
 
         # 開始手数。0なら無視(末尾の局面からなので)
         if start_gameply != 0:
-            sp = sfen.split()
-            # "moves"の文字列は上で追加しているので必ず存在すると仮定できる。
-            index = min(sp.index("moves") + start_gameply - 1, len(sp) - 1)
-            # sp[0]からsp[index]までの文字列を連結する。
-            sfen = " ".join(sp[0 : index + 1])
+            moves = moves[0 : max(start_gameply - 1, 0)]
 
-        self.sfen = sfen
+        self.moves = moves
+        self.side_to_move = get_side_to_move(self.start_position, len(moves))
 
         for engine in self.engines:
             if not engine.is_connected():
                 raise ValueError("engine is not connected.")
             engine.debug_print = self.debug_print
             engine.error_print = self.error_print
+            engine.info_capture_level = self.info_capture_level
 
-        # 1P側のエンジンを使って、現局面の手番を得る。
-        self.side_to_move = self.engines[0].get_side_to_move()
+    # game_start()の下請け。ゲームの状態を初期化する。
+    def begin_game(self):
         self.game_ply = 1
         self.game_result = GameResult.PLAYING
-
-        for engine in self.engines:
-            engine.send_command("usinewgame")  # いまから対局はじまるよー
+        self.game_start_time = time.time()
+        self.max_overshoot = 0
+        self.timeup = False
+        self.hung_player = None
 
         # 開始時 持ち時間
         self.rest_time = [
@@ -194,10 +265,6 @@ class AyaneruServer:
             self.time_setting["time2p"],
         ]
 
-        # 対局用のスレッドを作成するのがお手軽か..
-        self.game_thread = threading.Thread(target=self.game_worker)
-        self.game_thread.start()
-
     # 対局スレッド
     def game_worker(self):
 
@@ -207,74 +274,26 @@ class AyaneruServer:
             engine = self.engine(self.side_to_move)
             engine.usi_position(self.sfen)
 
-            # 現在の手番側["1p" or "2p]の時間設定
-            byoyomi_str = "byoyomi" + self.player_str(self.side_to_move)
-            inctime_str = "inc" + self.player_str(self.side_to_move)
-            inctime = self.time_setting[inctime_str]
-
-            # inctimeが指定されていないならbyoymiを付与
-            if inctime == 0:
-                byoyomi_or_inctime_str = "byoyomi {0}".format(
-                    self.time_setting[byoyomi_str]
-                )
-            else:
-                byoyomi_or_inctime_str = "binc {0} winc {1}".format(
-                    self.time_setting["inc" + self.player_str(Turn.BLACK)],
-                    self.time_setting["inc" + self.player_str(Turn.WHITE)],
-                )
-
             start_time = time.time()
-            engine.usi_go_and_wait_bestmove(
-                f"btime {self.get_rest_time(Turn.BLACK)} wtime {self.get_rest_time(Turn.WHITE)} {byoyomi_or_inctime_str}"
-            )
+            if not engine.usi_go_and_wait_bestmove(
+                self.go_options(), self.move_timeout()
+            ):
+                # 時間内に"bestmove"が返ってこなかったか、エンジンが異常終了した。
+                self.engine_hung(engine)
+                return
             end_time = time.time()
 
-            # 使用した時間を1秒単位で繰り上げて、残り時間から減算
-            # プロセス間の通信遅延を考慮して300[ms]ほど引いておく。(秒読みの場合、どうせ使い切るので問題ないはず..)
-            # 0.3秒以内に指すと0秒で指したことになるけど、いまのエンジン、詰みを発見したとき以外そういう挙動にはなりにくいのでまあいいや。
-            elapsed_time = (end_time - start_time) - 0.3  # [ms]に変換
-            elapsed_time = int(elapsed_time + 0.999) * 1000
-            if elapsed_time < 0:
-                elapsed_time = 0
-
-            # 現在の手番を数値化したもの。1P側=0 , 2P側=1
-            int_turn = self.player_number(self.side_to_move)
-            self.rest_time[int_turn] -= int(elapsed_time)
-            if (
-                self.rest_time[int_turn] + self.time_setting[byoyomi_str] < -2000
-            ):  # 秒読み含めて-2秒より減っていたら。0.1秒対局とかもあるので1秒繰り上げで引いていくとおかしくなる。
-                self.game_result = GameResult.from_win_turn(self.side_to_move.flip())
+            if self.consume_time(end_time - start_time):
                 self.game_over()
                 # 本来、自己対局では時間切れになってはならない。(計測が不確かになる)
                 # 警告を表示しておく。
                 print("Error! : player timeup")
                 return
-            # 残り時間がマイナスになっていたら0に戻しておく。
-            if self.rest_time[int_turn] < 0:
-                self.rest_time[int_turn] = 0
-
-            bestmove = engine.think_result.bestmove
-            if bestmove == "resign":
-                # 相手番の勝利
-                self.game_result = GameResult.from_win_turn(self.side_to_move.flip())
-                self.game_over()
-                return
-            if bestmove == "win":
-                # 宣言勝ち(手番側の勝ち)
-                # 局面はノーチェックだが、まあエンジン側がバグっていなければこれでいいだろう)
-                self.game_result = GameResult.from_win_turn(self.side_to_move)
+
+            if self.apply_bestmove(engine.think_result.bestmove):
                 self.game_over()
                 return
 
-            self.sfen = self.sfen + " " + bestmove
-            self.game_ply += 1
-
-            # inctime分、時間を加算
-            self.rest_time[int_turn] += inctime
-            self.side_to_move = self.side_to_move.flip()
-            # 千日手引き分けを処理しないといけないが、ここで判定するのは難しいので
-            # max_movesで抜けることを期待。
-
             if self.stop_thread:
                 # 強制停止なので試合内容は保証されない
                 self.game_result = GameResult.STOP_GAME
@@ -284,25 +303,168 @@ class AyaneruServer:
         self.game_result = GameResult.MAX_MOVES
         self.game_over()
 
+    # 手番側のエンジンに送る"go"コマンドのパラメーター文字列を返す。
+    def go_options(self) -> str:
+        # 現在の手番側["1p" or "2p]の時間設定
+        byoyomi_str = "byoyomi" + self.player_str(self.side_to_move)
+        inctime_str = "inc" + self.player_str(self.side_to_move)
+        inctime = self.time_setting[inctime_str]
+
+        # inctimeが指定されていないならbyoymiを付与
+        if inctime == 0:
+            byoyomi_or_inctime_str = "byoyomi {0}".format(
+                self.time_setting[byoyomi_str]
+            )
+        else:
+            byoyomi_or_inctime_str = "binc {0} winc {1}".format(
+                self.time_setting["inc" + self.player_str(Turn.BLACK)],
+                self.time_setting["inc" + self.player_str(Turn.WHITE)],
+            )
+
+        return f"btime {self.get_rest_time(Turn.BLACK)} wtime {self.get_rest_time(Turn.WHITE)} {byoyomi_or_inctime_str}"
+
+    # 手番側のエンジンが"bestmove"を返すのを待つ時間の上限[s]。watchdog_margin == NoneならNone。
+    def move_timeout(self) -> Optional[float]:
+        if self.watchdog_margin is None:
+            return None
+        player_str = self.player_str(self.side_to_move)
+        budget = (
+            self.get_rest_time(self.side_to_move)
+            + self.time_setting["byoyomi" + player_str]
+            + self.time_setting["inc" + player_str]
+        )
+        return budget / 1000 + self.watchdog_margin
+
+    # 手番側のエンジンが応答しなくなったときの処理。
+    # エンジンを強制終了させて同じ設定で起動しなおし、watchdog_policyに従って対局を終了させる。
+    # (起動しなおしたエンジンが"readyok"を返さなければ、終了させたままにする)
+    def engine_hung(self, engine: UsiEngine):
+        self.hung_player = self.player_number(self.side_to_move)
+        print("Error! : engine is not responding , " + engine.engine_path)
+        engine.kill()
+        # connect()するとstderr_bufferが作り直されるので、その前に最後の数行を表示しておく。
+        for line in engine.get_stderr()[-5:]:
+            print("  stderr : " + line)
+        try:
+            engine.connect(engine.engine_path)
+            if not engine.wait_ready(RESTART_READY_TIMEOUT):
+                engine.kill()
+        except OSError as e:
+            print("Error! : {0}".format(e))
+        if not engine.is_connected():
+            print("Error! : engine restart failed , " + engine.engine_path)
+
+        if self.stop_thread:
+            self.game_result = GameResult.STOP_GAME
+            return
+
+        # 相手側のエンジンにだけ終局を通知する。
+        opponent = self.engine(self.side_to_move.flip())
+        if self.watchdog_policy == WatchdogPolicy.Loss:
+            self.game_result = GameResult.from_win_turn(self.side_to_move.flip())
+            opponent.send_command("gameover win")
+        else:
+            self.game_result = GameResult.STOP_GAME
+            opponent.send_command("gameover draw")
+        self.notify_game_over()
+
+    # 手番側が思考に使った時間を持ち時間から減算する。
+    # elapsed_time : "go"を送ってから"bestmove"が返ってくるまでの時間[s]
+    # 返し値 : 時間切れになったならTrue。このときgame_resultは設定済み。
+    def consume_time(self, elapsed_time: float) -> bool:
+        byoyomi_str = "byoyomi" + self.player_str(self.side_to_move)
+
+        # 現在の手番を数値化したもの。1P側=0 , 2P側=1
+        int_turn = self.player_number(self.side_to_move)
+
+        # この手で使える時間をどれだけ超過したか
+        overshoot = int(elapsed_time * 1000) - (
+            self.rest_time[int_turn] + self.time_setting[byoyomi_str]
+        )
+        self.max_overshoot = max(self.max_overshoot, overshoot)
+
+        # 使用した時間を1秒単位で繰り上げて、残り時間から減算
+        # プロセス間の通信遅延を考慮して300[ms]ほど引いておく。(秒読みの場合、どうせ使い切るので問題ないはず..)
+        # 0.3秒以内に指すと0秒で指したことになるけど、いまのエンジン、詰みを発見したとき以外そういう挙動にはなりにくいのでまあいいや。
+        elapsed_time = elapsed_time - 0.3  # [ms]に変換
+        elapsed_time = int(elapsed_time + 0.999) * 1000
+        if elapsed_time < 0:
+            elapsed_time = 0
+
+        self.rest_time[int_turn] -= int(elapsed_time)
+        if (
+            self.rest_time[int_turn] + self.time_setting[byoyomi_str] < -2000
+        ):  # 秒読み含めて-2秒より減っていたら。0.1秒対局とかもあるので1秒繰り上げで引いていくとおかしくなる。
+            self.game_result = GameResult.from_win_turn(self.side_to_move.flip())
+            self.timeup = True
+            return True
+        # 残り時間がマイナスになっていたら0に戻しておく。
+        if self.rest_time[int_turn] < 0:
+            self.rest_time[int_turn] = 0
+        return False
+
+    # 手番側のエンジンから返ってきたbestmoveで局面を進める。
+    # 返し値 : 投了・宣言勝ちで終局したならTrue。このときgame_resultは設定済み。
+    def apply_bestmove(self, bestmove: str) -> bool:
+        if bestmove == "resign":
+            # 相手番の勝利
+            self.game_result = GameResult.from_win_turn(self.side_to_move.flip())
+            return True
+        if bestmove == "win":
+            # 宣言勝ち(手番側の勝ち)
+            # 局面はノーチェックだが、まあエンジン側がバグっていなければこれでいいだろう)
+            self.game_result = GameResult.from_win_turn(self.side_to_move)
+            return True
+
+        self.moves.append(bestmove)
+        self.game_ply += 1
+
+        # inctime分、時間を加算
+        int_turn = self.player_number(self.side_to_move)
+        self.rest_time[int_turn] += self.time_setting[
+            "inc" + self.player_str(self.side_to_move)
+        ]
+        self.side_to_move = self.side_to_move.flip()
+        # 千日手引き分けを処理しないといけないが、ここで判定するのは難しいので
+        # max_movesで抜けることを期待。
+        return False
+
     # ゲームオーバーの処理
     # エンジンに対してゲームオーバーのメッセージを送信する。
     def game_over(self):
+        for engine, message in self.game_over_messages():
+            engine.send_command(message)
+        self.notify_game_over()
+
+    # 終局時に、それぞれのエンジンに送信するメッセージを(engine , message)のlistで返す。
+    def game_over_messages(self) -> List[Tuple[UsiEngine, str]]:
         result = self.game_result
         if result.is_draw():
-            for engine in self.engines:
-                engine.send_command("gameover draw")
+            return [(engine, "gameover draw") for engine in self.engines]
         elif result.is_black_or_white_win():
             # resultをそのままintに変換したほうの手番側が勝利
-            self.engine(Turn(result)).send_command("gameover win")
-            self.engine(Turn(result).flip()).send_command("gameover lose")
+            return [
+                (self.engine(Turn(result)), "gameover win"),
+                (self.engine(Turn(result).flip()), "gameover lose"),
+            ]
         else:
             # それ以外サポートしてない
             raise ValueError("illegal result")
 
+    # 終局したことを通知する。
+    def notify_game_over(self):
+        if self.game_over_queue is not None:
+            self.game_over_queue.put_nowait(self)
+
+    # 対局用スレッドを停止させる。エンジンは終了させない。
+    def stop_game(self):
+        self.stop_thread = True
+        if self.game_thread is not None:
+            self.game_thread.join()
+
     # エンジンを終了させるなどの後処理を行う
     def terminate(self):
-        self.stop_thread = True
-        self.game_thread.join()
+        self.stop_game()
         for engine in self.engines:
             engine.disconnect()
 
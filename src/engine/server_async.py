@@ -0,0 +1,390 @@
+import asyncio
+import time
+from typing import Optional
+
+from src.engine.engine_async import AsyncUsiEngine
+from src.engine.enums import UsiEngineState, WatchdogPolicy
+from src.engine.game_result import GameResult
+from src.engine.server import RESTART_READY_TIMEOUT, AyaneruServer
+from src.engine.server_multi import MultiAyaneruServer
+
+
+# AyaneruServerのasyncio版。
+# 対局用のスレッドの代わりにtaskを用いる。エンジンはAsyncUsiEngineになる。
+# 持ち時間の管理などはAyaneruServerと共通。
+class AsyncAyaneruServer(AyaneruServer):
+    def __init__(self):
+        super().__init__()
+
+        # --- private members ---
+
+        # 対局用のtask
+        self.game_task: Optional[asyncio.Future] = None
+
+    def create_engine(self) -> AsyncUsiEngine:
+        return AsyncUsiEngine()
+
+    # [SYNC] ゲームを初期化して、対局を開始する。
+    # 引数の意味はAyaneruServer.game_start()と同じ。
+    # 対局の開始を待つだけで、対局の終了は待たない。
+    async def game_start(self, start_sfen: str = "startpos", start_gameply: int = 0):
+        self.setup_game(start_sfen, start_gameply)
+        self.begin_game()
+
+        for engine in self.engines:
+            await engine.send_command("usinewgame")  # いまから対局はじまるよー
+
+        # 前回の対局taskは、game_over()で終局を通知したあと、終了処理の途中である可能性があるので
+        # ここで終了を待っておく。
+        if (
+            self.game_task is not None
+            and self.game_task is not asyncio.current_task()
+        ):
+            await self.game_task
+
+        self.game_task = asyncio.ensure_future(self.game_worker())
+
+    # 対局task
+    async def game_worker(self):
+
+        while self.game_ply < self.moves_to_draw:
+            # 手番側に属するエンジンを取得する
+            engine = self.engine(self.side_to_move)
+            try:
+                await engine.usi_position(self.sfen)
+
+                start_time = time.time()
+                # watchdog_marginが設定されていれば、AyaneruServerと同じく持ち時間を過ぎても
+                # "bestmove"が返ってこないエンジンは応答しなくなったものとして扱う。
+                await asyncio.wait_for(
+                    engine.usi_go_and_wait_bestmove(self.go_options()),
+                    self.move_timeout(),
+                )
+                end_time = time.time()
+            except asyncio.TimeoutError:
+                # 手番側のエンジンが応答しなくなった。
+                # (Python 3.11以降はOSErrorの派生クラスなので、先に捕まえる)
+                await self.engine_disconnected(engine, None)
+                return
+            except (ValueError, OSError) as e:
+                # 対局中にエンジンが異常終了した。
+                await self.engine_disconnected(engine, e)
+                return
+
+            if self.consume_time(end_time - start_time):
+                await self.game_over()
+                print("Error! : player timeup")
+                return
+
+            if self.apply_bestmove(engine.think_result.bestmove):
+                await self.game_over()
+                return
+
+            if self.stop_thread:
+                # 強制停止なので試合内容は保証されない
+                self.game_result = GameResult.STOP_GAME
+                return
+
+        # 引き分けで終了
+        self.game_result = GameResult.MAX_MOVES
+        await self.game_over()
+
+    # [SYNC] 手番側のエンジンが対局中に異常終了したか、応答しなくなったときの処理。
+    # AyaneruServer.engine_hung()と同じく、強制終了させて同じ設定で起動しなおし、watchdog_policyに従って対局を終了させる。
+    # (起動しなおしたエンジンが"readyok"を返さなければ、終了させたままにする)
+    # error : 異常終了したときの例外。応答しなくなったときはNone。
+    async def engine_disconnected(
+        self, engine: AsyncUsiEngine, error: Optional[Exception]
+    ):
+        self.hung_player = self.player_number(self.side_to_move)
+        if error is None:
+            print("Error! : engine is not responding , " + engine.engine_path)
+        else:
+            print(
+                "Error! : engine disconnected , {0} : {1}".format(
+                    engine.engine_path, error
+                )
+            )
+        # connect()するとstderr_bufferが作り直されるので、その前に最後の数行を表示しておく。
+        await engine.kill()
+        for line in engine.get_stderr()[-5:]:
+            print("  stderr : " + line)
+        try:
+            await engine.connect(engine.engine_path)
+            await asyncio.wait_for(
+                engine.wait_for_state(UsiEngineState.WaitCommand),
+                RESTART_READY_TIMEOUT,
+            )
+        except (ValueError, asyncio.TimeoutError):
+            await engine.kill()
+        except OSError as e:
+            # (Python 3.11以降はasyncio.TimeoutErrorもOSErrorの派生クラスなので、先に捕まえてある)
+            print("Error! : {0}".format(e))
+            await engine.kill()
+        if not engine.is_connected():
+            print("Error! : engine restart failed , " + engine.engine_path)
+
+        if self.stop_thread:
+            self.game_result = GameResult.STOP_GAME
+            return
+
+        # 相手側のエンジンにだけ終局を通知する。
+        opponent = self.engine(self.side_to_move.flip())
+        if self.watchdog_policy == WatchdogPolicy.Loss:
+            self.game_result = GameResult.from_win_turn(self.side_to_move.flip())
+            await opponent.send_command("gameover win")
+        else:
+            self.game_result = GameResult.STOP_GAME
+            await opponent.send_command("gameover draw")
+        self.notify_game_over()
+
+    # [SYNC] ゲームオーバーの処理
+    # エンジンに対してゲームオーバーのメッセージを送信する。
+    async def game_over(self):
+        for engine, message in self.game_over_messages():
+            await engine.send_command(message)
+        self.notify_game_over()
+
+    # [SYNC] エンジンを終了させるなどの後処理を行う
+    async def terminate(self):
+        self.stop_thread = True
+        if self.game_task is not None:
+            await self.game_task
+            self.game_task = None
+        for engine in self.engines:
+            await engine.disconnect()
+
+    # terminate()はcoroutineなので、デストラクタからは呼び出せない。
+    # 明示的にawait terminate()すること。
+    def __del__(self):
+        pass
+
+
+# MultiAyaneruServerのasyncio版。
+# 1つのevent loopの上で、多数の対局を並列に行う。
+class AsyncMultiAyaneruServer(MultiAyaneruServer):
+    def __init__(self):
+        super().__init__()
+
+        # --- private members ---
+
+        # 対局監視用のtask
+        self.game_task: Optional[asyncio.Future] = None
+
+        # total_gamesが変化したときのイベント用
+        # 変化するごとにset()する。待つ側は、条件を調べてからclear()して待つ。
+        self.total_games_event: Optional[asyncio.Event] = None
+
+    def create_server(self) -> AsyncAyaneruServer:
+        return AsyncAyaneruServer()
+
+    # [SYNC] init_serverのあと、1P側、2P側のエンジンを初期化する。
+    # すべてのサーバーのエンジンを同時に起動する。
+    async def init_engine(self, player: int, engine_path: str, engine_options: dict):
+        engines = [server.engines[player] for server in self.servers]
+        for engine in engines:
+            engine.set_engine_options(engine_options)
+        await asyncio.gather(*[engine.connect(engine_path) for engine in engines])
+
+    # [SYNC] すべての対局を開始する
+    # match_source , engine_pool , cpu_affinity , recycle_games , recycle_rss_growthには対応していないので、
+    # 設定されていたら例外をraiseする。
+    async def game_start(self):
+        if len(self.servers) == 0:
+            raise ValueError("No Servers. Must call init_server()")
+        for name in (
+            "match_source",
+            "engine_pool",
+            "cpu_affinity",
+            "recycle_games",
+            "recycle_rss_growth",
+        ):
+            if getattr(self, name):
+                raise ValueError(name + " is not supported by AsyncMultiAyaneruServer.")
+
+        self.reset_results()
+
+        # すべてのエンジンの起動を待って、起動に失敗したものを取り除く。
+        await self.wait_engines_ready()
+
+        self.game_stop_flag = False
+        self.game_over_queue = asyncio.Queue()
+        self.total_games_event = asyncio.Event()
+
+        flip = False
+        # それぞれの対局、1個ごとに先後逆でスタートしておく。
+        for server in self.servers:
+            server.game_over_queue = self.game_over_queue
+            server.flip_turn = flip
+            if self.flip_turn_every_game:
+                flip ^= True
+        await asyncio.gather(
+            *[self.start_server(server) for server in self.start_concurrency()]
+        )
+
+        self.game_task = asyncio.ensure_future(self.game_worker())
+
+    # [SYNC] すべてのエンジンから"readyok"が返ってくるのを待つ。(MultiAyaneruServer.wait_engines_ready()と同じ)
+    # すべてのエンジンを同時に待つので、engine_ready_timeoutがそのまま共通の期限になる。
+    async def wait_engines_ready(self):
+        async def wait_ready(engine: AsyncUsiEngine) -> bool:
+            try:
+                await asyncio.wait_for(
+                    engine.wait_for_state(UsiEngineState.WaitCommand),
+                    self.engine_ready_timeout,
+                )
+            except (ValueError, asyncio.TimeoutError):
+                return False
+            return True
+
+        ready = await asyncio.gather(
+            *[
+                asyncio.gather(*[wait_ready(engine) for engine in server.engines])
+                for server in self.servers
+            ]
+        )
+
+        servers = []
+        for server, engines_ready in zip(self.servers, ready):
+            if all(engines_ready):
+                servers.append(server)
+                continue
+            for engine, engine_ready in zip(server.engines, engines_ready):
+                if not engine_ready:
+                    await self.engine_failed(engine)
+            await server.terminate()
+        self.servers = servers
+
+        if len(self.servers) == 0:
+            raise ValueError("No engines are ready.")
+
+    # [SYNC] "readyok"が返ってこなかったエンジンを強制終了させて、failed_enginesに記録する。
+    # (MultiAyaneruServer.engine_failed()と同じ)
+    async def engine_failed(self, engine: AsyncUsiEngine):
+        self.add_failed_engine(engine)
+        await engine.kill()
+        for line in engine.get_stderr()[-5:]:
+            print("  stderr : " + line)
+
+    # [SYNC] game_start()で開始したすべての対局を停止させる。
+    async def game_stop(self):
+        if self.game_task is None:
+            raise ValueError("game task is not running.")
+        self.game_stop_flag = True
+        # 終局待ちで寝ている対局監視用のtaskを起こす。
+        self.game_over_queue.put_nowait(None)
+        await self.game_task
+        self.game_task = None
+        self.flush_kifu_sink()
+
+    # [SYNC] 終了した試合数がn以上になるまで待つ。
+    # SPRTで結論が出て対局が打ち切られたときは、n局に到達していなくてもそこで待つのをやめる。
+    # timeout : 最大の待ち時間[s]。Noneなら無制限に待つ。
+    # 返し値 : n局に到達したか、対局が打ち切られたならTrue。timeoutしたならFalse。
+    # 対局を続けられなくなったら(errorが設定されたら)例外をraise
+    async def wait_for_games(self, n: int, timeout: Optional[float] = None) -> bool:
+        async def wait():
+            while (
+                self.total_games < n and not self.is_finished() and self.error is None
+            ):
+                if self.total_games_event is None:
+                    self.total_games_event = asyncio.Event()
+                self.total_games_event.clear()
+                await self.total_games_event.wait()
+
+        try:
+            await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.raise_error()
+        return True
+
+    # 対局監視用のtask
+    async def game_worker(self):
+
+        while not self.game_stop_flag:
+            server = await self.game_over_queue.get()
+            if server is None or self.game_stop_flag:
+                continue
+            await self.restart_server(server)
+
+        # serverの解体もしておく。
+        await asyncio.gather(*[server.terminate() for server in self.servers])
+        self.servers = []
+
+    # 結果を集計、棋譜の保存
+    def count_result(self, server: AsyncAyaneruServer):
+        super().count_result(server)
+        self.notify_total_games()
+
+    # 対局を続けられなくなったときも、wait_for_games()で待っているものを起こす。
+    def set_error(self, error: str):
+        super().set_error(error)
+        self.notify_total_games()
+
+    # wait_for_games()で待っているものを起こす。
+    def notify_total_games(self):
+        event = self.total_games_event
+        if event is not None:
+            event.set()
+
+    # [SYNC] 対局サーバーを開始する。
+    # max_gamesに達していたら開始しない。
+    async def start_server(self, server: AsyncAyaneruServer):
+        if not self.reserve_game():
+            self.idle_servers.append(server)
+            return
+        await server.game_start(*self.next_game(server))
+
+    # [SYNC] 対局結果を集計して、サーバーを再開(次の対局を開始)させる。
+    async def restart_server(self, server: AsyncAyaneruServer):
+        void = server.game_result == GameResult.STOP_GAME
+        if server.hung_player is not None:
+            self.add_engine_hang(void)
+
+        if void:
+            # 無効にした対局は集計せずに、同じ手番でやり直す。
+            self.cancel_game(server)
+        else:
+            # 対局結果の集計
+            self.count_result(server)
+
+            # flip_turnを反転させておく。(1局ごとに手番を入れ替え)
+            if self.flip_turn_every_game:
+                server.flip_turn ^= True
+
+        # SPRTで結論が出ていたら再開しない。
+        if self.is_finished():
+            return
+
+        # エンジンを起動しなおせなかったなら、その対局サーバーは止めたままにする。
+        if not all(engine.is_connected() for engine in server.engines):
+            await self.stop_server(server)
+            return
+
+        # 終了していたので再開
+        # (並列数を調整するときは、止めたり、止めていたものも再開させたりする)
+        for s in self.adjust_concurrency(server):
+            await self.start_server(s)
+
+    # [SYNC] serverを止めたままにして、まだ開始していない対局は止めている他の対局サーバーに引き継がせる。
+    # (MultiAyaneruServer.stop_server()と同じ)
+    async def stop_server(self, server: AsyncAyaneruServer):
+        self.stopped_servers.append(server)
+        if self.game_stop_flag or self.is_finished():
+            return
+        if self.idle_servers:
+            await self.start_server(self.idle_servers.pop())
+        elif self.parked_servers:
+            await self.start_server(self.parked_servers.pop())
+        elif len(self.stopped_servers) >= len(self.servers):
+            self.set_error("all game servers stopped. engines could not be restarted.")
+
+    # [SYNC] 内包しているすべてのあやねるサーバーを終了させる。
+    async def terminate(self):
+        if self.game_task is not None:
+            await self.game_stop()
+
+    # terminate()はcoroutineなので、デストラクタからは呼び出せない。
+    def __del__(self):
+        pass
@@ -1,11 +1,29 @@
 import random
 import threading
 import time
+from collections import deque
+from queue import Queue
+from typing import Callable, Deque, Dict, List, Optional, Tuple
 
+from src.engine.book import OpeningBook
+from src.engine.concurrency import ConcurrencyController
+from src.engine.cpu_affinity import (
+    describe_topology,
+    format_cpu_list,
+    get_cpu_topology,
+    plan_cpu_sets,
+    set_process_group_affinity,
+)
+from src.engine.engine import UsiEngine
+from src.engine.engine_match import EngineMatch
+from src.engine.engine_pool import UsiEnginePool, get_process_rss, make_engine_key
+from src.engine.enums import UsiEngineState, UsiInfoCaptureLevel, WatchdogPolicy
 from src.engine.game_result import GameResult
 from src.engine.kifu import GameKifu
+from src.engine.kifu_sink import KifuSink
+from src.engine.pairing import PairedOpenings
 from src.engine.server import AyaneruServer
-from src.engine.rating import EloRating
+from src.engine.rating import EloRating, PairEloRating, Sprt
 
 
 # 並列自己対局のためのクラス
@@ -21,22 +39,127 @@ class MultiAyaneruServer:
         # 0を指定すると末尾の局面から。
         self.start_gameply = 1
 
+        # 定跡ファイル。設定されていればstart_sfensの代わりにこちらから開始局面を選ぶ。
+        # 開始局面はOpeningBookの生成時にその開始手数で切り詰められているので、start_gameplyは用いない。
+        self.book: Optional[OpeningBook] = None
+
         # 1ゲームごとに手番を入れ替える。
         self.flip_turn_every_game = True
 
+        # Trueにすると、開始局面を重複なく選んで、それぞれ先後を入れ替えて2局ずつ対局させる。
+        # 戦績は2局1組(pentanomial)でも集計され、game_rating()はそれから信頼区間を求めるようになる。
+        # (開始局面の有利不利が打ち消しあうので、同じ信頼度を得るのに必要な対局数が少なくて済む)
+        # このときflip_turn_every_gameは用いない。
+        self.paired_openings = False
+
         # これをinit_server()呼び出し前にTrueにしておくと、エンジンの通信内容が標準出力に出力される。
         self.debug_print = False
 
         # これをinit_server()呼び出し前にTrueにしておくと、エンジンから"Error xxx"と送られてきたときにその内容が標準出力に出力される。
         self.error_print = False
 
+        # エンジンから送られてきた"info"をどこまで解釈するか。init_server()呼び出し前に設定すること。
+        self.info_capture_level = UsiInfoCaptureLevel.FinalOnly
+
+        # 終局した対局の棋譜の書き出し先。Noneなら書き出さない。
+        # 設定しておくと、終局するごとに棋譜がKifuSink.write()で書き出される。
+        self.kifu_sink: Optional[KifuSink] = None
+
+        # game_kifusに保持しておく棋譜の数の上限。(最新のものから、この数だけ保持する)
+        # Noneなら無制限。kifu_sinkでファイルに書き出すときは、0にしておけばメモリを消費しない。
+        self.game_kifus_limit: Optional[int] = None
+
+        # エンジンのpool。設定されていれば、init_engine()ではここからエンジンを借りて、
+        # 対局サーバーの解体時にエンジンを終了させずに返却する。init_engine()呼び出し前に設定すること。
+        # (あやねるゲートのように、MultiAyaneruServerを何度も作り直すときに、エンジンの起動時間を節約できる。)
+        self.engine_pool: Optional[UsiEnginePool] = None
+
+        # game_start()のときに、すべてのエンジンから"readyok"が返ってくるのを待つ時間の上限[s]。Noneなら無制限。
+        # これを超えても"readyok"が返ってこないエンジンは起動に失敗したものとして、そのエンジンを用いる対局サーバーは取り除く。
+        self.engine_ready_timeout: Optional[float] = 60.0
+
+        # Trueにすると、game_start()のときに対局サーバーごとに互いに重ならないCPUの集合を割り当てて、
+        # 先後のエンジンのプロセスをそのCPUでだけ動くようにする。(Linuxのみ)
+        # 1つの対局サーバーに割り当てるCPUの数は、エンジンオプションの"Threads"の大きいほう。
+        self.cpu_affinity = False
+
+        # cpu_affinity == Trueのときに、1つの対局サーバーに割り当てるCPUの数。
+        # Noneならエンジンオプションの"Threads"の大きいほう。
+        # (match_sourceで対局中にエンジンを入れ替えるときは、すべてのエンジンの"Threads"の最大値にしておくとよい)
+        self.cpu_threads: Optional[int] = None
+
+        # cpu_affinity == Trueのときに、対局サーバーごとに割り当てるCPUの集合。
+        # Noneならgame_start()のときにCPUのtopologyから決める。(Noneの要素はその対局サーバーには割り当てない)
+        self.cpu_sets: Optional[List[Optional[List[int]]]] = None
+
+        # 対局中に並列数を増減させるためのもの。Noneなら並列数は固定。
+        # 設定されていれば、対局が終わるごとに、時間の超過具合に応じて対局サーバーを止めたり再開したりする。
+        self.concurrency_controller: Optional[ConcurrencyController] = None
+
+        # 逐次確率比検定(SPRT)。設定されていれば、1局終わるごとに1P側と2P側の戦績から対数尤度比を計算して、
+        # H0かH1が採択されたら新たな対局は開始しない。game_info()にも対数尤度比が含まれるようになる。
+        self.sprt: Optional[Sprt] = None
+
+        # 開始する対局数の上限。Noneなら無制限。
+        # 設定されていれば、ちょうどこの数だけ対局を開始して、それ以降は終局した対局サーバーを再開させない。
+        # wait_for_games(max_games)で待ってからgame_stop()すれば、途中で打ち切られて集計されない対局はなくなる。
+        self.max_games: Optional[int] = None
+
+        # 対局させるエンジンの組(EngineMatch)を返す関数。Noneなら、すべての対局サーバーでinit_engine()のエンジンを対局させる。
+        # 設定されていれば、init_engine()は呼び出さなくてよい。game_start()のときと、
+        # 対局サーバーがそれまでの組のgames局を開始し終わったときに呼び出され、その対局サーバーのエンジンを入れ替えて
+        # 返された組を対局させる。(エンジンの入れ替えは別スレッドで行うので、その間も他の対局サーバーは対局を続ける)
+        # これにより、異なるエンジンの組の対局を同時に行える。Noneを返したら、その対局サーバーは止めたままにする。
+        # 対局監視用のスレッドや、エンジンを入れ替える(起動しなおす)スレッドから呼び出される。
+        # 呼び出しはlockして1つずつ行うので、スレッドセーフでなくともよいが、時間のかかる処理はしないこと。
+        # 組ごとの戦績はEngineMatchに集計され、すべての対局が終わった組はpop_finished_matches()で取得できる。
+        # (total_gamesやgame_rating()などは、すべての組の合計になる)
+        self.match_source: Optional[Callable[[], Optional[EngineMatch]]] = None
+
+        # 1手ごとの監視(watchdog)で、その手で使える時間に加えて待つ時間[s]と、応答しなくなったエンジンがあったときの対局の扱い。
+        # init_server()呼び出し前に設定すること。(AyaneruServer.watchdog_margin , watchdog_policyを参照)
+        # VoidGameなら、その対局は集計せずに、開始しなかったことにして同じ開始局面から対局しなおす。
+        self.watchdog_margin: Optional[float] = 10.0
+        self.watchdog_policy = WatchdogPolicy.VoidGame
+
+        # エンジンを起動しなおす(recycle)までの、そのエンジンでの対局数。Noneなら対局数では起動しなおさない。
+        # 何千局も同じプロセスで対局させると、エンジンのメモリリークやhashの断片化で探索速度が落ちていくことがあるので、
+        # 終局したときに、この数に達したエンジンを起動しなおしてから次の対局を開始する。
+        # 起動しなおすのは別スレッドで行うので、その間も他の対局サーバーは対局を続ける。
+        # (最初に起動しなおすまでの対局数は対局サーバーごとにずらしておくので、一斉に起動しなおすことはない)
+        self.recycle_games: Optional[int] = None
+
+        # エンジンの物理メモリ使用量(/proc/[pid]/statusのVmRSS)が、そのエンジンの最初の終局時から
+        # これ以上増えていたら、終局したときに起動しなおす[MB]。Noneなら見ない。(Linuxのみ)
+        self.recycle_rss_growth: Optional[int] = None
+
         # --- public readonly members ---
 
         # 対局サーバー群
         self.servers = []  # List[AyaneruServer]
 
-        # 対局棋譜
-        self.game_kifus = []  # List[GameKifu]
+        # concurrency_controllerによって止められている対局サーバー(serversの一部)
+        self.parked_servers = []  # List[AyaneruServer]
+
+        # cpu_affinity == Trueのときに、CPUをどのように割り当てたかの説明
+        self.cpu_affinity_report = ""
+
+        # 起動に失敗したエンジン。("エンジンのpath : 理由"の形)
+        self.failed_engines: List[str] = []
+
+        # 対局を続けられなくなったときの、その理由。(子プロセスが異常終了したときなど)
+        # 設定されると、wait_for_games() , wait_for_matches()は待つのをやめて例外をraiseする。
+        self.error: Optional[str] = None
+
+        # 対局棋譜(game_kifus_limitの数まで)
+        # 上限を超えたら古いものから捨てるので、dequeにしてある。
+        self.game_kifus: Deque[GameKifu] = deque()
+
+        # paired_openings == Trueのときの、開始局面の順番と2局1組の戦績
+        self.pairing: Optional[PairedOpenings] = None
+
+        # 開始した試合数。
+        self.started_games = 0
 
         # 終了した試合数。
         self.total_games = 0
@@ -54,6 +177,21 @@ class MultiAyaneruServer:
         # 引き分けたゲーム数
         self.draw_games = 0
 
+        # match_sourceから返された組のうち、まだすべての対局が終わっていないもの。組の番号 -> 組
+        self.matches: Dict[int, EngineMatch] = {}
+
+        # すべての対局が終わった組の数
+        self.finished_match_count = 0
+
+        # 応答しなくなって(もしくは異常終了して)、起動しなおしたエンジンの数
+        self.engine_hangs = 0
+
+        # そのために無効にした対局の数
+        self.void_games = 0
+
+        # recycle_games , recycle_rss_growthに従って起動しなおしたエンジンの数
+        self.recycled_engines = 0
+
         # --- private members ---
 
         # game_start()のあとこれをTrueにするとすべての対局が停止する。
@@ -62,24 +200,108 @@ class MultiAyaneruServer:
         # 対局監視用のスレッド
         self.game_thread: threading.Thread = None
 
+        # 終局したAyaneruServerがputされるqueue。
+        # 対局監視用のスレッドはこれを待機して、終局したサーバーをすぐに再開させる。
+        # Noneがputされたときは、game_stop_flagを確認するために起こされただけ。
+        self.game_over_queue: Queue = Queue()
+
+        # total_gamesが変化したときのイベント用
+        self.total_games_cv = threading.Condition()
+
+        # paired_openings == Trueのときに、各対局サーバーで対局中の組の番号
+        self.server_pair_ids: Dict[AyaneruServer, int] = {}
+
+        # paired_openings == Trueのときに、各対局サーバーで対局中の開始局面の番号
+        # (無効にした対局を同じ開始局面でやり直すため)
+        self.server_openings: Dict[AyaneruServer, int] = {}
+
+        # cpu_affinity == Trueのときに、各対局サーバーに割り当てたCPUの集合
+        # (エンジンを入れ替えたときに、新しいエンジンにも設定する)
+        self.server_cpu_sets: Dict[AyaneruServer, List[int]] = {}
+
+        # match_sourceが設定されているときに、各対局サーバーで対局させているエンジンの組
+        self.server_matches: Dict[AyaneruServer, EngineMatch] = {}
+
+        # エンジンの起動に失敗して対局させられなかった組。他の対局サーバーで対局させる。
+        self.returned_matches: Deque[EngineMatch] = deque()
+
+        # すべての対局が終わって、pop_finished_matches()で取り出されるのを待っている組
+        self.finished_matches: List[EngineMatch] = []
+
+        # 開始できる対局が残っていなかったので、止めたままにしている対局サーバー
+        # (他の対局サーバーが止まったときに、その対局を引き継がせる)
+        self.idle_servers: List[AyaneruServer] = []
+
+        # エンジンを起動しなおせなかったので、止めたままにしている対局サーバー
+        self.stopped_servers: List[AyaneruServer] = []
+
+        # 次に振る組の番号
+        self.next_match_id = 0
+
+        # 対局の割り振り(start_server() , stop_server() , switch_match() , restart_server()と、
+        # そこから呼び出されるnext_match() , next_game() , cancel_game()など)をlockするためのもの。
+        # 対局監視用のスレッドと、エンジンを入れ替える(起動しなおす)スレッドから呼び出されるので、
+        # server_matches , returned_matches , idle_servers , parked_servers , server_pair_ids ,
+        # server_openings , PairedOpeningsなどは、これをlockしてから操作する。
+        # (入れ替えるスレッドは、"readyok"を待っている間はlockしない。入れ子でlockするのでRLock)
+        self.schedule_lock = threading.RLock()
+
+        # エンジンを入れ替えているスレッド(起動しなおしているものも含む)
+        self.switch_threads: List[threading.Thread] = []
+
+        # recycle_gamesのための、エンジンごとの(起動してから、もしくは最初にずらした分を含めた)対局数
+        self.engine_games: Dict[UsiEngine, int] = {}
+
+        # recycle_rss_growthのための、エンジンごとの最初の終局時の物理メモリ使用量[MB]
+        self.engine_rss_base: Dict[UsiEngine, int] = {}
+
     # 対局サーバーを初期化する
     # num = 用意する対局サーバーの数(この数だけ並列対局する)
     def init_server(self, num: int):
         servers = []
         for _ in range(num):
-            server = AyaneruServer()
+            server = self.create_server()
             server.debug_print = self.debug_print
             server.error_print = self.error_print
+            server.info_capture_level = self.info_capture_level
+            server.watchdog_margin = self.watchdog_margin
+            server.watchdog_policy = self.watchdog_policy
             servers.append(server)
         self.servers = servers
 
+    # 対局サーバーを1つ生成する。
+    # 派生クラスでAyaneruServer以外の対局サーバーを使いたいときはこれをoverrideする。
+    def create_server(self) -> AyaneruServer:
+        return AyaneruServer()
+
     # init_serverのあと、1P側、2P側のエンジンを初期化する。
     # player : 0なら1P側、1なら2P側
     def init_engine(self, player: int, engine_path: str, engine_options: dict):
         for server in self.servers:
-            engine = server.engines[player]
-            engine.set_engine_options(engine_options)
-            engine.connect(engine_path)
+            server.engines[player] = self.connect_engine(
+                server, engine_path, engine_options
+            )
+
+    # serverで用いるエンジンを起動して返す。
+    # engine_poolが設定されていれば、ここから借りる。
+    def connect_engine(
+        self, server: AyaneruServer, engine_path: str, engine_options: dict
+    ) -> UsiEngine:
+        if self.engine_pool is not None:
+            return self.engine_pool.lease(engine_path, engine_options)
+        engine = server.create_engine()
+        engine.set_engine_options(engine_options)
+        engine.connect(engine_path)
+        return engine
+
+    # connect_engine()で起動したエンジンを終了させる。
+    # engine_poolが設定されていれば、終了させずに返却する。
+    def release_engine(self, engine: UsiEngine):
+        self.forget_engine(engine)
+        if self.engine_pool is not None:
+            self.engine_pool.release(engine)
+        else:
+            engine.disconnect()
 
     # すべてのあやねるサーバーに持ち時間設定を行う。
     # AyaneruServer.set_time_setting()と設定の仕方は同じ。
@@ -92,49 +314,291 @@ class MultiAyaneruServer:
         if len(self.servers) == 0:
             raise ValueError("No Servers. Must call init_server()")
 
-        self.total_games = 0
-        self.player1_win = 0
-        self.player2_win = 0
-        self.black_win = 0
-        self.white_win = 0
-        self.draw_games = 0
+        self.reset_results()
+
+        # エンジンの組ごとに対局させるなら、対局サーバーごとに組を決めてエンジンを起動する。
+        if self.match_source is not None:
+            self.init_matches()
+
+        # すべてのエンジンの起動を待って、起動に失敗したものを取り除く。
+        self.wait_engines_ready()
+        if self.match_source is not None:
+            self.return_failed_matches()
+
+        if self.cpu_affinity:
+            self.apply_cpu_affinity()
+
+        self.init_recycle()
 
         self.game_stop_flag = False
+        self.game_over_queue = Queue()
 
         flip = False
         # それぞれの対局、1個ごとに先後逆でスタートしておく。
         for server in self.servers:
+            server.game_over_queue = self.game_over_queue
             server.flip_turn = flip
             if self.flip_turn_every_game:
                 flip ^= True
-            # 対局を開始する
-            self.start_server(server)
+
+        # 対局を開始する
+        # (エンジンを入れ替えるスレッドがここで開始されることがあるので、lockしておく)
+        with self.schedule_lock:
+            for server in self.start_concurrency():
+                self.start_server(server)
 
         # 対局用のスレッドを作成するのがお手軽か..
         self.game_thread = threading.Thread(target=self.game_worker)
         self.game_thread.start()
 
+    # [SYNC] すべてのエンジンから"readyok"が返ってくるのを待つ。
+    # エンジンはinit_engine()で一斉に起動してあるので、共通の期限(engine_ready_timeout)まで順番に待てばよい。
+    # 期限までに"readyok"が返ってこなかったエンジンや、終了してしまったエンジンは強制終了させて、
+    # そのエンジンを用いる対局サーバーを取り除く。すべての対局サーバーが取り除かれたら例外をraise。
+    def wait_engines_ready(self):
+        timeout = self.engine_ready_timeout
+        deadline = None if timeout is None else time.time() + timeout
+
+        servers = []
+        for server in self.servers:
+            ready = True
+            for engine in server.engines:
+                rest = None if deadline is None else max(deadline - time.time(), 0)
+                if engine.wait_ready(rest):
+                    continue
+                self.engine_failed(engine)
+                ready = False
+            if ready:
+                servers.append(server)
+            else:
+                self.terminate_server(server)
+        self.servers = servers
+
+        if len(self.servers) == 0:
+            raise ValueError("No engines are ready.")
+
+    # "readyok"が返ってこなかったエンジンを強制終了させて、failed_enginesに記録する。
+    # 原因がわかるように、エンジンの標準エラー出力の最後の数行も表示する。
+    def engine_failed(self, engine: UsiEngine):
+        self.add_failed_engine(engine)
+        engine.kill()
+        for line in engine.get_stderr()[-5:]:
+            print("  stderr : " + line)
+
+    # "readyok"が返ってこなかったエンジンを、その理由とともにfailed_enginesに記録する。
+    def add_failed_engine(self, engine: UsiEngine):
+        reason = (
+            "disconnected"
+            if engine.engine_state == UsiEngineState.Disconnected
+            else "readyok timeout"
+        )
+        failed = "{0} : {1}".format(engine.engine_path, reason)
+        self.failed_engines.append(failed)
+        print("Error! : engine startup failed , " + failed)
+
+    # 対局サーバーごとにCPUを割り当てて、エンジンのプロセスに設定する。
+    # エンジンがスレッドを生成し終わってから設定したいので、"readyok"が返ってきたあとに呼び出す。
+    def apply_cpu_affinity(self):
+        threads = self.cpu_threads
+        if threads is None:
+            threads = max(
+                get_engine_threads(engine.options)
+                for server in self.servers
+                for engine in server.engines
+            )
+        lines = []
+        cpu_sets = self.cpu_sets
+        if cpu_sets is None:
+            topology = get_cpu_topology()
+            cpu_sets = plan_cpu_sets(len(self.servers), threads, topology)
+            lines.append("cpu topology : " + describe_topology(topology))
+        lines.append(
+            "cpu affinity : {0} servers , {1} threads per server".format(
+                len(self.servers), threads
+            )
+        )
+
+        self.server_cpu_sets = {}
+        for i, server in enumerate(self.servers):
+            cpus = cpu_sets[i] if i < len(cpu_sets) else None
+            if cpus is None:
+                lines.append("server {0} : not pinned (not enough cpus)".format(i))
+                continue
+            self.server_cpu_sets[server] = cpus
+            pinned = self.pin_engines(server)
+            lines.append(
+                "server {0} : cpus {1}{2}".format(
+                    i, format_cpu_list(cpus), "" if pinned else " (failed)"
+                )
+            )
+        self.cpu_affinity_report = "\n".join(lines)
+
+    # serverのエンジンのプロセスを、serverに割り当てたCPUでだけ動くようにする。
+    # 返し値 : すべてのエンジンに設定できたならTrue。
+    def pin_engines(self, server: AyaneruServer) -> bool:
+        cpus = self.server_cpu_sets.get(server)
+        if cpus is None:
+            return False
+        pinned = True
+        for engine in server.engines:
+            proc = engine.proc
+            if proc is None or not set_process_group_affinity(proc.pid, cpus):
+                pinned = False
+        return pinned
+
+    # エンジンの起動にかかった時間("readyok"が返ってくるまでの時間)を文字列化して返す。
+    def startup_info(self) -> str:
+        latencies = [
+            engine.ready_latency
+            for server in self.servers
+            for engine in server.engines
+            if engine.ready_latency is not None
+        ]
+        if len(latencies) == 0:
+            return "engine startup : no engines"
+        return "engine startup : {0} engines , readyok max {1:.2f}s , avg {2:.2f}s , failed {3}".format(
+            len(latencies),
+            max(latencies),
+            sum(latencies) / len(latencies),
+            len(self.failed_engines),
+        )
+
+    # 戦績をリセットする。
+    def reset_results(self):
+        self.error = None
+        self.started_games = 0
+        self.total_games = 0
+        self.player1_win = 0
+        self.player2_win = 0
+        self.black_win = 0
+        self.white_win = 0
+        self.draw_games = 0
+        # エンジンの組ごとに対局させるときは、2局1組の戦績は組ごとに集計する。
+        self.pairing = (
+            PairedOpenings(self.opening_count())
+            if self.paired_openings and self.match_source is None
+            else None
+        )
+        self.server_pair_ids = {}
+        self.server_openings = {}
+        self.engine_hangs = 0
+        self.void_games = 0
+        self.recycled_engines = 0
+        self.matches = {}
+        self.finished_match_count = 0
+        self.server_matches = {}
+        self.returned_matches = deque()
+        self.finished_matches = []
+        self.next_match_id = 0
+        self.idle_servers = []
+        self.stopped_servers = []
+
     # game_start()で開始したすべての対局を停止させる。
     def game_stop(self):
         if self.game_thread is None:
             raise ValueError("game thread is not running.")
         self.game_stop_flag = True
+        # 終局待ちで寝ている対局監視用のスレッドを起こす。
+        self.game_over_queue.put(None)
         self.game_thread.join()
         self.game_thread = None
+        self.flush_kifu_sink()
+
+    # kifu_sinkに溜まっている棋譜を書き出す。
+    def flush_kifu_sink(self):
+        if self.kifu_sink is not None:
+            self.kifu_sink.flush()
+
+    # [SYNC] 終了した試合数がn以上になるまで待つ。
+    # SPRTで結論が出て対局が打ち切られたときは、n局に到達していなくてもそこで待つのをやめる。
+    # timeout : 最大の待ち時間[s]。Noneなら無制限に待つ。
+    # 返し値 : n局に到達したか、対局が打ち切られたならTrue。timeoutしたならFalse。
+    # 対局を続けられなくなったら(errorが設定されたら)例外をraise
+    def wait_for_games(self, n: int, timeout: Optional[float] = None) -> bool:
+        with self.total_games_cv:
+            result = self.total_games_cv.wait_for(
+                lambda: self.total_games >= n
+                or self.is_finished()
+                or self.error is not None,
+                timeout,
+            )
+            self.raise_error()
+            return result
+
+    # [SYNC] すべての対局が終わった組の数がn以上になるまで待つ。(match_sourceを設定したとき用)
+    # timeout : 最大の待ち時間[s]。Noneなら無制限に待つ。
+    # 返し値 : n組に到達したならTrue。timeoutしたならFalse。
+    # 対局を続けられなくなったら(errorが設定されたら)例外をraise
+    def wait_for_matches(self, n: int, timeout: Optional[float] = None) -> bool:
+        with self.total_games_cv:
+            result = self.total_games_cv.wait_for(
+                lambda: self.finished_match_count >= n or self.error is not None,
+                timeout,
+            )
+            self.raise_error()
+            return result
+
+    # 対局を続けられなくなったことを記録して、wait_for_games()などで待っているものを起こす。
+    # 最初に記録された理由だけを残す。
+    def set_error(self, error: str):
+        with self.total_games_cv:
+            if self.error is None:
+                self.error = error
+            self.total_games_cv.notify_all()
+
+    # errorが設定されていれば例外をraise
+    def raise_error(self):
+        if self.error is not None:
+            raise ValueError("game server failed : " + self.error)
+
+    # すべての対局が終わった組を返す。(前回呼び出したとき以降のもの)
+    def pop_finished_matches(self) -> List[EngineMatch]:
+        with self.total_games_cv:
+            matches, self.finished_matches = self.finished_matches, []
+        return matches
+
+    # [SYNC] まだすべての対局が終わっていない組と、その途中までの戦績を返す。(途中経過の表示用)
+    # 返し値 : (組 , 1P側の勝ち数 , 引き分け数 , 2P側の勝ち数)のlist。組の番号順。
+    def running_matches(self) -> List[Tuple[EngineMatch, int, int, int]]:
+        with self.total_games_cv:
+            return [
+                (match, match.player1_win, match.draw_games, match.player2_win)
+                for _, match in sorted(self.matches.items())
+            ]
 
     # 対局結果("70-3-50"みたいな1P勝利数 - 引き分け - 2P勝利数　と、その勝率から計算されるレーティング差を文字列化して返す)
+    # sprtが設定されていれば、対数尤度比とその上限・下限も含める。
+    # 応答しなくなって起動しなおしたエンジンがあれば、その数と無効にした対局の数も含める。
+    # 対局監視用のスレッドがadd_kifu()で戦績を更新しているので、lockして読み出す。
     def game_info(self) -> str:
-        elo = self.game_rating()
-        return elo.pretty_string
+        with self.total_games_cv:
+            info = self.game_rating().pretty_string
+            if self.sprt is not None:
+                self.update_sprt()
+                info += " " + self.sprt.pretty_string
+            if self.engine_hangs > 0:
+                info += " hangs {0} (void {1})".format(
+                    self.engine_hangs, self.void_games
+                )
+            if self.recycled_engines > 0:
+                info += " recycled {0}".format(self.recycled_engines)
+        return info
 
     # Eloレーティングを計算して返す。(EloRating型を)
+    # paired_openings == Trueなら、2局1組の戦績から信頼区間を求める。
     def game_rating(self) -> EloRating:
-        elo = EloRating()
-        elo.player1_win = self.player1_win
-        elo.player2_win = self.player2_win
-        elo.black_win = self.black_win
-        elo.white_win = self.white_win
-        elo.draw_games = self.draw_games
+        if self.pairing is not None:
+            elo = PairEloRating()
+        else:
+            elo = EloRating()
+        with self.total_games_cv:
+            if self.pairing is not None:
+                elo.pentanomial = list(self.pairing.pentanomial)
+            elo.player1_win = self.player1_win
+            elo.player2_win = self.player2_win
+            elo.black_win = self.black_win
+            elo.white_win = self.white_win
+            elo.draw_games = self.draw_games
         elo.calc()
         return elo
 
@@ -142,59 +606,507 @@ class MultiAyaneruServer:
     def game_worker(self):
 
         while not self.game_stop_flag:
-            for server in self.servers:
-                # 対局が終了しているサーバーがあるなら次のゲームを開始する。
-                if server.game_result.is_gameover():
-                    self.restart_server(server)
-            time.sleep(1)
+            # 対局が終了したサーバーがあるなら次のゲームを開始する。
+            # 終局はAyaneruServer.game_over()からqueueで通知される。
+            server = self.game_over_queue.get()
+            if server is None or self.game_stop_flag:
+                continue
+            self.restart_server(server)
+
+        # エンジンを入れ替えている途中のものは、終わるのを待つ。
+        for thread in self.switch_threads:
+            thread.join()
+        self.switch_threads = []
 
         # serverの解体もしておく。
         for server in self.servers:
-            server.terminate()
+            self.terminate_server(server)
         self.servers = []
 
+    # 対局サーバーを解体する。
+    # engine_poolが設定されていれば、エンジンは終了させずにpoolに返却する。
+    def terminate_server(self, server: AyaneruServer):
+        if self.engine_pool is None:
+            server.terminate()
+            return
+        server.stop_game()
+        engines, server.engines = server.engines, []
+        for engine in engines:
+            self.engine_pool.release(engine)
+
     # 結果を集計、棋譜の保存
     def count_result(self, server: AyaneruServer):
-        result = server.game_result
-
-        # 終局内容に応じて戦績を加算
-        if result.is_black_or_white_win():
-            if result.is_player1_win(server.flip_turn):
-                self.player1_win += 1
-            else:
-                self.player2_win += 1
-            if result == GameResult.BLACK_WIN:
-                self.black_win += 1
-            else:
-                self.white_win += 1
-        else:
-            self.draw_games += 1
-        self.total_games += 1
-
-        # 棋譜を保存しておく。
         kifu = GameKifu()
-        kifu.sfen = server.sfen
+        kifu.start_position = server.start_position
+        kifu.moves = server.moves
         kifu.flip_turn = server.flip_turn
         kifu.game_result = server.game_result
-        self.game_kifus.append(kifu)
+        kifu.pair_id = self.server_pair_ids.pop(server, None)
+        match = self.server_matches.get(server)
+        if match is not None:
+            kifu.match_id = match.match_id
+        self.add_kifu(kifu)
+
+    # 終局した対局の棋譜を保存して、戦績に加算する。
+    def add_kifu(self, kifu: GameKifu):
+        result = kifu.game_result
+
+        # 棋譜を書き出す。
+        if self.kifu_sink is not None:
+            self.kifu_sink.write(kifu)
+
+        # 棋譜を保存しておく。
+        # (game_kifus_limitが変更されていたら、その上限のdequeに作りなおす)
+        limit = self.game_kifus_limit
+        if limit is None or limit > 0:
+            if self.game_kifus.maxlen != limit:
+                self.game_kifus = deque(self.game_kifus, maxlen=limit)
+            self.game_kifus.append(kifu)
+
+        with self.total_games_cv:
+            # 終局内容に応じて戦績を加算
+            if result.is_black_or_white_win():
+                if result.is_player1_win(kifu.flip_turn):
+                    self.player1_win += 1
+                else:
+                    self.player2_win += 1
+                if result == GameResult.BLACK_WIN:
+                    self.black_win += 1
+                else:
+                    self.white_win += 1
+            else:
+                self.draw_games += 1
+            self.total_games += 1
+
+            # 2局1組の戦績
+            if self.pairing is not None and kifu.pair_id is not None:
+                if result.is_black_or_white_win():
+                    score = 1.0 if result.is_player1_win(kifu.flip_turn) else 0.0
+                else:
+                    score = 0.5
+                self.pairing.add_result(kifu.pair_id, score)
+
+            # エンジンの組ごとの戦績
+            match = self.matches.get(kifu.match_id)
+            if match is not None:
+                match.add_result(result, kifu.flip_turn, kifu.pair_id)
+                if match.is_finished():
+                    del self.matches[kifu.match_id]
+                    self.finished_matches.append(match)
+                    self.finished_match_count += 1
+
+            # SPRTで結論が出たら、対局を打ち切る。
+            if self.sprt is not None and self.sprt.accepted is None:
+                self.update_sprt()
+                if self.sprt.accepted is not None:
+                    self.finish_games()
+
+            self.total_games_cv.notify_all()
+
+    # sprtに現在の戦績を反映させる。total_games_cvをlockしてから呼び出すこと。
+    def update_sprt(self):
+        sprt = self.sprt
+        sprt.player1_win = self.player1_win
+        sprt.player2_win = self.player2_win
+        sprt.draw_games = self.draw_games
+        sprt.calc()
+
+    # SPRTで結論が出ているか。このときは新たな対局は開始されない。
+    def is_finished(self) -> bool:
+        return self.sprt is not None and self.sprt.accepted is not None
+
+    # SPRTで結論が出たときに呼び出される。
+    # 対局中のものは終局まで指させて、新たな対局はrestart_server()で開始しないようにする。
+    # (派生クラスで、対局の止め方が異なるときはこれをoverrideする)
+    def finish_games(self):
+        pass
 
     # 対局サーバーを開始する。
+    # match_sourceが設定されていて、serverの組のgames局を開始し終わっていたら、次の組のエンジンに入れ替えてから開始する。
     def start_server(self, server: AyaneruServer):
+        with self.schedule_lock:
+            if self.match_source is not None:
+                match = self.server_matches.get(server)
+                if match is None or match.started_games >= match.games:
+                    # 開始できる対局が残っていなければ、エンジンを入れ替えても無駄になる。
+                    if self.has_game_budget():
+                        self.switch_match(server)
+                    else:
+                        self.idle_servers.append(server)
+                    return
+                if not self.reserve_game():
+                    self.idle_servers.append(server)
+                    return
+                match.started_games += 1
+            elif not self.reserve_game():
+                self.idle_servers.append(server)
+                return
+            server.game_start(*self.next_game(server))
+
+    # max_gamesに達していなければ、開始する対局を1つ数えてTrueを返す。
+    # 達していればFalse。(その対局サーバーは再開させない)
+    def reserve_game(self) -> bool:
+        with self.total_games_cv:
+            if not self.has_game_budget():
+                return False
+            self.started_games += 1
+            return True
+
+    # max_gamesまでに、まだ開始できる対局が残っているか。
+    def has_game_budget(self) -> bool:
+        return self.max_games is None or self.started_games < self.max_games
+
+    # game_start()のときに、対局サーバーごとに対局させる組を決めて、そのエンジンを起動する。
+    # 組が足りなければ、余った対局サーバーは解体する。
+    def init_matches(self):
+        servers = []
+        exhausted = False
+        for server in self.servers:
+            match = None if exhausted else self.next_match()
+            if match is None:
+                # エンジンはまだ起動していないので、そのまま解体してよい。
+                exhausted = True
+                server.terminate()
+                continue
+            self.server_matches[server] = match
+            for player, (engine_path, engine_options) in enumerate(
+                match.engine_configs
+            ):
+                server.engines[player] = self.connect_engine(
+                    server, engine_path, engine_options
+                )
+            servers.append(server)
+        self.servers = servers
+
+        if len(self.servers) == 0:
+            raise ValueError("No Matches. match_source returned None.")
+
+    # エンジンの起動に失敗して取り除かれた対局サーバーの組を、他の対局サーバーで対局させるために戻しておく。
+    def return_failed_matches(self):
+        for server, match in list(self.server_matches.items()):
+            if server not in self.servers:
+                del self.server_matches[server]
+                self.returned_matches.append(match)
+
+    # 次に対局させる組を返す。なければNone。
+    # エンジンの起動に失敗して戻された組があれば、それを優先する。
+    def next_match(self) -> Optional[EngineMatch]:
+        with self.schedule_lock:
+            return self.next_match_locked()
+
+    # next_match()の本体。schedule_lockをlockしてから呼び出すこと。
+    def next_match_locked(self) -> Optional[EngineMatch]:
+        if self.returned_matches:
+            return self.returned_matches.popleft()
+        match = self.match_source()
+        if match is None or match.match_id is not None:
+            return match
+
+        match.match_id = self.next_match_id
+        self.next_match_id += 1
+        if self.paired_openings:
+            match.pairing = PairedOpenings(self.opening_count())
+        with self.total_games_cv:
+            self.matches[match.match_id] = match
+        return match
+
+    # serverに次の組を対局させる。
+    # エンジンの入れ替えには時間がかかるので、別スレッドで行う。次の組がなければserverは止めたままにする。
+    def switch_match(self, server: AyaneruServer):
+        with self.schedule_lock:
+            previous = self.server_matches.pop(server, None)
+            match = self.next_match()
+            if match is None:
+                self.idle_servers.append(server)
+                return
+            self.server_matches[server] = match
+            self.start_switch_thread(self.switch_engines, (server, previous, match))
+
+    # エンジンを入れ替えるスレッドを開始する。
+    # 対局中ずっと増え続けないように、終了しているスレッドはswitch_threadsから取り除いておく。
+    def start_switch_thread(self, target, args: tuple):
+        self.switch_threads = [t for t in self.switch_threads if t.is_alive()]
+        thread = threading.Thread(target=target, args=args)
+        self.switch_threads.append(thread)
+        thread.start()
+
+    # serverのエンジンを、previousの組のものからmatchの組のものに入れ替えて、対局を開始する。
+    # 同じエンジン(実行ファイルとオプションが同じもの)はそのまま用いる。
+    # 起動に失敗したら、matchは他の対局サーバーで対局させるために戻して、serverは止めたままにする。
+    def switch_engines(
+        self,
+        server: AyaneruServer,
+        previous: Optional[EngineMatch],
+        match: EngineMatch,
+    ):
+        # 前の対局の対局スレッドは、終局を通知したあと終了処理の途中である可能性があるので、終了を待っておく。
+        if server.game_thread is not None:
+            server.game_thread.join()
+
+        for player, (engine_path, engine_options) in enumerate(match.engine_configs):
+            if previous is not None:
+                old_path, old_options = previous.engine_configs[player]
+                if make_engine_key(old_path, old_options) == make_engine_key(
+                    engine_path, engine_options
+                ):
+                    continue
+            self.release_engine(server.engines[player])
+            server.engines[player] = self.connect_engine(
+                server, engine_path, engine_options
+            )
+
+        ready = True
+        for engine in server.engines:
+            if engine.wait_ready(self.engine_ready_timeout):
+                continue
+            self.engine_failed(engine)
+            ready = False
+
+        if ready:
+            self.pin_engines(server)
+
+        # 対局の割り振りは対局監視用のスレッドと同時に行わないように、ここだけlockする。
+        with self.schedule_lock:
+            if not ready:
+                if self.server_matches.get(server) is match:
+                    del self.server_matches[server]
+                self.returned_matches.append(match)
+                self.stop_server(server)
+            elif not self.game_stop_flag and not self.is_finished():
+                self.start_server(server)
+
+    # serverで次に対局させる開始局面と開始手数を返す。
+    # paired_openings == Trueなら、serverのflip_turnも設定する。
+    # (match_sourceが設定されていれば、開始局面の順番はserverで対局させている組ごとに決める)
+    def next_game(self, server: AyaneruServer) -> Tuple[str, int]:
+        pairing = self.pairing
+        if self.match_source is not None:
+            pairing = self.server_matches[server].pairing
+        if pairing is None:
+            return self.next_start_sfen(), self.next_start_gameply()
+
+        index, flip_turn, pair_id = pairing.next_game()
+        server.flip_turn = flip_turn
+        self.server_pair_ids[server] = pair_id
+        self.server_openings[server] = index
+        if self.book is not None:
+            sfen = self.book.get_sfen(index)
+        else:
+            sfen = self.start_sfens[index]
+        return sfen, self.next_start_gameply()
+
+    # 開始局面の数
+    def opening_count(self) -> int:
+        if self.book is not None:
+            return len(self.book)
+        return len(self.start_sfens)
+
+    # 次の対局の開始局面を返す。
+    def next_start_sfen(self) -> str:
+        if self.book is not None:
+            return self.book.random_sfen()
         # sfenをstart_sfensのなかから一つランダムに取得
-        sfen = self.start_sfens[random.randint(0, len(self.start_sfens) - 1)]
-        server.game_start(sfen, self.start_gameply)
+        return self.start_sfens[random.randint(0, len(self.start_sfens) - 1)]
+
+    # next_start_sfen()で返した開始局面の開始手数を返す。
+    def next_start_gameply(self) -> int:
+        # bookの局面は切り詰め済みなので末尾の局面から。
+        return 0 if self.book is not None else self.start_gameply
 
     # 対局結果を集計して、サーバーを再開(次の対局を開始)させる。
     def restart_server(self, server: AyaneruServer):
-        # 対局結果の集計
-        self.count_result(server)
+        with self.schedule_lock:
+            void = server.game_result == GameResult.STOP_GAME
+            if server.hung_player is not None:
+                self.add_engine_hang(void)
+                # 起動しなおしたエンジンにも、CPUの割り当てを設定しなおす。
+                self.pin_engines(server)
+                self.forget_engine(server.engines[server.hung_player])
 
-        # flip_turnを反転させておく。(1局ごとに手番を入れ替え)
-        if self.flip_turn_every_game:
-            server.flip_turn ^= True
+            if void:
+                # 無効にした対局は集計せずに、同じ手番でやり直す。
+                self.cancel_game(server)
+            else:
+                # 対局結果の集計
+                self.count_result(server)
 
-        # 終了していたので再開
-        self.start_server(server)
+                # flip_turnを反転させておく。(1局ごとに手番を入れ替え)
+                if self.flip_turn_every_game:
+                    server.flip_turn ^= True
+
+            # SPRTで結論が出ていたら再開しない。
+            if self.is_finished():
+                return
+
+            # エンジンを起動しなおせなかったなら、その対局サーバーは止めたままにする。
+            # (無効にした対局は、止めている他の対局サーバーでやり直させる)
+            if not all(engine.is_connected() for engine in server.engines):
+                self.stop_server(server)
+                return
+
+            # 終了していたので再開
+            # (並列数を調整するときは、止めたり、止めていたものも再開させたりする)
+            # 起動しなおすエンジンがあれば、それが終わってから再開させる。
+            recycle = self.count_engine_games(server)
+            for s in self.adjust_concurrency(server):
+                if s is server and recycle:
+                    self.recycle_server(server, recycle)
+                else:
+                    self.start_server(s)
+
+    # game_start()のときに、エンジンごとの対局数をリセットする。
+    # recycle_gamesが設定されていれば、対局サーバーごとに最初に起動しなおすまでの対局数を均等にずらしておく。
+    def init_recycle(self):
+        self.engine_games = {}
+        self.engine_rss_base = {}
+        if self.recycle_games is None:
+            return
+        for i, server in enumerate(self.servers):
+            for engine in server.engines:
+                self.engine_games[engine] = i * self.recycle_games // len(self.servers)
+
+    # serverで終局したので、そのエンジンの対局数を数えて、起動しなおすエンジンを返す。
+    # recycle_gamesの対局数に達したか、物理メモリ使用量がrecycle_rss_growth以上増えたエンジンを起動しなおす。
+    def count_engine_games(self, server: AyaneruServer) -> List[UsiEngine]:
+        if self.recycle_games is None and self.recycle_rss_growth is None:
+            return []
+        recycle = []
+        for engine in server.engines:
+            games = self.engine_games.get(engine, 0) + 1
+            self.engine_games[engine] = games
+            if self.recycle_games is not None and games >= self.recycle_games:
+                recycle.append(engine)
+                continue
+            if self.recycle_rss_growth is None or engine.proc is None:
+                continue
+            # 終局ごとに全エンジンについて調べるので、プロセスグループ全体は見ずに、エンジン本体のものだけを見る。
+            rss = get_process_rss(engine.proc.pid)
+            if rss is None:
+                continue
+            base = self.engine_rss_base.setdefault(engine, rss)
+            if rss - base >= self.recycle_rss_growth:
+                recycle.append(engine)
+        return recycle
+
+    # エンジンごとの対局数と物理メモリ使用量を忘れる。(エンジンを起動しなおしたり、返却したりしたとき用)
+    def forget_engine(self, engine: UsiEngine):
+        self.engine_games.pop(engine, None)
+        self.engine_rss_base.pop(engine, None)
+
+    # serverのenginesを起動しなおしてから、対局を開始する。
+    # 時間がかかるので別スレッドで行い、その間も他の対局サーバーは対局を続ける。
+    def recycle_server(self, server: AyaneruServer, engines: List[UsiEngine]):
+        self.start_switch_thread(self.recycle_engines, (server, engines))
+
+    # serverのenginesを終了させて、同じ実行ファイル・同じオプションで起動しなおす。
+    # 起動に失敗したら、serverは止めたままにする。(対局させていた組は、他の対局サーバーで対局させるために戻す)
+    def recycle_engines(self, server: AyaneruServer, engines: List[UsiEngine]):
+        # 前の対局の対局スレッドは、終局を通知したあと終了処理の途中である可能性があるので、終了を待っておく。
+        if server.game_thread is not None:
+            server.game_thread.join()
+
+        with self.schedule_lock:
+            for engine in engines:
+                self.forget_engine(engine)
+        for engine in engines:
+            engine.disconnect()
+            try:
+                engine.connect(engine.engine_path)
+            except OSError:
+                # 起動に失敗したエンジンは、wait_ready()がFalseを返す。
+                pass
+
+        ready = True
+        for engine in engines:
+            if engine.wait_ready(self.engine_ready_timeout):
+                continue
+            self.engine_failed(engine)
+            ready = False
+        self.add_recycled_engines(len(engines))
+        if ready:
+            self.pin_engines(server)
+
+        # 対局の割り振りは対局監視用のスレッドと同時に行わないように、ここだけlockする。
+        with self.schedule_lock:
+            if not ready:
+                self.stop_server(server)
+            elif not self.game_stop_flag and not self.is_finished():
+                self.start_server(server)
+
+    # serverのエンジンを起動しなおせなかったので、serverを止めたままにする。
+    # serverで対局させていた組と、まだ開始していない対局は、止めている他の対局サーバーに引き継がせる。
+    # 引き継げる対局サーバーがなく、すべての対局サーバーが止まったなら、もう対局できないのでerrorにする。
+    def stop_server(self, server: AyaneruServer):
+        with self.schedule_lock:
+            match = self.server_matches.pop(server, None)
+            if match is not None:
+                self.returned_matches.append(match)
+            self.stopped_servers.append(server)
+            if self.game_stop_flag or self.is_finished():
+                return
+            if self.idle_servers:
+                self.start_server(self.idle_servers.pop())
+            elif self.parked_servers:
+                self.start_server(self.parked_servers.pop())
+            elif len(self.stopped_servers) >= len(self.servers):
+                self.set_error(
+                    "all game servers stopped. engines could not be restarted."
+                )
+
+    # 起動しなおしたエンジンの数を数える。
+    def add_recycled_engines(self, n: int):
+        with self.total_games_cv:
+            self.recycled_engines += n
+
+    # 応答しなくなったエンジンを起動しなおしたことを数える。
+    # void : そのために対局を無効にしたか
+    def add_engine_hang(self, void: bool):
+        with self.total_games_cv:
+            self.engine_hangs += 1
+            if void:
+                self.void_games += 1
+
+    # serverで無効にした対局を、開始しなかったことにする。
+    # paired_openings == Trueなら、同じ開始局面・手番・組の番号でもう一度対局させる。
+    def cancel_game(self, server: AyaneruServer):
+        pair_id = self.server_pair_ids.pop(server, None)
+        index = self.server_openings.pop(server, None)
+        match = self.server_matches.get(server)
+        pairing = self.pairing if match is None else match.pairing
+        if pairing is not None and pair_id is not None:
+            pairing.requeue(index, server.flip_turn, pair_id)
+        with self.total_games_cv:
+            self.started_games -= 1
+            if match is not None:
+                match.started_games -= 1
+
+    # 対局開始時に、concurrency_controllerの開始時の並列数を超える対局サーバーを止めておく。
+    # 返し値 : 対局を開始させる対局サーバー
+    def start_concurrency(self) -> List[AyaneruServer]:
+        controller = self.concurrency_controller
+        if controller is None:
+            self.parked_servers = []
+            return self.servers
+        active = controller.start(len(self.servers))
+        self.parked_servers = self.servers[active:]
+        return self.servers[:active]
+
+    # 終局したserverの時間の超過具合をconcurrency_controllerに渡して、並列数を調整する。
+    # 返し値 : 次の対局を開始させる対局サーバー。
+    #          並列数を減らすならserverは止めたままにするので含まず、増やすなら止めていたものも含む。
+    def adjust_concurrency(self, server: AyaneruServer) -> List[AyaneruServer]:
+        controller = self.concurrency_controller
+        if controller is None:
+            return [server]
+        change = controller.on_game_over(
+            server.game_start_time, server.max_overshoot, server.timeup
+        )
+        if change < 0:
+            self.parked_servers.append(server)
+            return []
+        if change > 0 and self.parked_servers:
+            return [server, self.parked_servers.pop()]
+        return [server]
 
     # 内包しているすべてのあやねるサーバーを終了させる。
     def terminate(self):
@@ -203,3 +1115,13 @@ class MultiAyaneruServer:
 
     def __del__(self):
         self.terminate()
+
+
+# エンジンオプションの"Threads"の値。指定されていなければ1。
+def get_engine_threads(options: Optional[dict]) -> int:
+    if options is None:
+        return 1
+    try:
+        return max(int(options.get("Threads", 1)), 1)
+    except ValueError:
+        return 1
@@ -0,0 +1,343 @@
+import multiprocessing
+import threading
+import traceback
+from multiprocessing.connection import Connection, wait
+from typing import Dict, List, Optional, Tuple
+
+from src.engine.book import OpeningBook
+from src.engine.cpu_affinity import describe_topology, get_cpu_topology, plan_cpu_sets
+from src.engine.engine_match import EngineMatch
+from src.engine.game_result import GameResult
+from src.engine.kifu import GameKifu
+from src.engine.server_multi import MultiAyaneruServer, get_engine_threads
+
+
+# MultiAyaneruServerを複数のプロセスに分割して動かすためのクラス。
+# エンジンからのメッセージの解釈などはすべて子プロセス側で行われるので、
+# 並列数が多いときに親プロセスのGILがボトルネックにならない。
+# 使い方はMultiAyaneruServerと同じ。game_info() , game_rating()は全プロセスの合計で計算される。
+# concurrency_controllerは子プロセスごとに複製されるので、並列数の上限・下限はプロセスごとに適用される。
+# match_sourceは親プロセスで呼び出され、子プロセスからの要求に応じて組をpipeで送る。
+# max_gamesは、子プロセスごとのサーバー数に比例させて分割する。
+class ShardedMultiAyaneruServer(MultiAyaneruServer):
+    def __init__(self):
+        super().__init__()
+
+        # --- public members ---
+
+        # 対局サーバーを分割するプロセス数。
+        # init_server()で指定したサーバー数より多い場合は、サーバー数まで減らす。
+        # デフォルトでは、論理コア16個につき1プロセス。
+        self.processes = max(multiprocessing.cpu_count() // 16, 1)
+
+        # --- public readonly members ---
+
+        # 子プロセスに割り当てたサーバー数の合計
+        self.server_num = 0
+
+        # --- private members ---
+
+        # init_engine()で渡されたエンジンの設定。[1P側 , 2P側]
+        self.engine_configs: List[Optional[Tuple[str, dict]]] = [None, None]
+
+        # set_time_setting()で渡された持ち時間設定
+        self.time_setting_str = "byoyomi 100"
+
+        # 子プロセス群
+        self.shard_processes: List[multiprocessing.Process] = []
+
+        # 子プロセスに対局の停止を指示するためのイベント
+        self.stop_event = None
+
+    # 対局サーバーを初期化する
+    # 実際のサーバーはgame_start()のときに子プロセス側で生成される。
+    def init_server(self, num: int):
+        self.server_num = num
+
+    # init_serverのあと、1P側、2P側のエンジンを設定する。
+    # エンジンはgame_start()のときに子プロセス側で起動される。
+    def init_engine(self, player: int, engine_path: str, engine_options: dict):
+        self.engine_configs[player] = (engine_path, engine_options)
+
+    # すべてのあやねるサーバーに持ち時間設定を行う。
+    def set_time_setting(self, time_setting: str):
+        self.time_setting_str = time_setting
+
+    # すべての対局を開始する
+    def game_start(self):
+        if self.server_num == 0:
+            raise ValueError("No Servers. Must call init_server()")
+        if self.match_source is None and None in self.engine_configs:
+            raise ValueError("No Engines. Must call init_engine()")
+
+        self.reset_results()
+
+        # 子プロセスから結果を受け取るときにスレッドを用いるので、forkではなくspawnで起動する。
+        context = multiprocessing.get_context("spawn")
+        self.stop_event = context.Event()
+
+        # CPUの割り当ては、子プロセス間で重ならないようにここで決めておく。
+        cpu_sets = self.cpu_sets
+        if self.cpu_affinity and cpu_sets is None:
+            threads = self.cpu_threads
+            if threads is None:
+                threads = max(
+                    get_engine_threads(config[1])
+                    for config in self.engine_configs
+                    if config is not None
+                )
+            topology = get_cpu_topology()
+            cpu_sets = plan_cpu_sets(self.server_num, threads, topology)
+            self.cpu_affinity_report = (
+                "cpu topology : {0}\n"
+                "cpu affinity : {1} servers , {2} threads per server".format(
+                    describe_topology(topology), self.server_num, threads
+                )
+            )
+
+        processes = min(self.processes, self.server_num)
+        connections = []
+        self.shard_processes = []
+        first = 0
+        for i in range(processes):
+            # サーバーをなるべく均等に割り振る。
+            num = self.server_num // processes + (
+                1 if i < self.server_num % processes else 0
+            )
+            max_games = None
+            if self.max_games is not None:
+                # 累積で切り捨てた値の差にするので、合計はちょうどmax_gamesになる。
+                begin = self.max_games * first // self.server_num
+                end = self.max_games * (first + num) // self.server_num
+                max_games = end - begin
+            config = {
+                "server_num": num,
+                "engine_configs": self.engine_configs,
+                "time_setting": self.time_setting_str,
+                "start_sfens": self.start_sfens,
+                "start_gameply": self.start_gameply,
+                # bookは子プロセス側で開き直す。
+                "book": None
+                if self.book is None
+                else (self.book.path, self.book.start_gameply),
+                "flip_turn_every_game": self.flip_turn_every_game,
+                "paired_openings": self.paired_openings,
+                "debug_print": self.debug_print,
+                "error_print": self.error_print,
+                "info_capture_level": self.info_capture_level,
+                "watchdog_margin": self.watchdog_margin,
+                "watchdog_policy": self.watchdog_policy,
+                "recycle_games": self.recycle_games,
+                "recycle_rss_growth": self.recycle_rss_growth,
+                "cpu_affinity": self.cpu_affinity,
+                "cpu_threads": self.cpu_threads,
+                "match_mode": self.match_source is not None,
+                "concurrency_controller": self.concurrency_controller,
+                "max_games": max_games,
+                "cpu_sets": None
+                if cpu_sets is None
+                else cpu_sets[first : first + num],
+            }
+            first += num
+            # 子プロセスから組の要求を受けて返すので、双方向にしておく。
+            parent_conn, child_conn = context.Pipe()
+            proc = context.Process(
+                target=shard_worker, args=(config, child_conn, self.stop_event)
+            )
+            proc.start()
+            # 親プロセス側では書き込み側は不要。閉じておかないとEOFが検出できない。
+            child_conn.close()
+            connections.append(parent_conn)
+            self.shard_processes.append(proc)
+
+        # 子プロセスから結果を受け取るスレッド
+        self.game_thread = threading.Thread(
+            target=self.game_worker, args=(connections,)
+        )
+        self.game_thread.start()
+
+    # game_start()で開始したすべての対局を停止させる。
+    def game_stop(self):
+        if self.game_thread is None:
+            raise ValueError("game thread is not running.")
+        self.stop_event.set()
+        # 子プロセスがすべてのpipeを閉じると受信スレッドは終了する。
+        self.game_thread.join()
+        self.game_thread = None
+        for proc in self.shard_processes:
+            proc.join()
+        self.shard_processes = []
+        self.flush_kifu_sink()
+
+    # SPRTで結論が出たら、子プロセスに対局の停止を指示する。
+    # (子プロセス側では戦績を集計していないので、打ち切りは親プロセスで判定する)
+    def finish_games(self):
+        self.stop_event.set()
+
+    # 子プロセスから送られてくる対局結果を集計するスレッド
+    # 組の番号は子プロセスごとに振られているので、(子プロセスの番号 , 組の番号)にして区別する。
+    # Noneが送られてきたら、それは子プロセスからの組(EngineMatch)の要求なので、次の組を返す。
+    # (HANG_RECORD , void)が送られてきたら、子プロセスでエンジンを起動しなおしたので、それを数える。
+    # (RECYCLE_RECORD , n)も同様。
+    # (ERROR_RECORD , traceback)が送られてくるか、game_stop()の前に子プロセスがpipeを閉じたら、
+    # その子プロセスは対局を続けられなくなったので、errorに設定してwait_for_games()などで待っているものを起こす。
+    def game_worker(self, connections: List[Connection]):
+        shard_ids = {conn: i for i, conn in enumerate(connections)}
+        while connections:
+            for conn in wait(connections):
+                try:
+                    record = conn.recv()
+                except EOFError:
+                    connections.remove(conn)
+                    conn.close()
+                    if not self.stop_event.is_set():
+                        self.set_error(
+                            "shard process {0} exited".format(shard_ids[conn])
+                        )
+                    continue
+                if record is None:
+                    conn.send(self.next_match())
+                    continue
+                if record[0] == ERROR_RECORD:
+                    self.set_error(
+                        "shard process {0} failed\n{1}".format(
+                            shard_ids[conn], record[1]
+                        )
+                    )
+                    continue
+                if record[0] == HANG_RECORD:
+                    self.add_engine_hang(record[1])
+                    continue
+                if record[0] == RECYCLE_RECORD:
+                    self.add_recycled_engines(record[1])
+                    continue
+                kifu = record_to_kifu(record)
+                if kifu.pair_id is not None:
+                    kifu.pair_id = (shard_ids[conn], kifu.pair_id)
+                self.add_kifu(kifu)
+
+
+# 子プロセス側でGameKifuを親プロセスに送るときの形式。
+# (game_result , flip_turn , sfen , pair_id , match_id)のtupleにする。
+KifuRecord = Tuple[int, bool, str, Optional[int], Optional[int]]
+
+
+# 子プロセス側で応答しなくなったエンジンを起動しなおしたときに、親プロセスに送るtupleの先頭の要素。
+# (HANG_RECORD , 対局を無効にしたか)のtupleにする。
+HANG_RECORD = "hang"
+
+# 子プロセス側で例外が発生して対局を続けられなくなったときに、親プロセスに送るtupleの先頭の要素。
+# (ERROR_RECORD , tracebackの文字列)のtupleにする。
+ERROR_RECORD = "error"
+
+# 子プロセス側でrecycle_games , recycle_rss_growthに従ってエンジンを起動しなおしたときに、親プロセスに送るtupleの先頭の要素。
+# (RECYCLE_RECORD , 起動しなおしたエンジンの数)のtupleにする。
+RECYCLE_RECORD = "recycle"
+
+
+def kifu_to_record(kifu: GameKifu) -> KifuRecord:
+    return (
+        int(kifu.game_result),
+        kifu.flip_turn,
+        kifu.sfen,
+        kifu.pair_id,
+        kifu.match_id,
+    )
+
+
+# kifu_to_record()の逆変換
+def record_to_kifu(record: KifuRecord) -> GameKifu:
+    kifu = GameKifu()
+    kifu.game_result = GameResult(record[0])
+    kifu.flip_turn = record[1]
+    kifu.sfen = record[2]
+    kifu.pair_id = record[3]
+    kifu.match_id = record[4]
+    return kifu
+
+
+# 子プロセス側で動くMultiAyaneruServer。
+# 終局した対局を手元に溜めずに、pipeで親プロセスに送る。
+class ShardServer(MultiAyaneruServer):
+    def __init__(self, conn: Connection):
+        super().__init__()
+        self.conn = conn
+
+        # エンジンを起動しなおすスレッドからも送るので、pipeを用いるときはlockしておく。
+        self.conn_lock = threading.Lock()
+
+    def add_kifu(self, kifu: GameKifu):
+        with self.conn_lock:
+            self.conn.send(kifu_to_record(kifu))
+
+    # エンジンを起動しなおした数は、親プロセスで数える。
+    def add_engine_hang(self, void: bool):
+        with self.conn_lock:
+            self.conn.send((HANG_RECORD, void))
+
+    def add_recycled_engines(self, n: int):
+        with self.conn_lock:
+            self.conn.send((RECYCLE_RECORD, n))
+
+    # 子プロセスで対局を続けられなくなったことは、親プロセスに送って、そちらで待っているものを起こす。
+    def set_error(self, error: str):
+        super().set_error(error)
+        with self.conn_lock:
+            self.conn.send((ERROR_RECORD, error))
+
+    # 親プロセスに次の組を要求する。(match_sourceとして用いる)
+    # 組の番号は親プロセスで振られていて、戦績も親プロセスで集計される。
+    def request_match(self) -> Optional[EngineMatch]:
+        with self.conn_lock:
+            self.conn.send(None)
+            return self.conn.recv()
+
+
+# 子プロセスのエントリーポイント
+# 例外が発生したら、そのtracebackを親プロセスに送ってから終了する。
+def shard_worker(config: Dict, conn: Connection, stop_event):
+    server = ShardServer(conn)
+    try:
+        run_shard(server, config, stop_event)
+    except Exception:
+        with server.conn_lock:
+            conn.send((ERROR_RECORD, traceback.format_exc()))
+        raise
+    finally:
+        conn.close()
+
+
+# 子プロセスで、configのとおりに対局サーバーを設定して、stop_eventが設定されるまで対局させる。
+def run_shard(server: "ShardServer", config: Dict, stop_event):
+    server.debug_print = config["debug_print"]
+    server.error_print = config["error_print"]
+    server.info_capture_level = config["info_capture_level"]
+    server.watchdog_margin = config["watchdog_margin"]
+    server.watchdog_policy = config["watchdog_policy"]
+    server.recycle_games = config["recycle_games"]
+    server.recycle_rss_growth = config["recycle_rss_growth"]
+    server.cpu_affinity = config["cpu_affinity"]
+    server.cpu_threads = config["cpu_threads"]
+    server.cpu_sets = config["cpu_sets"]
+    server.concurrency_controller = config["concurrency_controller"]
+    server.max_games = config["max_games"]
+    server.init_server(config["server_num"])
+    if config["match_mode"]:
+        server.match_source = server.request_match
+    else:
+        for player, (engine_path, engine_options) in enumerate(
+            config["engine_configs"]
+        ):
+            server.init_engine(player, engine_path, engine_options)
+    server.set_time_setting(config["time_setting"])
+    server.start_sfens = config["start_sfens"]
+    server.start_gameply = config["start_gameply"]
+    if config["book"] is not None:
+        server.book = OpeningBook(*config["book"])
+    server.flip_turn_every_game = config["flip_turn_every_game"]
+    server.paired_openings = config["paired_openings"]
+
+    server.game_start()
+    stop_event.wait()
+    server.game_stop()
+    server.terminate()
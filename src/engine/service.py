@@ -1,10 +1,27 @@
-from typing import List
+from array import array
+from typing import Iterator, List, Optional, Tuple
+
+from src.engine.enums import UsiBound, UsiEvalSpecialValue
+from src.engine.eval import UsiEvalValue
 
 
 # 思考エンジンから送られてきた読み筋を表現するクラス。
 # "info pv ..."を解釈したもの。
 # 送られてこなかった値に関してはNoneになっている。
+# 対局の全指し手ぶん保持することがあるので、__slots__にして__dict__を持たないようにしてある。
 class UsiThinkPV:
+    __slots__ = [
+        "pv",
+        "eval",
+        "depth",
+        "seldepth",
+        "nodes",
+        "time",
+        "hashfull",
+        "nps",
+        "bound",
+    ]
+
     def __init__(self):
         # --- public members ---
 
@@ -64,14 +81,77 @@ class UsiThinkPV:
 
     # to_string()の下請け。str2がNoneではないとき、s[]に、str1とstr2をappendする。
     @classmethod
-    def append(cls, s: List[str], str1: str, str2: str):
+    def append(cls, s: List[str], str1: str, str2):
         if str2 is not None:
             s.append(str1)
-            s.append(str2)
+            s.append(str(str2))
+
+
+# 思考エンジンから送られてきた読み筋の履歴を、数値の配列で保持するクラス。(struct of arrays)
+# MultiPVの数が多いエンジンで、すべての読み筋を保持したいときに用いる。
+# 読み筋の文字列は保持しない。
+# 値が送られてこなかったときは、depth , nodesは0、evalはValueNoneになる。
+class UsiThinkHistory:
+    __slots__ = ["multipv", "depth", "nodes", "eval", "bound"]
+
+    def __init__(self):
+        # multipvの何番目の読み筋であったか(1 origin)
+        self.multipv = array("H")
+
+        # 読みの深さ
+        self.depth = array("H")
+
+        # 読みのノード数
+        self.nodes = array("q")
+
+        # 評価値
+        self.eval = array("i")
+
+        # bound。UsiBoundの値。
+        self.bound = array("B")
+
+    # 読み筋を1つ追加する。
+    def append(self, multipv: int, pv: UsiThinkPV):
+        self.multipv.append(multipv)
+        self.depth.append(pv.depth if pv.depth is not None else 0)
+        self.nodes.append(pv.nodes if pv.nodes is not None else 0)
+        self.eval.append(
+            pv.eval if pv.eval is not None else UsiEvalSpecialValue.ValueNone
+        )
+        self.bound.append(
+            pv.bound.value if pv.bound is not None else UsiBound.BoundNone.value
+        )
+
+    # 保持している読み筋の数
+    def __len__(self) -> int:
+        return len(self.depth)
+
+    # i番目の読み筋を(multipv , depth , nodes , eval , bound)のtupleで返す。
+    # 評価値が送られてこなかったときのevalはNone。
+    def get(
+        self, i: int
+    ) -> Tuple[int, int, int, Optional[UsiEvalValue], UsiBound]:
+        eval_ = self.eval[i]
+        return (
+            self.multipv[i],
+            self.depth[i],
+            self.nodes[i],
+            UsiEvalValue(eval_) if eval_ != UsiEvalSpecialValue.ValueNone else None,
+            UsiBound(self.bound[i]),
+        )
+
+    # 保持している読み筋を順番に返す。
+    def __iter__(
+        self,
+    ) -> Iterator[Tuple[int, int, int, Optional[UsiEvalValue], UsiBound]]:
+        for i in range(len(self)):
+            yield self.get(i)
 
 
 # 思考エンジンに対して送った"go"コマンドに対して思考エンジンから返ってきた情報を保持する構造体
 class UsiThinkResult:
+    __slots__ = ["bestmove", "ponder", "pvs", "checkmate", "history"]
+
     def __init__(self):
 
         # --- public members ---
@@ -94,6 +174,10 @@ class UsiThinkResult:
         # 詰め将棋エンジンの応答
         self.checkmate = None # str
 
+        # 解釈したすべての読み筋の履歴
+        # UsiEngine.record_think_history == Trueのときだけ記録される。それ以外のときはNone。
+        self.history: Optional[UsiThinkHistory] = None
+
     # このインスタンスの内容を文字列化する。(主にデバッグ用)
     def to_string(self) -> str:
         s = ""
@@ -0,0 +1,98 @@
+import threading
+from collections import deque
+from typing import IO, Deque, List, Optional
+
+# エンジンの標準エラー出力を保持しておくためのモジュール。
+#
+# 標準エラー出力をpipeにしたまま読まずにいると、pipeのbufferが一杯になったところで
+# エンジンが書き込みでblockして、探索の途中で止まってしまう。(時間切れの原因になる)
+# そこで常に読み出しておき、最後のほうの行だけをメモリ上に残しておく。
+
+# 1行の最大の長さ[bytes]。これより長い行は分割して読み出す。
+MAX_LINE_BYTES = 4096
+
+
+# 最後のmax_lines行だけを保持するリングバッファ。
+# spill_pathを指定すると、すべての行をそのファイルにも追記する。
+class StderrBuffer:
+    # max_lines : 保持する最大の行数
+    # spill_path : すべての行を追記するファイルのpath。Noneなら書き出さない。
+    def __init__(self, max_lines: int = 200, spill_path: Optional[str] = None):
+
+        # --- public readonly members ---
+
+        # 保持する最大の行数
+        self.max_lines = max_lines
+
+        # すべての行を追記するファイルのpath
+        self.spill_path = spill_path
+
+        # これまでに受け取った行数(捨てたものも含む)
+        self.total_lines = 0
+
+        # --- private members ---
+
+        # 最後のmax_lines行
+        self.lines: Deque[str] = deque(maxlen=max_lines)
+
+        # spill_pathのファイル。最初に書き込むときに開く。
+        self.spill_file: Optional[IO[str]] = None
+
+        # lines , spill_fileを操作するときのlock object
+        self.lock_object = threading.Lock()
+
+    # 1行加える。
+    def append(self, line: str):
+        with self.lock_object:
+            self.lines.append(line)
+            self.total_lines += 1
+            if self.spill_path is not None:
+                if self.spill_file is None:
+                    self.spill_file = open(self.spill_path, "a", encoding="utf-8")
+                self.spill_file.write(line + "\n")
+                self.spill_file.flush()
+
+    # 保持している行を古い順に返す。
+    def get_lines(self) -> List[str]:
+        with self.lock_object:
+            return list(self.lines)
+
+    # streamが終端に達するまで読み出して、1行ずつappend()する。(読み出し用のスレッドで呼び出す)
+    # 文字コードが壊れていても読み出しが止まらないように、bytesで読んでから置き換えつつdecodeする。
+    def drain(self, stream: IO[bytes]):
+        while True:
+            line = stream.readline(MAX_LINE_BYTES)
+            if not line:
+                break
+            self.append(line.decode("utf-8", errors="replace").rstrip("\r\n"))
+
+    # asyncio.StreamReaderが終端に達するまで読み出して、1行ずつappend()する。(AsyncUsiEngineのtaskで呼び出す)
+    # StreamReader.readline()はlimitを超える長い行で例外になるので、まとめて読み出して行に分割する。
+    # drain()と同じく、MAX_LINE_BYTESより長い行は分割する。
+    async def drain_async(self, stream):
+        rest = b""
+        while True:
+            chunk = await stream.read(MAX_LINE_BYTES)
+            if not chunk:
+                break
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                for i in range(0, max(len(line), 1), MAX_LINE_BYTES):
+                    self.append_bytes(line[i : i + MAX_LINE_BYTES])
+            while len(rest) >= MAX_LINE_BYTES:
+                self.append_bytes(rest[:MAX_LINE_BYTES])
+                rest = rest[MAX_LINE_BYTES:]
+        if rest:
+            self.append_bytes(rest)
+
+    # bytesのままの1行を、置き換えつつdecodeしてappend()する。
+    def append_bytes(self, line: bytes):
+        self.append(line.decode("utf-8", errors="replace").rstrip("\r"))
+
+    # spill_pathのファイルを閉じる。
+    def close(self):
+        with self.lock_object:
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
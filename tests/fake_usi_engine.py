@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# テスト用のUSIエンジンもどき
+# 本物の思考エンジンの代わりに、決め打ちの応答を返す。
+# 挙動はsetoptionで変更できる。
+#   ResignPly : この手数(開始局面からの手数)に達したら投了する。(デフォルト10)
+#   InfoLines : bestmoveの前に出力するinfo行の数。(デフォルト3 , 1000行を超える分はdepth 1からの繰り返し)
+#   MoveTime  : 1手ごとに消費する時間[ms]。(デフォルト0)
+#   ReadyDelay: "isready"に対して"readyok"を返すまでの時間[ms]。(デフォルト0)
+#   HangPly   : この手数に達したら応答しなくなる。(デフォルト0 = 無効)
+#   CrashPly  : この手数に達したら異常終了する。(デフォルト0 = 無効)
+#   StderrLines: 1手ごとに標準エラー出力に書き出す行数。(デフォルト0)
+#   InfoStringBytes: bestmoveの前に出力する"info string"行の長さ[bytes]。(デフォルト0 = 出力しない)
+import sys
+import time
+
+# 適当な指し手。合法かどうかはチェックしない。
+DUMMY_MOVES = ["7g7f", "3c3d", "2g2f", "8c8d", "2f2e", "8d8e", "6i7h", "4a3b"]
+
+# "info"行をまとめて書き出す行数
+INFO_BLOCK = 1000
+
+
+def output(message: str):
+    sys.stdout.write(message + "\n")
+    sys.stdout.flush()
+
+
+def main():
+    options = {
+        "ResignPly": 10,
+        "InfoLines": 3,
+        "MoveTime": 0,
+        "ReadyDelay": 0,
+        "HangPly": 0,
+        "CrashPly": 0,
+        "StderrLines": 0,
+        "InfoStringBytes": 0,
+    }
+    ply = 0
+    black = True
+    infinite = False
+
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+
+        if command == "usi":
+            output("id name FakeUsiEngine")
+            output("usiok")
+        elif command == "setoption":
+            # "setoption name XXX value YYY"
+            if len(tokens) >= 5 and tokens[3] == "value":
+                name = tokens[2]
+                if name in options:
+                    options[name] = int(tokens[4])
+        elif command == "isready":
+            time.sleep(options["ReadyDelay"] / 1000)
+            output("readyok")
+        elif command == "position":
+            if "moves" in tokens:
+                moves = len(tokens) - tokens.index("moves") - 1
+            else:
+                moves = 0
+            if tokens[1] == "sfen":
+                black = tokens[3] == "b"
+            else:
+                black = True
+            if moves % 2 == 1:
+                black = not black
+            ply = moves
+        elif command == "go":
+            # 応答しなくなる前に書き出したものも読み出せるか確かめられるように、先に書き出しておく。
+            for i in range(options["StderrLines"]):
+                sys.stderr.write(
+                    "warning ply {0} line {1} {2}\n".format(ply, i, "x" * 100)
+                )
+            sys.stderr.flush()
+            if options["HangPly"] and ply + 1 >= options["HangPly"]:
+                # 応答しなくなったエンジンを模倣する。
+                time.sleep(3600)
+            if options["CrashPly"] and ply + 1 >= options["CrashPly"]:
+                # 対局中に異常終了したエンジンを模倣する。
+                sys.exit(1)
+            infinite = "infinite" in tokens
+            time.sleep(options["MoveTime"] / 1000)
+            if options["InfoStringBytes"]:
+                output("info string " + "x" * options["InfoStringBytes"])
+            output_info(options["InfoLines"])
+            if not infinite:
+                output(bestmove(ply, options))
+        elif command == "stop":
+            if infinite:
+                infinite = False
+                output(bestmove(ply, options))
+        elif command == "moves":
+            output(" ".join(DUMMY_MOVES))
+        elif command == "side":
+            output("black" if black else "white")
+        elif command == "quit":
+            break
+
+
+# "info"行をn行出力する。
+# 大量に出力させて読み出す側の速さを測ることもあるので、INFO_BLOCK行ずつまとめて作って書き出す。
+# (INFO_BLOCK行を超える分は、depth 1からの繰り返しになる)
+def output_info(n: int):
+    block = "".join(
+        "info depth {0} seldepth {1} score cp {2} nodes {3} nps 1000 time {4} pv {5}\n".format(
+            depth, depth + 2, depth * 10 - 20, depth * 100, depth, " ".join(DUMMY_MOVES[0:depth])
+        )
+        for depth in range(1, min(n, INFO_BLOCK) + 1)
+    )
+    for _ in range(n // INFO_BLOCK):
+        sys.stdout.write(block)
+    if n % INFO_BLOCK:
+        sys.stdout.write(block[: nth_line_end(block, n % INFO_BLOCK)])
+
+
+# textの先頭からn行目の末尾(改行の次)の位置
+def nth_line_end(text: str, n: int) -> int:
+    end = 0
+    for _ in range(n):
+        end = text.index("\n", end) + 1
+    return end
+
+
+# 現在の手数に対するbestmove文字列
+def bestmove(ply: int, options: dict) -> str:
+    if ply + 1 >= options["ResignPly"]:
+        return "bestmove resign"
+    move = DUMMY_MOVES[ply % len(DUMMY_MOVES)]
+    ponder = DUMMY_MOVES[(ply + 1) % len(DUMMY_MOVES)]
+    return "bestmove {0} ponder {1}".format(move, ponder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+from src.engine.book import OpeningBook
+from src.engine.server_multi import MultiAyaneruServer
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+SFEN = "sfen lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL w - 1"
+
+BOOK = (
+    "﻿startpos moves 7g7f 3c3d 2g2f 8c8d\r\n"
+    "\n"
+    "  " + SFEN + " moves 3c3d 7g7f\n"
+    "startpos\n"
+    "startpos moves 2g2f"
+)
+
+
+class TestOpeningBook(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "book.sfen")
+        with open(self.path, "w", encoding="utf-8", newline="") as f:
+            f.write(BOOK)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_read(self):
+        book = OpeningBook(self.path)
+        self.assertEqual(len(book), 4)
+        self.assertEqual(book.get_sfen(0), "startpos moves 7g7f 3c3d 2g2f 8c8d")
+        self.assertEqual(book.get_sfen(1), SFEN + " moves 3c3d 7g7f")
+        self.assertEqual(book.get_sfen(2), "startpos")
+        self.assertEqual(book.get_sfen(3), "startpos moves 2g2f")
+        book.close()
+
+    # start_gameplyの手数の局面までで切り詰められる。
+    def test_start_gameply(self):
+        book = OpeningBook(self.path, 3)
+        self.assertEqual(book.get_sfen(0), "startpos moves 7g7f 3c3d")
+        self.assertEqual(book.get_sfen(1), SFEN + " moves 3c3d 7g7f")
+        self.assertEqual(book.get_sfen(2), "startpos")
+        self.assertEqual(book.get_sfen(3), "startpos moves 2g2f")
+        self.assertIn(book.random_sfen(), [book.get_sfen(i) for i in range(4)])
+        book.close()
+
+        book = OpeningBook(self.path, 1)
+        self.assertEqual(book.get_sfen(0), "startpos moves")
+        book.close()
+
+    def test_empty_book(self):
+        path = os.path.join(self.tempdir.name, "empty.sfen")
+        open(path, "w").close()
+        book = OpeningBook(path)
+        self.assertEqual(len(book), 0)
+        with self.assertRaises(ValueError):
+            book.random_sfen()
+        book.close()
+
+    # 後手番から始まる局面でも、手番がずれずに対局できる。
+    def test_server_book(self):
+        path = os.path.join(self.tempdir.name, "white.sfen")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(SFEN + " moves 3c3d 7g7f 8c8d\n")
+
+        server = MultiAyaneruServer()
+        server.book = OpeningBook(path, 3)
+        server.init_server(2)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        self.assertTrue(server.wait_for_games(4, timeout=30))
+        server.game_stop()
+        server.terminate()
+
+        # 2手進めた後手番の局面から始まり、7手進んだ局面で手番側(先手)が投了する。
+        kifu = server.game_kifus[0]
+        self.assertEqual(kifu.start_position, SFEN)
+        self.assertEqual(kifu.moves[:2], ["3c3d", "7g7f"])
+        self.assertEqual(len(kifu.moves), 7)
+        self.assertEqual(server.white_win, server.total_games)
+        server.book.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import time
+import unittest
+
+from src.engine.concurrency import (
+    ConcurrencyController,
+    ConcurrencyPlanner,
+    parse_cores,
+)
+from src.engine.engine_pool import UsiEnginePool
+from src.engine.server_multi import MultiAyaneruServer
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+
+class TestConcurrencyPlanner(unittest.TestCase):
+    # メモリを考慮しなければ、CPUの数だけで決まる。(従来と同じ)
+    def test_cpu_only(self):
+        planner = ConcurrencyPlanner(cores=8, memory=0)
+        self.assertEqual(planner.plan([(FAKE_ENGINE_PATH, None)] * 2, 2), 3)
+        self.assertEqual(planner.memory_per_key, {})
+        # CPUが足りなくても最低1
+        self.assertEqual(planner.plan([(FAKE_ENGINE_PATH, None)] * 2, 16), 1)
+        self.assertEqual(parse_cores("auto"), None)
+        self.assertEqual(parse_cores("12"), 12)
+
+    # エンジンを起動して計測し、メモリに収まる並列数にする。
+    def test_memory(self):
+        pool = UsiEnginePool()
+        planner = ConcurrencyPlanner(cores=20, memory=4500)
+        planner.engine_pool = pool
+        options = {"Hash": "1000"}
+        server_num = planner.plan([(FAKE_ENGINE_PATH, options)] * 2, 1)
+
+        # Hashの値より小さくは見積もらない。
+        memory = planner.probe(FAKE_ENGINE_PATH, options)
+        self.assertGreaterEqual(memory, 1000)
+        self.assertEqual(server_num, 4500 // (memory * 2))
+        self.assertIn("memory 4500MB", planner.plan_info)
+
+        # 同じエンジンは1回だけ計測して、計測に用いたエンジンはpoolに返却されている。
+        self.assertEqual(pool.spawned, 1)
+        self.assertEqual(pool.idle_count(), 1)
+        pool.close()
+
+
+class TestConcurrencyController(unittest.TestCase):
+    def test_controller(self):
+        controller = ConcurrencyController(min_servers=1)
+        controller.initial_servers = 2
+        self.assertEqual(controller.start(4), 2)
+        now = time.time()
+
+        # 超過のない対局が grow_games × 並列数 局続いたら増やす。
+        for _ in range(3):
+            self.assertEqual(controller.on_game_over(now, 0, False), 0)
+        self.assertEqual(controller.on_game_over(now, 0, False), 1)
+        self.assertEqual(controller.active, 3)
+
+        # 増やす前に開始した対局は判定に用いない。
+        self.assertEqual(controller.on_game_over(now, 0, True), 0)
+        self.assertEqual(controller.timeups, 1)
+
+        # 超過していたら減らして、次に増やすのに必要な対局数を倍にする。
+        now = time.time()
+        self.assertEqual(controller.on_game_over(now, 1000, False), -1)
+        self.assertEqual(controller.active, 2)
+        self.assertEqual(controller.grow_games, 4)
+
+        # 下限より減らさない。
+        now = time.time()
+        self.assertEqual(controller.on_game_over(now, 0, True), -1)
+        now = time.time()
+        self.assertEqual(controller.on_game_over(now, 0, True), 0)
+        self.assertEqual(controller.active, 1)
+
+    # エンジンが時間どおりに指せていなければ、対局サーバーを止めていく。
+    def test_server(self):
+        server = MultiAyaneruServer()
+        server.concurrency_controller = ConcurrencyController(min_servers=1)
+        server.init_server(3)
+        # 秒読み0.1秒に対して0.7秒かけて指すので、毎手0.6秒超過する。
+        options = {"ResignPly": "2", "MoveTime": "700"}
+        server.init_engine(0, FAKE_ENGINE_PATH, options)
+        server.init_engine(1, FAKE_ENGINE_PATH, options)
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        try:
+            self.assertTrue(server.wait_for_games(6, timeout=60))
+        finally:
+            server.game_stop()
+
+        controller = server.concurrency_controller
+        self.assertEqual(controller.active, 1)
+        self.assertEqual(controller.shrinks, 2)
+        self.assertEqual(controller.timeups, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+
+from src.engine.cpu_affinity import (
+    format_cpu_list,
+    get_cpu_topology,
+    parse_cpu_list,
+    plan_cpu_sets,
+)
+from src.engine.server_multi import MultiAyaneruServer
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+
+class TestCpuAffinity(unittest.TestCase):
+    def test_cpu_list(self):
+        self.assertEqual(parse_cpu_list("0-3,8,10-11\n"), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(format_cpu_list([11, 0, 1, 2, 3, 8, 10]), "0-3,8,10-11")
+        self.assertEqual(format_cpu_list([]), "")
+
+    # SMTのsiblingは同じ対局サーバーにまとめ、番号の大きい物理コアから割り当てる。
+    def test_plan(self):
+        topology = [(0, [0, 4]), (0, [1, 5]), (0, [2, 6]), (0, [3, 7])]
+        self.assertEqual(plan_cpu_sets(3, 2, topology), [[3, 7], [2, 6], [1, 5]])
+        # CPUが足りなければNone
+        self.assertEqual(
+            plan_cpu_sets(3, 3, topology), [[2, 3, 6, 7], [0, 1, 4, 5], None]
+        )
+
+        # 1つの対局サーバーが複数のpackageにまたがらない。
+        topology = [(0, [0]), (0, [1]), (1, [2]), (1, [3]), (1, [4])]
+        self.assertEqual(plan_cpu_sets(3, 2, topology), [[3, 4], [0, 1], None])
+
+    # SMT 2で対局サーバーが論理コアと同じ数あるときは、物理コア単位では足りないので論理コア単位で割り当てる。
+    def test_plan_smt(self):
+        topology = [(0, [0, 4]), (0, [1, 5]), (0, [2, 6]), (0, [3, 7])]
+        plan = plan_cpu_sets(8, 1, topology)
+        self.assertEqual(plan, [[7], [3], [6], [2], [5], [1], [4], [0]])
+        # 足りるならsiblingはまとめたまま。
+        self.assertEqual(
+            plan_cpu_sets(4, 2, topology), [[3, 7], [2, 6], [1, 5], [0, 4]]
+        )
+        # 論理コア単位でも足りなければ、割り当てられる数が多いほうにする。
+        plan = plan_cpu_sets(9, 1, topology)
+        self.assertEqual(plan.count(None), 1)
+        self.assertEqual(sorted(c for cpus in plan[:8] for c in cpus), list(range(8)))
+
+    def test_topology(self):
+        with tempfile.TemporaryDirectory() as sysfs:
+            for cpu, (package, siblings) in enumerate(
+                [(0, "0,2"), (0, "1,3"), (0, "0,2"), (0, "1,3")]
+            ):
+                path = os.path.join(sysfs, "cpu{0}".format(cpu), "topology")
+                os.makedirs(path)
+                with open(os.path.join(path, "physical_package_id"), "w") as f:
+                    f.write("{0}\n".format(package))
+                with open(os.path.join(path, "thread_siblings_list"), "w") as f:
+                    f.write(siblings + "\n")
+            self.assertEqual(
+                get_cpu_topology([0, 1, 2, 3], sysfs), [(0, [0, 2]), (0, [1, 3])]
+            )
+            # topology情報がないCPUは、1つずつ物理コアとみなす。
+            self.assertEqual(
+                get_cpu_topology([0, 2, 5], sysfs), [(0, [0, 2]), (0, [5])]
+            )
+
+    @unittest.skipUnless(hasattr(os, "sched_getaffinity"), "needs sched_setaffinity")
+    def test_server(self):
+        cpus = sorted(os.sched_getaffinity(0))
+        server = MultiAyaneruServer()
+        server.cpu_affinity = True
+        server.cpu_sets = [[cpus[-1]]]
+        server.init_server(1)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "6"})
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        try:
+            self.assertIn(
+                "server 0 : cpus {0}".format(cpus[-1]), server.cpu_affinity_report
+            )
+            for engine in server.servers[0].engines:
+                self.assertEqual(os.sched_getaffinity(engine.proc.pid), {cpus[-1]})
+            self.assertTrue(server.wait_for_games(2, timeout=30))
+        finally:
+            server.game_stop()
+            server.terminate()
+
+
+if __name__ == "__main__":
+    unittest.main()
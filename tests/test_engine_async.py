@@ -0,0 +1,246 @@
+import asyncio
+import io
+import os
+import unittest
+from contextlib import redirect_stdout
+
+from src.engine.engine_async import AsyncUsiEngine
+from src.engine.engine_pool import UsiEnginePool
+from src.engine.enums import Turn, UsiEngineState, WatchdogPolicy
+from src.engine.server_async import AsyncMultiAyaneruServer
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+
+class TestAsyncUsiEngine(unittest.TestCase):
+    def test_engine(self):
+        async def run():
+            usi = AsyncUsiEngine()
+            usi.set_engine_options({"InfoLines": "5"})
+            await usi.connect(FAKE_ENGINE_PATH)
+            await usi.usi_position("startpos moves 7g7f")
+
+            self.assertEqual(await usi.get_side_to_move(), Turn.WHITE)
+            self.assertTrue(len((await usi.get_moves()).split()) > 0)
+
+            await usi.usi_go_and_wait_bestmove("btime 0 wtime 0 byoyomi 100")
+            self.assertEqual(usi.think_result.bestmove, "3c3d")
+            self.assertEqual(usi.think_result.pvs[0].depth, 5)
+
+            # "go infinite"は"stop"を送るまでbestmoveが返ってこない。
+            await usi.usi_go("infinite")
+            await usi.usi_stop()
+            await usi.wait_bestmove()
+            self.assertIsNotNone(usi.think_result.bestmove)
+
+            await usi.disconnect()
+            self.assertEqual(usi.engine_state, UsiEngineState.Disconnected)
+
+        asyncio.run(run())
+
+    # StreamReaderのlimit(64KiB)より長い行が送られてきても、切断扱いにならない。
+    def test_long_line(self):
+        async def run():
+            usi = AsyncUsiEngine()
+            usi.set_engine_options({"InfoStringBytes": "100000"})
+            await usi.connect(FAKE_ENGINE_PATH)
+            await usi.usi_position("startpos")
+
+            await usi.usi_go_and_wait_bestmove("btime 0 wtime 0 byoyomi 100")
+            self.assertEqual(usi.think_result.bestmove, "7g7f")
+            self.assertEqual(usi.engine_state, UsiEngineState.WaitCommand)
+
+            await usi.disconnect()
+
+        asyncio.run(run())
+
+    # 標準エラー出力は読み出され続けて、異常終了したあとも最後の行を参照できる。
+    def test_stderr(self):
+        async def run():
+            usi = AsyncUsiEngine()
+            usi.error_print = False
+            usi.stderr_lines = 3
+            usi.set_engine_options({"StderrLines": "2", "CrashPly": "2"})
+            await usi.connect(FAKE_ENGINE_PATH)
+            await usi.usi_position("startpos")
+            await usi.usi_go_and_wait_bestmove("btime 0 wtime 0 byoyomi 100")
+
+            await usi.usi_position("startpos moves 7g7f")
+            with self.assertRaises(ValueError):
+                await usi.usi_go_and_wait_bestmove("btime 0 wtime 0 byoyomi 100")
+            await usi.disconnect()
+
+            lines = usi.get_stderr()
+            self.assertEqual(len(lines), 3)
+            self.assertTrue(lines[0].startswith("warning ply 0 line 1 "))
+            self.assertTrue(lines[2].startswith("warning ply 1 line 1 "))
+
+        asyncio.run(run())
+
+    # たくさんの対局を1つのevent loopで並列に行う
+    def test_multi_server(self):
+        async def run():
+            server = AsyncMultiAyaneruServer()
+            server.init_server(16)
+            await server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "12"})
+            await server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "12"})
+            server.set_time_setting("byoyomi 100")
+
+            await server.game_start()
+            self.assertTrue(await server.wait_for_games(64, timeout=30))
+            await server.game_stop()
+
+            self.assertGreaterEqual(server.total_games, 64)
+            self.assertEqual(len(server.game_kifus), server.total_games)
+            self.assertIn("-", server.game_info())
+
+            await server.terminate()
+
+        asyncio.run(run())
+
+    # 対局中に異常終了したエンジンは起動しなおされて、その対局は無効になり対局しなおされる。
+    def test_multi_server_engine_crash(self):
+        async def run():
+            server = AsyncMultiAyaneruServer()
+            server.max_games = 2
+            server.init_server(1)
+            await server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "12"})
+            await server.init_engine(
+                1, FAKE_ENGINE_PATH, {"ResignPly": "12", "CrashPly": "4"}
+            )
+            server.set_time_setting("byoyomi 100")
+            crash_engine = server.servers[0].engines[1]
+            crash_engine.error_print = False
+
+            await server.game_start()
+            for _ in range(300):
+                if server.void_games >= 2:
+                    break
+                await asyncio.sleep(0.1)
+            await server.game_stop()
+
+            # 起動しなおしてもまた異常終了するので、何度でもやり直されて集計はされない。
+            self.assertGreaterEqual(server.void_games, 2)
+            self.assertEqual(server.engine_hangs, server.void_games)
+            self.assertEqual(server.total_games, 0)
+            self.assertLessEqual(server.started_games, 1)
+
+            await server.terminate()
+
+        asyncio.run(run())
+
+    # 持ち時間を過ぎても"bestmove"を返さないエンジンは強制終了されて、起動しなおされる。
+    def test_multi_server_watchdog(self):
+        async def run():
+            server = AsyncMultiAyaneruServer()
+            server.max_games = 2
+            server.flip_turn_every_game = False
+            server.watchdog_margin = 0.5
+            server.watchdog_policy = WatchdogPolicy.Loss
+            server.init_server(1)
+            await server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+            await server.init_engine(
+                1,
+                FAKE_ENGINE_PATH,
+                {"ResignPly": "8", "HangPly": "4", "StderrLines": "1"},
+            )
+            server.set_time_setting("byoyomi 100")
+            hung_engine = server.servers[0].engines[1]
+            first_pid = hung_engine.proc.pid
+
+            await server.game_start()
+            self.assertTrue(await server.wait_for_games(2, timeout=30))
+            self.assertNotEqual(hung_engine.proc.pid, first_pid)
+            await server.game_stop()
+
+            # 後手(2P側)が4手目で応答しなくなるので、すべて1P側の勝ち。
+            self.assertEqual(server.player1_win, 2)
+            self.assertEqual(server.engine_hangs, 2)
+            self.assertEqual(server.void_games, 0)
+
+            await server.terminate()
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            asyncio.run(run())
+        self.assertIn("Error! : engine is not responding", output.getvalue())
+        self.assertIn("  stderr : warning ply 3 line 0", output.getvalue())
+
+    # エンジンを起動しなおせず、すべての対局サーバーが止まったら、wait_for_games()は例外をraiseする。
+    def test_multi_server_all_stopped(self):
+        async def run():
+            server = AsyncMultiAyaneruServer()
+            server.max_games = 2
+            server.init_server(1)
+            await server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "12"})
+            await server.init_engine(
+                1, FAKE_ENGINE_PATH, {"ResignPly": "12", "CrashPly": "4"}
+            )
+            server.set_time_setting("byoyomi 100")
+            crash_engine = server.servers[0].engines[1]
+            crash_engine.error_print = False
+
+            await server.game_start()
+            # 起動しなおそうとしても、実行ファイルが見つからない。
+            crash_engine.engine_path = os.path.join(
+                os.path.dirname(__file__), "missing"
+            )
+            with self.assertRaises(ValueError):
+                await server.wait_for_games(2, timeout=30)
+            await server.game_stop()
+            await server.terminate()
+
+        asyncio.run(run())
+
+
+    # "readyok"が返ってこなかったエンジンを用いる対局サーバーは取り除かれて、残りで対局する。
+    def test_multi_server_ready_timeout(self):
+        async def run():
+            server = AsyncMultiAyaneruServer()
+            server.max_games = 4
+            server.engine_ready_timeout = 1.0
+            server.init_server(2)
+            await server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+            await server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+            server.set_time_setting("byoyomi 100")
+            slow_engine = server.servers[1].engines[1]
+            await slow_engine.disconnect()
+            slow_engine.set_engine_options({"ReadyDelay": "10000"})
+            await slow_engine.connect(FAKE_ENGINE_PATH)
+
+            await server.game_start()
+            self.assertTrue(await server.wait_for_games(4, timeout=30))
+            await server.game_stop()
+
+            self.assertEqual(len(server.failed_engines), 1)
+            self.assertIn("readyok timeout", server.failed_engines[0])
+            self.assertEqual(server.total_games, 4)
+            await server.terminate()
+
+        asyncio.run(run())
+
+    # 対応していない設定があれば、game_start()は例外をraiseする。
+    def test_multi_server_unsupported(self):
+        settings = {
+            "match_source": lambda: None,
+            "engine_pool": UsiEnginePool(),
+            "cpu_affinity": True,
+            "recycle_games": 10,
+            "recycle_rss_growth": 100,
+        }
+        for name, value in settings.items():
+            with self.subTest(name=name):
+
+                async def run():
+                    server = AsyncMultiAyaneruServer()
+                    server.init_server(1)
+                    setattr(server, name, value)
+                    with self.assertRaises(ValueError):
+                        await server.game_start()
+
+                asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+import unittest
+
+from src.engine.engine import UsiEngine
+from src.engine.enums import UsiBound, UsiEngineState, UsiInfoCaptureLevel
+from src.engine.eval import UsiEvalValue
+from src.engine.info_parser import parse_info
+from src.engine.service import UsiThinkResult
+
+INFO_LINES = [
+    "info depth 1 seldepth 1 score cp 60 nodes 38 nps 38000 time 1 pv 2g2f",
+    "info depth 2 seldepth 3 score cp 52 upperbound nodes 120 nps 120000 time 1 pv 2g2f 8c8d",
+    "info depth 3 seldepth 4 score cp 48 nodes 412 nps 206000 time 2 pv 7g7f 8c8d 2g2f",
+    "info string this line is a comment",
+]
+
+
+# エンジンには接続せず、受信したメッセージを流し込んで解釈させる。
+def feed(level: UsiInfoCaptureLevel, lines) -> UsiEngine:
+    usi = UsiEngine()
+    usi.info_capture_level = level
+    usi.engine_state = UsiEngineState.WaitBestmove
+    usi.think_result = UsiThinkResult()
+    for line in lines:
+        usi.dispatch_message(line)
+    return usi
+
+
+class TestInfoCaptureLevel(unittest.TestCase):
+    def test_full(self):
+        usi = feed(UsiInfoCaptureLevel.Full, INFO_LINES[0:2])
+        self.assertEqual(usi.think_result.pvs[0].pv, "2g2f 8c8d")
+        usi.dispatch_message("bestmove 2g2f ponder 8c8d")
+        self.assertEqual(usi.think_result.bestmove, "2g2f")
+
+    def test_final_only(self):
+        usi = feed(UsiInfoCaptureLevel.FinalOnly, INFO_LINES)
+        # "bestmove"を受信するまでは解釈されない。
+        self.assertEqual(usi.think_result.pvs, [])
+        usi.dispatch_message("bestmove 7g7f ponder 8c8d")
+        self.assertEqual(len(usi.think_result.pvs), 1)
+        # "info string"は無視されて、その前の読み筋が残る。
+        self.assertEqual(usi.think_result.pvs[0].pv, "7g7f 8c8d 2g2f")
+        self.assertEqual(usi.think_result.pvs[0].eval, 48)
+        self.assertEqual(usi.engine_state, UsiEngineState.WaitCommand)
+
+    def test_think_history(self):
+        usi = UsiEngine()
+        usi.record_think_history = True
+        usi.engine_state = UsiEngineState.WaitCommand
+        # "go"を送信したことにする。(エンジンには接続していないので送信はされない)
+        usi.usi_go("infinite")
+        usi.engine_state = UsiEngineState.WaitBestmove
+        for line in INFO_LINES:
+            usi.dispatch_message(line)
+        history = usi.think_result.history
+        self.assertEqual(len(history), 3)
+        self.assertEqual(list(history.depth), [1, 2, 3])
+        self.assertEqual(list(history.nodes), [38, 120, 412])
+        self.assertEqual(history.get(1)[3], 52)
+        self.assertEqual(history.get(1)[4], UsiBound.BoundUpper)
+
+    def test_no_capture(self):
+        usi = feed(UsiInfoCaptureLevel.NoCapture, INFO_LINES)
+        usi.dispatch_message("bestmove 7g7f")
+        self.assertEqual(usi.think_result.pvs, [])
+        self.assertEqual(usi.think_result.bestmove, "7g7f")
+
+    # read_worker()から渡されるbytesの行も、同じように解釈される。(改行コードが"\r\n"でもよい)
+    def test_dispatch_line(self):
+        for level in UsiInfoCaptureLevel:
+            usi = feed(level, [])
+            for line in INFO_LINES:
+                usi.dispatch_line(line.encode() + b"\r")
+            usi.dispatch_line(b"bestmove 7g7f ponder 8c8d\r")
+            self.assertEqual(usi.think_result.bestmove, "7g7f")
+            self.assertEqual(usi.think_result.ponder, "8c8d")
+            if level == UsiInfoCaptureLevel.NoCapture:
+                self.assertEqual(usi.think_result.pvs, [])
+            else:
+                self.assertEqual(usi.think_result.pvs[0].pv, "7g7f 8c8d 2g2f")
+
+        # 1行応答を待っているときは、"info"で始まる行でもその応答として扱う。
+        usi = feed(UsiInfoCaptureLevel.NoCapture, [])
+        usi.engine_state = UsiEngineState.WaitOneLine
+        usi.dispatch_line(b"info string reply")
+        self.assertEqual(usi.last_received_line, "info string reply")
+        self.assertEqual(usi.engine_state, UsiEngineState.WaitCommand)
+
+    # まとめて読み出した複数行も、1行ずつ渡したときと同じように解釈される。
+    def test_dispatch_block(self):
+        block = "".join(line + "\n" for line in INFO_LINES).encode()
+        for level in UsiInfoCaptureLevel:
+            usi = feed(level, [])
+            # "info"行だけのもの(最後が"info string"のもの)と、"bestmove"を含むもの
+            usi.dispatch_block(block)
+            usi.dispatch_block(block[: block.index(b"info string")])
+            usi.dispatch_block(b"info depth 1 pv 2g2f\nbestmove 2g2f\n")
+            self.assertEqual(usi.think_result.bestmove, "2g2f")
+            if level == UsiInfoCaptureLevel.NoCapture:
+                self.assertEqual(usi.think_result.pvs, [])
+            else:
+                self.assertEqual(usi.think_result.pvs[0].pv, "2g2f")
+
+        # "info string"が最後の行なら、その前の読み筋が残る。
+        usi = feed(UsiInfoCaptureLevel.FinalOnly, [])
+        usi.dispatch_block(block)
+        usi.dispatch_block(b"bestmove 7g7f\n")
+        self.assertEqual(usi.think_result.pvs[0].pv, "7g7f 8c8d 2g2f")
+
+
+class TestParseInfo(unittest.TestCase):
+    def test_fields(self):
+        multipv, pv = parse_info(
+            "info depth 12 seldepth 16 score cp 58 upperbound nodes 51273 nps 1709100 hashfull 3 time 30 pv 2g2f 8c8d"
+        )
+        self.assertEqual(multipv, 1)
+        self.assertEqual(pv.depth, 12)
+        self.assertEqual(pv.seldepth, 16)
+        self.assertEqual(pv.nodes, 51273)
+        self.assertEqual(pv.nps, 1709100)
+        self.assertEqual(pv.hashfull, 3)
+        self.assertEqual(pv.time, 30)
+        self.assertEqual(pv.eval, 58)
+        self.assertEqual(pv.bound, UsiBound.BoundUpper)
+        self.assertEqual(pv.pv, "2g2f 8c8d")
+
+    def test_multipv(self):
+        multipv, pv = parse_info(
+            "info multipv 3 depth 5 score cp -120 lowerbound pv 7g7f"
+        )
+        self.assertEqual(multipv, 3)
+        self.assertEqual(pv.eval, -120)
+        self.assertEqual(pv.bound, UsiBound.BoundLower)
+
+    def test_mate(self):
+        _, pv = parse_info("info depth 9 score mate 7 pv 2d2c+ 3a2b")
+        self.assertEqual(pv.eval, UsiEvalValue.mate_in_ply(7))
+        self.assertEqual(pv.bound, UsiBound.BoundExact)
+        _, pv = parse_info("info depth 9 score mate -4 pv 2d2c+ 3a2b")
+        self.assertEqual(pv.eval, UsiEvalValue.mated_in_ply(4))
+        self.assertTrue(pv.eval.is_mated_score())
+
+    # https://github.com/yaneurao/Ayane/issues/6
+    def test_mate_without_ply(self):
+        self.assertIsNone(
+            parse_info("info depth 1 nodes 0 time 0 score mate + string Nyugyoku")
+        )
+        _, pv = parse_info("info depth 1 score mate -")
+        self.assertTrue(pv.eval.is_mated_score())
+
+    def test_slots(self):
+        _, pv = parse_info(INFO_LINES[0])
+        self.assertFalse(hasattr(pv, "__dict__"))
+        self.assertFalse(hasattr(pv.eval, "__dict__"))
+        self.assertFalse(hasattr(UsiThinkResult(), "__dict__"))
+        self.assertTrue(pv.to_string().startswith("depth 1 seldepth 1 cp 60"))
+
+    def test_string(self):
+        self.assertIsNone(parse_info("info string hash probe 8"))
+
+    def test_unknown_keyword(self):
+        _, pv = parse_info("info depth 3 currmove 7g7f currmovenumber 1 foo nodes 10")
+        self.assertEqual(pv.depth, 3)
+        self.assertEqual(pv.nodes, 10)
+        self.assertIsNone(pv.pv)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import unittest
+
+from src.engine.engine_pool import UsiEnginePool
+from src.engine.enums import UsiEngineState
+from src.engine.server_multi import MultiAyaneruServer
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+
+class TestUsiEnginePool(unittest.TestCase):
+    # MultiAyaneruServerを作り直しても、エンジンは使い回される。
+    def test_reuse_across_servers(self):
+        pool = UsiEnginePool()
+        for _ in range(2):
+            server = MultiAyaneruServer()
+            server.engine_pool = pool
+            server.init_server(2)
+            server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+            server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "6"})
+            server.set_time_setting("byoyomi 100")
+            server.game_start()
+            self.assertTrue(server.wait_for_games(4, timeout=30))
+            server.game_stop()
+            server.terminate()
+
+            self.assertEqual(pool.idle_count(), 4)
+            for _, engine, _ in pool.idle.values():
+                self.assertEqual(engine.engine_state, UsiEngineState.WaitCommand)
+
+        self.assertEqual(pool.spawned, 4)
+        self.assertEqual(pool.reused, 4)
+        pool.close()
+        self.assertEqual(pool.idle_count(), 0)
+
+    # メモリ使用量の上限を超えたら、最も長く使われていないものから終了させる。
+    def test_evict(self):
+        pool = UsiEnginePool()
+        engine_a = pool.lease(FAKE_ENGINE_PATH, {"ResignPly": "1"})
+        engine_b = pool.lease(FAKE_ENGINE_PATH, {"ResignPly": "2"})
+        # 起動途中だとメモリ使用量が0MBと計測されることがあるので、起動し終わってから返却する。
+        self.assertTrue(engine_a.wait_ready(10))
+        self.assertTrue(engine_b.wait_ready(10))
+        pool.release(engine_a)
+        pool.release(engine_b)
+        self.assertEqual(pool.idle_count(), 2)
+
+        memory = sum(m for _, _, m in pool.idle.values())
+        pool.memory_budget = memory - 1
+        engine_c = pool.lease(FAKE_ENGINE_PATH, {"ResignPly": "3"})
+        self.assertEqual(pool.evicted, 1)
+        self.assertEqual(list(pool.idle), [engine_b.instance_id])
+        self.assertEqual(engine_a.engine_state, UsiEngineState.Disconnected)
+
+        # 同じオプションなら、返却されたものが貸し出される。
+        self.assertIs(pool.lease(FAKE_ENGINE_PATH, {"ResignPly": "2"}), engine_b)
+
+        engine_b.disconnect()
+        engine_c.disconnect()
+        pool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
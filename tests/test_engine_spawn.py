@@ -0,0 +1,87 @@
+import os
+import tempfile
+import unittest
+
+from src.engine.engine import UsiEngine, kill_sessions, session_pids
+from src.engine.enums import UsiEngineState
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+
+# /proc/[pid]/cmdlineの引数のlist。取得できなければNone。
+def read_cmdline(pid: int):
+    try:
+        with open("/proc/{0}/cmdline".format(pid), "rb") as f:
+            return f.read().decode().split("\0")
+    except OSError:
+        return None
+
+
+class TestEngineSpawn(unittest.TestCase):
+    # shellを介さずに起動するので、proc.pidがエンジンのプロセスになる。
+    def test_direct(self):
+        engine = UsiEngine()
+        engine.connect(FAKE_ENGINE_PATH)
+        try:
+            self.assertTrue(engine.wait_ready(10))
+            cmdline = read_cmdline(engine.proc.pid)
+            if cmdline is not None:
+                self.assertTrue(cmdline[1].endswith("fake_usi_engine.py"))
+            # Ctrl+Cがエンジンにも届くように、このプロセスと同じprocess groupで起動する。
+            if os.name == "posix":
+                self.assertEqual(os.getpgid(engine.proc.pid), os.getpgid(0))
+        finally:
+            engine.disconnect()
+
+        # shell経由でも起動できる。
+        engine.spawn_with_shell = True
+        engine.connect(FAKE_ENGINE_PATH)
+        self.assertTrue(engine.wait_ready(10))
+        engine.disconnect()
+
+    # shell経由で起動したエンジンは新しいprocess groupになり、このプロセスの終了時にまとめて終了させられる。
+    @unittest.skipUnless(os.name == "posix", "process groups are POSIX only")
+    def test_session(self):
+        engine = UsiEngine()
+        engine.spawn_with_shell = True
+        engine.connect(FAKE_ENGINE_PATH)
+        try:
+            self.assertTrue(engine.wait_ready(10))
+            pid = engine.proc.pid
+            self.assertEqual(os.getpgid(pid), pid)
+            self.assertIn(pid, session_pids)
+
+            # atexitで呼び出されるもの。エンジンはprocess groupごと終了する。
+            kill_sessions()
+            with engine.state_changed_cv:
+                self.assertTrue(
+                    engine.state_changed_cv.wait_for(
+                        lambda: engine.engine_state == UsiEngineState.Disconnected, 10
+                    )
+                )
+        finally:
+            engine.disconnect()
+        self.assertNotIn(pid, session_pids)
+
+    # 起動に失敗したら、すぐに例外になる。
+    def test_exec_failure(self):
+        engine = UsiEngine()
+        with self.assertRaises(FileNotFoundError):
+            engine.connect(FAKE_ENGINE_PATH + ".missing")
+        self.assertEqual(engine.engine_state, UsiEngineState.Disconnected)
+
+        # 実行権限のないファイル
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "engine")
+            with open(path, "w") as f:
+                f.write("not an engine\n")
+            os.chmod(path, 0o644)
+            with self.assertRaises(OSError):
+                engine.connect(path)
+            self.assertEqual(engine.exit_state, "Connection Error")
+            self.assertFalse(engine.is_connected())
+
+
+if __name__ == "__main__":
+    unittest.main()
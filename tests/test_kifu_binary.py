@@ -0,0 +1,103 @@
+import os
+import tempfile
+import unittest
+
+from src.engine.game_result import GameResult
+from src.engine.kifu import GameKifu
+from src.engine.kifu_binary import (
+    KifuBinaryReader,
+    KifuBinaryWriter,
+    binary_to_text,
+    decode_move,
+    encode_move,
+    text_to_binary,
+)
+
+SFENS = [
+    "startpos moves 7g7f 3c3d 8h2b+ 3a2b B*4e",
+    "sfen lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL w - 1 moves 3c3d",
+    "startpos moves",
+]
+
+
+def make_kifu(i: int) -> GameKifu:
+    kifu = GameKifu()
+    kifu.sfen = SFENS[i % len(SFENS)]
+    kifu.flip_turn = i % 2 == 1
+    kifu.game_result = GameResult(i % 4)
+    return kifu
+
+
+class TestKifuBinary(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "kifu.bin")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_encode_move(self):
+        for move in ["7g7f", "8h2b+", "B*4e", "P*1a", "9i1a", "1a9i+"]:
+            code = encode_move(move)
+            self.assertLess(code, 1 << 16)
+            self.assertEqual(decode_move(code), move)
+        with self.assertRaises(ValueError):
+            encode_move("resign")
+        with self.assertRaises(ValueError):
+            encode_move("K*5e")
+
+    def test_write_and_read(self):
+        writer = KifuBinaryWriter(self.path)
+        for i in range(10):
+            writer.write(make_kifu(i))
+        writer.close()
+
+        reader = KifuBinaryReader(self.path)
+        self.assertEqual(len(reader), 10)
+        # 開始局面は重複して格納されない。
+        self.assertEqual(len(reader.positions), 2)
+
+        # ランダムアクセス
+        kifu = reader[4]
+        expected = make_kifu(4)
+        self.assertEqual(kifu.sfen, expected.sfen)
+        self.assertEqual(kifu.flip_turn, expected.flip_turn)
+        self.assertEqual(kifu.game_result, expected.game_result)
+        self.assertEqual(reader[-1].sfen, make_kifu(9).sfen)
+        self.assertEqual(reader.get_header(2), (0, False, GameResult.DRAW, 0))
+        self.assertEqual(
+            list(reader.get_move_codes(1)), [encode_move("3c3d")]
+        )
+        with self.assertRaises(IndexError):
+            reader.get_kifu(10)
+
+        # 順番に読み出す
+        self.assertEqual(
+            [kifu.sfen for kifu in reader], [make_kifu(i).sfen for i in range(10)]
+        )
+        reader.close()
+
+    # closeしていないファイルは読み込めない。
+    def test_unclosed_file(self):
+        writer = KifuBinaryWriter(self.path)
+        writer.write(make_kifu(0))
+        writer.flush()
+        with self.assertRaises(ValueError):
+            KifuBinaryReader(self.path)
+        writer.close()
+
+    def test_convert(self):
+        text_path = os.path.join(self.tempdir.name, "kifu.sfen")
+        with open(text_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(SFENS) + "\n")
+
+        self.assertEqual(text_to_binary(text_path, self.path), len(SFENS))
+
+        text_path2 = os.path.join(self.tempdir.name, "kifu2.sfen")
+        self.assertEqual(binary_to_text(self.path, text_path2), len(SFENS))
+        with open(text_path2, encoding="utf-8") as f:
+            self.assertEqual(f.read().splitlines(), SFENS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+from src.engine.game_result import GameResult
+from src.engine.kifu import GameKifu
+from src.engine.kifu_sink import KifuSink, read_kifus
+from src.engine.server_multi import MultiAyaneruServer
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+
+def make_kifu(i: int) -> GameKifu:
+    kifu = GameKifu()
+    kifu.sfen = "startpos moves 7g7f 3c3d" if i % 2 == 0 else "startpos moves 2g2f"
+    kifu.flip_turn = i % 2 == 1
+    kifu.game_result = GameResult.BLACK_WIN if i % 2 == 0 else GameResult.DRAW
+    return kifu
+
+
+class TestKifuSink(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    # flush_gamesに達するまではファイルに書き出されない
+    def test_batched_flush(self):
+        path = os.path.join(self.tempdir.name, "kifu.jsonl")
+        sink = KifuSink(path, flush_games=3, flush_interval=3600)
+        sink.write(make_kifu(0))
+        sink.write(make_kifu(1))
+        self.assertEqual(len(list(read_kifus(path))), 0)
+        sink.write(make_kifu(2))
+        self.assertEqual(len(list(read_kifus(path))), 3)
+        sink.write(make_kifu(3))
+        sink.close()
+
+        kifus = list(read_kifus(path))
+        self.assertEqual(len(kifus), 4)
+        self.assertEqual(sink.total_games, 4)
+        for i, kifu in enumerate(kifus):
+            expected = make_kifu(i)
+            self.assertEqual(kifu.sfen, expected.sfen)
+            self.assertEqual(kifu.flip_turn, expected.flip_turn)
+            self.assertEqual(kifu.game_result, expected.game_result)
+
+    def test_sfen_format(self):
+        path = os.path.join(self.tempdir.name, "kifu.sfen")
+        sink = KifuSink(path, "sfen")
+        sink.write(make_kifu(0))
+        sink.close()
+        with open(path, encoding="utf-8") as f:
+            self.assertEqual(f.read(), "startpos moves 7g7f 3c3d\n")
+        self.assertEqual(
+            [kifu.moves for kifu in read_kifus(path, "sfen")], [["7g7f", "3c3d"]]
+        )
+
+    def test_invalid_format(self):
+        with self.assertRaises(ValueError):
+            KifuSink(os.path.join(self.tempdir.name, "kifu.txt"), "csa")
+
+    # MultiAyaneruServerに設定して、game_kifusは直近の棋譜だけ保持する。
+    def test_server_kifu_sink(self):
+        path = os.path.join(self.tempdir.name, "kifu.jsonl")
+        sink = KifuSink(path)
+
+        server = MultiAyaneruServer()
+        server.kifu_sink = sink
+        server.game_kifus_limit = 2
+        server.init_server(2)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        self.assertTrue(server.wait_for_games(6, timeout=30))
+        server.game_stop()
+        server.terminate()
+
+        # game_stop()のときにすべて書き出されている。
+        kifus = list(read_kifus(path))
+        self.assertEqual(len(kifus), server.total_games)
+        self.assertEqual(len(server.game_kifus), 2)
+        self.assertEqual(server.game_kifus[-1].sfen, kifus[-1].sfen)
+        self.assertTrue(all(len(kifu.moves) == 7 for kifu in kifus))
+        sink.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import unittest
+from collections import Counter
+
+from src.engine.pairing import PairedOpenings, pentanomial_to_str
+from src.engine.server_multi import MultiAyaneruServer
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+
+class TestPairedOpenings(unittest.TestCase):
+    def test_next_game(self):
+        pairing = PairedOpenings(3)
+        games = [pairing.next_game() for _ in range(12)]
+
+        # 開始局面ごとに、先後を入れ替えて2局ずつ続けて指す。
+        for first, second in zip(games[0::2], games[1::2]):
+            self.assertEqual(first[0], second[0])
+            self.assertEqual((first[1], second[1]), (False, True))
+            self.assertEqual(first[2], second[2])
+
+        # すべての開始局面を使い切るまでは、重複して選ばない。
+        self.assertEqual(sorted(g[0] for g in games[0:6:2]), [0, 1, 2])
+        self.assertEqual(sorted(g[0] for g in games[6:12:2]), [0, 1, 2])
+
+    # 戻した対局は、次に同じ開始局面・手番・組の番号で返される。
+    def test_requeue(self):
+        pairing = PairedOpenings(3)
+        first = pairing.next_game()
+        pairing.requeue(*first)
+        self.assertEqual(pairing.next_game(), first)
+        second = pairing.next_game()
+        self.assertEqual(second, (first[0], True, first[2]))
+        pairing.requeue(*second)
+        self.assertEqual(pairing.next_game(), second)
+
+    def test_add_result(self):
+        pairing = PairedOpenings(1)
+        results = [(1, 1), (1, 0.5), (0, 1), (0.5, 0.5), (0, 0)]
+        for pair_id, scores in enumerate(results):
+            self.assertFalse(pairing.add_result(pair_id, scores[0]))
+            self.assertTrue(pairing.add_result(pair_id, scores[1]))
+        # 1局目だけ終わった組は数えない。
+        pairing.add_result(100, 1)
+        self.assertEqual(pairing.pentanomial, [1, 0, 2, 1, 1])
+        self.assertEqual(pairing.pair_count(), 5)
+        self.assertEqual(
+            pentanomial_to_str(pairing.pentanomial), "LL-LD-DD-WD-WW = 1-0-2-1-1"
+        )
+
+    def test_server(self):
+        server = MultiAyaneruServer()
+        server.paired_openings = True
+        server.start_sfens = [
+            "startpos moves 1g1f",
+            "startpos moves 5g5f",
+            "startpos moves 9g9f",
+        ]
+        server.start_gameply = 0
+        # 最初の3組だけを対局させる。(終局の順番によらず、6局で3組が揃うように)
+        server.max_games = 6
+        server.init_server(2)
+        # 2P側が先に投了するので、1P側が全勝する。
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "6"})
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        self.assertTrue(server.wait_for_games(6, timeout=30))
+        server.game_stop()
+
+        # 最初の3組で、それぞれの開始局面を先後入れ替えて1回ずつ指している。
+        starts = Counter(
+            (kifu.moves[0], kifu.flip_turn)
+            for kifu in server.game_kifus
+            if kifu.pair_id < 3
+        )
+        self.assertEqual(len(starts), 6)
+        self.assertEqual(set(starts.values()), {1})
+
+        pentanomial = server.pairing.pentanomial
+        self.assertGreaterEqual(pentanomial[4], 3)
+        self.assertEqual(sum(pentanomial), pentanomial[4])
+        elo = server.game_rating()
+        self.assertEqual(elo.pentanomial, pentanomial)
+        self.assertIn("pairs LL-LD-DD-WD-WW", server.game_info())
+        server.terminate()
+
+
+if __name__ == "__main__":
+    unittest.main()
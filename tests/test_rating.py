@@ -0,0 +1,68 @@
+import os
+import unittest
+
+from src.engine.rating import EloRating, Sprt
+from src.engine.server_multi import MultiAyaneruServer
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+
+class TestSprt(unittest.TestCase):
+    def test_llr(self):
+        # 期待得点はcalc_rating()の逆関数
+        self.assertAlmostEqual(Sprt.calc_score(EloRating.calc_rating(0.6)), 0.6)
+
+        sprt = Sprt(elo0=0, elo1=10)
+        self.assertAlmostEqual(sprt.lower_bound, -2.944, places=3)
+        self.assertAlmostEqual(sprt.upper_bound, 2.944, places=3)
+
+        # 勝率54%程度ではまだ結論は出ない。
+        sprt.player1_win = 300
+        sprt.player2_win = 250
+        sprt.draw_games = 50
+        sprt.calc()
+        self.assertAlmostEqual(sprt.llr, 1.31, places=2)
+        self.assertIsNone(sprt.accepted)
+        self.assertIn("LLR 1.31 [-2.94,2.94]", sprt.pretty_string)
+
+        # 同じ勝率で対局数が増えれば、H1が採択される。
+        sprt.player1_win *= 3
+        sprt.player2_win *= 3
+        sprt.draw_games *= 3
+        sprt.calc()
+        self.assertEqual(sprt.accepted, "H1")
+
+        # 互角ならH0が採択される。一度採択されたら変化しない。
+        sprt = Sprt(elo0=0, elo1=10)
+        sprt.player1_win = sprt.player2_win = 4000
+        sprt.calc()
+        self.assertEqual(sprt.accepted, "H0")
+        sprt.player1_win = 8000
+        sprt.calc()
+        self.assertEqual(sprt.accepted, "H0")
+
+    # 結論が出たら、対局を打ち切る。
+    def test_server(self):
+        server = MultiAyaneruServer()
+        server.sprt = Sprt(elo0=0, elo1=200)
+        server.init_server(2)
+        # 2P側が先に投了するので、1P側が全勝する。
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "6"})
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        try:
+            self.assertTrue(server.wait_for_games(1000, timeout=30))
+        finally:
+            server.game_stop()
+
+        self.assertTrue(server.is_finished())
+        self.assertEqual(server.sprt.accepted, "H1")
+        self.assertLess(server.total_games, 20)
+        self.assertEqual(server.player2_win, 0)
+        self.assertIn("H1 accepted", server.game_info())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import random
+import tempfile
+import unittest
+
+from src.engine.rating_fit import GameResultTable, fit_ratings
+
+
+class TestRatingFit(unittest.TestCase):
+    # 保存した対局結果を読み込むと、同じ集計になる。
+    def test_table(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "game_results.txt")
+            table = GameResultTable()
+            table.append(path, "B", "A", 3, 1, 2)
+            table.append(path, "A", "B", 5, 0, 1)
+            table.append(path, "A", "C", 0, 4, 0)
+            self.assertEqual(table.results[("A", "B")], [7, 1, 4])
+
+            loaded = GameResultTable()
+            loaded.load(path)
+            self.assertEqual(loaded.results, table.results)
+            self.assertEqual(loaded.total_games(), 16)
+            self.assertEqual(loaded.players(), ["A", "B", "C"])
+
+    # 固定したエンジンを基準に、すべてのエンジンのレーティングが推定される。
+    def test_fit(self):
+        rand = random.Random(1)
+        true_ratings = {"A": 2000, "B": 1800, "C": 1700, "D": 1500}
+        names = list(true_ratings)
+        table = GameResultTable()
+        for _ in range(200):
+            player1, player2 = rand.sample(names, 2)
+            diff = true_ratings[player1] - true_ratings[player2]
+            p = 1 / (1 + 10 ** (-diff / 400))
+            win = sum(rand.random() < p for _ in range(100))
+            table.add(player1, player2, win, 0, 100 - win)
+
+        ratings = fit_ratings(table, {"B": 1500, "C": 1500}, {"A": 2000})
+        self.assertEqual(ratings["A"], (2000, 0.0))
+        for name in ["B", "C", "D"]:
+            rating, error = ratings[name]
+            self.assertGreater(error, 0)
+            self.assertLess(error, 30)
+            self.assertLess(abs(rating - true_ratings[name]), error)
+
+    # 全勝していても発散しない。対局していないエンジンは初期値のまま。
+    def test_degenerate(self):
+        table = GameResultTable()
+        table.add("A", "B", 10, 0, 0)
+        ratings = fit_ratings(table, {"A": 1500, "B": 1500, "C": 1600})
+        self.assertGreater(ratings["A"][0] - ratings["B"][0], 300)
+        self.assertLess(ratings["A"][0] - ratings["B"][0], 1000)
+        self.assertAlmostEqual(ratings["A"][0] + ratings["B"][0], 3000, places=3)
+        self.assertAlmostEqual(ratings["C"][0], 1600)
+
+
+if __name__ == "__main__":
+    unittest.main()
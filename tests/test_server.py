@@ -0,0 +1,63 @@
+import unittest
+
+from src.engine.enums import Turn
+from src.engine.kifu import GameKifu, build_sfen, get_side_to_move, split_sfen
+from src.engine.server import AyaneruServer
+
+
+class TestAyaneruServerMoves(unittest.TestCase):
+    def test_split_sfen(self):
+        self.assertEqual(split_sfen("startpos"), ("startpos", []))
+        self.assertEqual(split_sfen("startpos moves"), ("startpos", []))
+        self.assertEqual(
+            split_sfen("startpos moves 7g7f 3c3d\n"), ("startpos", ["7g7f", "3c3d"])
+        )
+        sfen = "sfen lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1"
+        self.assertEqual(split_sfen(sfen + " moves 2g2f"), (sfen, ["2g2f"]))
+        self.assertEqual(build_sfen("startpos", []), "startpos moves")
+        self.assertEqual(build_sfen(sfen, ["2g2f"]), sfen + " moves 2g2f")
+
+    def test_kifu_sfen(self):
+        kifu = GameKifu()
+        kifu.sfen = "startpos moves 7g7f 3c3d"
+        self.assertEqual(kifu.moves, ["7g7f", "3c3d"])
+        self.assertEqual(kifu.sfen, "startpos moves 7g7f 3c3d")
+
+    # 指し手を追加していったときにsfenが正しく組み立てられるか
+    def test_sfen(self):
+        server = AyaneruServer()
+        # エンジンには接続しないので、局面の設定だけを行う。
+        server.engines = []
+        server.setup_game("startpos moves 7g7f 3c3d 2g2f 8c8d", 3)
+        self.assertEqual(server.moves, ["7g7f", "3c3d"])
+        self.assertEqual(server.sfen, "startpos moves 7g7f 3c3d")
+        server.moves.append("2g2f")
+        self.assertEqual(server.sfen, "startpos moves 7g7f 3c3d 2g2f")
+        server.moves.append("8c8d")
+        server.moves.append("2f2e")
+        self.assertEqual(server.sfen, "startpos moves 7g7f 3c3d 2g2f 8c8d 2f2e")
+
+        server.setup_game("startpos", 0)
+        self.assertEqual(server.sfen, "startpos moves")
+        server.moves.append("7g7f")
+        self.assertEqual(server.sfen, "startpos moves 7g7f")
+
+    # 手番は開始局面と手数から求める
+    def test_side_to_move(self):
+        self.assertEqual(get_side_to_move("startpos", 0), Turn.BLACK)
+        self.assertEqual(get_side_to_move("startpos", 3), Turn.WHITE)
+        board = "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL"
+        self.assertEqual(get_side_to_move("sfen " + board + " w - 2", 0), Turn.WHITE)
+        self.assertEqual(get_side_to_move("sfen " + board + " w - 2", 1), Turn.BLACK)
+        self.assertEqual(get_side_to_move("sfen " + board + " b - 1", 2), Turn.BLACK)
+
+        server = AyaneruServer()
+        server.engines = []
+        server.setup_game("startpos moves 7g7f 3c3d 2g2f", 3)
+        self.assertEqual(server.side_to_move, Turn.BLACK)
+        server.setup_game("startpos moves 7g7f 3c3d 2g2f", 0)
+        self.assertEqual(server.side_to_move, Turn.WHITE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,333 @@
+import io
+import os
+import time
+import unittest
+from contextlib import redirect_stdout
+
+from src.engine.engine_match import EngineMatch
+from src.engine.engine_pool import UsiEnginePool
+from src.engine.enums import WatchdogPolicy
+from src.engine.server_multi import MultiAyaneruServer
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+
+class TestMultiAyaneruServer(unittest.TestCase):
+    # 終局が通知されて、すぐに次の対局が始まるかのテスト
+    def test_wait_for_games(self):
+        server = MultiAyaneruServer()
+        server.init_server(2)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.set_time_setting("byoyomi 100")
+
+        start_time = time.time()
+        server.game_start()
+
+        # 1秒間隔のpollingだと10局に5秒以上かかる。
+        self.assertTrue(server.wait_for_games(10, timeout=30))
+        elapsed_time = time.time() - start_time
+        server.game_stop()
+
+        self.assertLess(elapsed_time, 5)
+        self.assertGreaterEqual(server.total_games, 10)
+        self.assertEqual(
+            server.total_games,
+            server.player1_win + server.player2_win + server.draw_games,
+        )
+        self.assertEqual(len(server.game_kifus), server.total_games)
+
+        # 8手目を指す側が投了するので、7手指されている。
+        kifu = server.game_kifus[0]
+        self.assertEqual(kifu.start_position, "startpos")
+        self.assertEqual(len(kifu.moves), 7)
+        self.assertEqual(kifu.sfen, "startpos moves " + " ".join(kifu.moves))
+
+        server.terminate()
+
+    # "readyok"が返ってこないエンジンを用いる対局サーバーは取り除かれる
+    def test_engine_startup_timeout(self):
+        server = MultiAyaneruServer()
+        server.engine_ready_timeout = 1.0
+        server.init_server(2)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        slow_engine = server.servers[1].engines[1]
+        slow_engine.disconnect()
+        slow_engine.set_engine_options({"ReadyDelay": "60000"})
+        slow_engine.connect(FAKE_ENGINE_PATH)
+        server.set_time_setting("byoyomi 100")
+
+        start_time = time.time()
+        server.game_start()
+        self.assertLess(time.time() - start_time, 5)
+        self.assertEqual(len(server.servers), 1)
+        self.assertEqual(len(server.failed_engines), 1)
+        self.assertIn("readyok timeout", server.failed_engines[0])
+        self.assertIsNone(slow_engine.ready_latency)
+        self.assertIsNotNone(server.servers[0].engines[0].ready_latency)
+        self.assertIn("failed 1", server.startup_info())
+
+        # 残った対局サーバーで対局は続けられる。
+        self.assertTrue(server.wait_for_games(2, timeout=30))
+        server.game_stop()
+        server.terminate()
+
+    # max_gamesの数だけ対局を開始して、それ以上は開始しない。
+    def test_max_games(self):
+        server = MultiAyaneruServer()
+        server.max_games = 7
+        server.init_server(3)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        try:
+            self.assertTrue(server.wait_for_games(7, timeout=30))
+            # 対局中のものはなく、これ以上は終局しない。
+            self.assertFalse(server.wait_for_games(8, timeout=0.5))
+        finally:
+            server.game_stop()
+
+        self.assertEqual(server.started_games, 7)
+        self.assertEqual(server.total_games, 7)
+        self.assertEqual(len(server.game_kifus), 7)
+        server.terminate()
+
+    # 対局サーバーごとに異なるエンジンの組を対局させて、組ごとに集計する。
+    def test_matches(self):
+        # ResignPly 8 vs 6 なら1P側の全勝、9同士なら後手の全勝。
+        configs = [
+            [
+                (FAKE_ENGINE_PATH, {"ResignPly": "8"}),
+                (FAKE_ENGINE_PATH, {"ResignPly": "6"}),
+            ],
+            [
+                (FAKE_ENGINE_PATH, {"ResignPly": "9"}),
+                (FAKE_ENGINE_PATH, {"ResignPly": "9"}),
+            ],
+        ]
+        matches = []
+
+        def match_source():
+            if len(matches) == 5:
+                return None
+            match = EngineMatch(configs[len(matches) % 2], 3)
+            match.tag = len(matches) % 2
+            matches.append(match)
+            return match
+
+        pool = UsiEnginePool()
+        server = MultiAyaneruServer()
+        server.engine_pool = pool
+        server.match_source = match_source
+        server.init_server(2)
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        try:
+            self.assertTrue(server.wait_for_matches(5, timeout=60))
+        finally:
+            server.game_stop()
+
+        finished = server.pop_finished_matches()
+        self.assertEqual(sorted(m.match_id for m in finished), [0, 1, 2, 3, 4])
+        self.assertEqual(server.pop_finished_matches(), [])
+        self.assertEqual(server.running_matches(), [])
+        self.assertEqual(server.total_games, 15)
+        for match in finished:
+            self.assertEqual(match.total_games, 3)
+            if match.tag == 0:
+                self.assertEqual(match.player1_win, 3)
+            else:
+                self.assertEqual(match.white_win, 3)
+        first = min(finished, key=lambda m: m.match_id)
+        self.assertTrue(first.game_rating().pretty_string.startswith("3 - 0 - 0"))
+
+        # 入れ替えたエンジンは使い回されるので、起動するのは3種類のエンジンを2つずつまで。
+        self.assertLessEqual(pool.spawned, 6)
+        server.terminate()
+        pool.close()
+
+    # 応答しなくなったエンジンは起動しなおされて、その側の負けになる。
+    def test_watchdog_loss(self):
+        server = MultiAyaneruServer()
+        server.max_games = 3
+        server.flip_turn_every_game = False
+        server.watchdog_margin = 0.5
+        server.watchdog_policy = WatchdogPolicy.Loss
+        server.init_server(1)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8", "HangPly": "4"})
+        server.set_time_setting("byoyomi 100")
+        hung_engine = server.servers[0].engines[1]
+        server.game_start()
+        first_pid = hung_engine.proc.pid
+        try:
+            self.assertTrue(server.wait_for_games(3, timeout=30))
+            self.assertNotEqual(hung_engine.proc.pid, first_pid)
+        finally:
+            server.game_stop()
+
+        # 後手(2P側)が4手目で応答しなくなるので、すべて1P側の勝ち。
+        self.assertEqual(server.player1_win, 3)
+        self.assertEqual(server.engine_hangs, 3)
+        self.assertEqual(server.void_games, 0)
+        self.assertIn("hangs 3 (void 0)", server.game_info())
+        self.assertTrue(all(len(kifu.moves) == 3 for kifu in server.game_kifus))
+        server.terminate()
+
+    # 応答しなくなったエンジンがあった対局は無効になり、集計されずに対局しなおされる。
+    def test_watchdog_void(self):
+        server = MultiAyaneruServer()
+        server.max_games = 1
+        server.watchdog_margin = 0.5
+        server.init_server(1)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8", "HangPly": "3"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8", "HangPly": "3"})
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        try:
+            deadline = time.time() + 30
+            while server.void_games < 2 and time.time() < deadline:
+                time.sleep(0.1)
+        finally:
+            server.game_stop()
+
+        # 無効になった対局は開始しなかったことになるので、max_gamesに達せずに何度でもやり直される。
+        self.assertGreaterEqual(server.void_games, 2)
+        self.assertEqual(server.engine_hangs, server.void_games)
+        self.assertEqual(server.total_games, 0)
+        self.assertLessEqual(server.started_games, 1)
+        self.assertIn("hangs", server.game_info())
+        server.terminate()
+
+    # 応答しなくなったエンジンを起動しなおせなかったら、無効にした対局は止めている他の対局サーバーでやり直される。
+    def test_watchdog_restart_failed(self):
+        server = MultiAyaneruServer()
+        server.max_games = 4
+        server.watchdog_margin = 0.5
+        server.init_server(2)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.set_time_setting("byoyomi 100")
+        # 2つ目の対局サーバーの後手だけが、4手目で応答しなくなる。
+        hung_server = server.servers[1]
+        hung_server.engines[1].disconnect()
+        hung_engine = server.connect_engine(
+            hung_server, FAKE_ENGINE_PATH, {"ResignPly": "8", "HangPly": "4"}
+        )
+        hung_server.engines[1] = hung_engine
+        server.game_start()
+        # 起動しなおそうとしても、実行ファイルが見つからない。
+        hung_engine.engine_path = os.path.join(os.path.dirname(__file__), "missing")
+        try:
+            self.assertTrue(server.wait_for_games(4, timeout=30))
+        finally:
+            server.game_stop()
+
+        self.assertEqual(server.total_games, 4)
+        self.assertEqual(server.void_games, 1)
+        server.terminate()
+
+    # 応答しなくなったエンジンが直前に書き出した標準エラー出力は、起動しなおす前に表示される。
+    def test_watchdog_stderr(self):
+        server = MultiAyaneruServer()
+        server.max_games = 1
+        server.flip_turn_every_game = False
+        server.watchdog_margin = 0.5
+        server.watchdog_policy = WatchdogPolicy.Loss
+        server.init_server(1)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.set_time_setting("byoyomi 100")
+        hung_server = server.servers[0]
+        hung_server.engines[1].disconnect()
+        hung_server.engines[1] = server.connect_engine(
+            hung_server,
+            FAKE_ENGINE_PATH,
+            {"ResignPly": "8", "HangPly": "4", "StderrLines": "1"},
+        )
+        output = io.StringIO()
+        with redirect_stdout(output):
+            server.game_start()
+            try:
+                self.assertTrue(server.wait_for_games(1, timeout=30))
+            finally:
+                server.game_stop()
+
+        # 後手は4手目(ply 3)の"go"を受け取って書き出したあとに応答しなくなった。
+        self.assertIn("Error! : engine is not responding", output.getvalue())
+        self.assertIn("  stderr : warning ply 3 line 0", output.getvalue())
+        self.assertEqual(server.engine_hangs, 1)
+        server.terminate()
+
+    # すべての対局サーバーが止まったら、wait_for_games()は待ち続けずに例外をraiseする。
+    def test_watchdog_all_servers_stopped(self):
+        server = MultiAyaneruServer()
+        server.max_games = 4
+        server.watchdog_margin = 0.5
+        server.init_server(1)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8", "HangPly": "4"})
+        server.set_time_setting("byoyomi 100")
+        hung_engine = server.servers[0].engines[1]
+        server.game_start()
+        hung_engine.engine_path = os.path.join(os.path.dirname(__file__), "missing")
+        try:
+            with self.assertRaises(ValueError):
+                server.wait_for_games(4, timeout=30)
+        finally:
+            server.game_stop()
+        server.terminate()
+
+    # recycle_gamesの対局数ごとに、エンジンが起動しなおされる。
+    def test_recycle_games(self):
+        server = MultiAyaneruServer()
+        server.max_games = 12
+        server.recycle_games = 3
+        server.init_server(2)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        try:
+            self.assertTrue(server.wait_for_games(12, timeout=60))
+        finally:
+            server.game_stop()
+
+        # 2つの対局サーバーで最初に起動しなおすまでの対局数がずれているので、
+        # 12局のうちに、どちらのエンジンも少なくとも1回ずつは起動しなおされている。
+        self.assertGreaterEqual(server.recycled_engines, 4)
+        self.assertEqual(server.total_games, 12)
+        self.assertIn("recycled", server.game_info())
+        server.terminate()
+
+    # 物理メモリ使用量がrecycle_rss_growth以上増えたエンジンは起動しなおされる。
+    @unittest.skipUnless(os.path.exists("/proc/self/status"), "requires /proc")
+    def test_recycle_rss_growth(self):
+        server = MultiAyaneruServer()
+        server.max_games = 4
+        # 0なら、毎局起動しなおされる。
+        server.recycle_rss_growth = 0
+        server.init_server(1)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        try:
+            self.assertTrue(server.wait_for_games(4, timeout=60))
+        finally:
+            server.game_stop()
+
+        self.assertGreaterEqual(server.recycled_engines, 6)
+        server.terminate()
+
+    # 対局が終わらないときはtimeoutでFalseが返る
+    def test_wait_for_games_timeout(self):
+        server = MultiAyaneruServer()
+        self.assertFalse(server.wait_for_games(1, timeout=0.01))
+
+
+if __name__ == "__main__":
+    unittest.main()
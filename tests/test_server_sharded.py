@@ -0,0 +1,156 @@
+import os
+import unittest
+
+from src.engine.engine_match import EngineMatch
+from src.engine.enums import WatchdogPolicy
+from src.engine.server_sharded import ShardedMultiAyaneruServer
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+
+class TestShardedMultiAyaneruServer(unittest.TestCase):
+    def test_sharded_games(self):
+        server = ShardedMultiAyaneruServer()
+        server.processes = 2
+        server.init_server(4)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "9"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "9"})
+        server.set_time_setting("byoyomi 100")
+
+        server.game_start()
+        self.assertTrue(server.wait_for_games(20, timeout=60))
+        server.game_stop()
+
+        self.assertGreaterEqual(server.total_games, 20)
+        self.assertEqual(len(server.game_kifus), server.total_games)
+        self.assertEqual(
+            server.total_games,
+            server.player1_win + server.player2_win + server.draw_games,
+        )
+        self.assertEqual(server.black_win + server.white_win, server.total_games)
+        # 9手目(先手番)で投了するので、すべて後手勝ち。
+        self.assertEqual(server.white_win, server.total_games)
+        self.assertTrue(server.game_kifus[0].sfen.startswith("startpos moves 7g7f"))
+        self.assertEqual(server.game_rating().player1_win, server.player1_win)
+
+        server.terminate()
+
+    # 子プロセスでエンジンの起動に失敗したら、wait_for_games()は待ち続けずに例外をraiseする。
+    def test_shard_error(self):
+        server = ShardedMultiAyaneruServer()
+        server.processes = 2
+        server.init_server(4)
+        missing_path = os.path.join(os.path.dirname(__file__), "missing_engine.exe")
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "9"})
+        server.init_engine(1, missing_path, {})
+        server.set_time_setting("byoyomi 100")
+
+        server.game_start()
+        try:
+            with self.assertRaises(ValueError) as cm:
+                server.wait_for_games(20, timeout=60)
+            # どのエンジンの起動に失敗したのかがわかる。
+            self.assertIn(missing_path, str(cm.exception))
+        finally:
+            server.game_stop()
+            server.terminate()
+
+    # 子プロセスごとに振られた組の番号が、親プロセスで区別されて集計される。
+    def test_paired_openings(self):
+        server = ShardedMultiAyaneruServer()
+        server.processes = 2
+        server.paired_openings = True
+        server.init_server(4)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "9"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "9"})
+        server.set_time_setting("byoyomi 100")
+
+        server.game_start()
+        self.assertTrue(server.wait_for_games(20, timeout=60))
+        server.game_stop()
+
+        # すべて後手勝ちなので、先後を入れ替えた2局で1勝1敗になる。
+        pentanomial = server.pairing.pentanomial
+        self.assertGreaterEqual(pentanomial[2], 8)
+        self.assertEqual(sum(pentanomial), pentanomial[2])
+        self.assertTrue(all(isinstance(k.pair_id, tuple) for k in server.game_kifus))
+
+        server.terminate()
+
+    # max_gamesは子プロセスに分割されて、合計でちょうどその数だけ対局する。
+    def test_max_games(self):
+        server = ShardedMultiAyaneruServer()
+        server.processes = 2
+        server.max_games = 9
+        server.init_server(3)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "9"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "9"})
+        server.set_time_setting("byoyomi 100")
+
+        server.game_start()
+        self.assertTrue(server.wait_for_games(9, timeout=60))
+        self.assertFalse(server.wait_for_games(10, timeout=0.5))
+        server.game_stop()
+
+        self.assertEqual(server.total_games, 9)
+        server.terminate()
+
+    # 子プロセスでエンジンを起動しなおした数も、親プロセスで集計される。
+    def test_watchdog(self):
+        server = ShardedMultiAyaneruServer()
+        server.processes = 2
+        server.max_games = 4
+        server.flip_turn_every_game = False
+        server.watchdog_margin = 0.5
+        server.watchdog_policy = WatchdogPolicy.Loss
+        server.init_server(2)
+        server.init_engine(0, FAKE_ENGINE_PATH, {"ResignPly": "8"})
+        server.init_engine(1, FAKE_ENGINE_PATH, {"ResignPly": "8", "HangPly": "4"})
+        server.set_time_setting("byoyomi 100")
+
+        server.game_start()
+        self.assertTrue(server.wait_for_games(4, timeout=60))
+        server.game_stop()
+
+        self.assertEqual(server.player1_win, 4)
+        self.assertEqual(server.engine_hangs, 4)
+        self.assertIn("hangs 4 (void 0)", server.game_info())
+        server.terminate()
+
+    # エンジンの組は親プロセスから子プロセスに送られて、戦績は親プロセスで組ごとに集計される。
+    def test_matches(self):
+        matches = []
+
+        def match_source():
+            if len(matches) == 4:
+                return None
+            options = {"ResignPly": "9"}
+            match = EngineMatch([(FAKE_ENGINE_PATH, options)] * 2, 4)
+            matches.append(match)
+            return match
+
+        server = ShardedMultiAyaneruServer()
+        server.processes = 2
+        server.paired_openings = True
+        server.match_source = match_source
+        server.init_server(2)
+        server.set_time_setting("byoyomi 100")
+
+        server.game_start()
+        self.assertTrue(server.wait_for_matches(4, timeout=60))
+        server.game_stop()
+
+        finished = server.pop_finished_matches()
+        self.assertEqual(len(finished), 4)
+        self.assertEqual(server.total_games, 16)
+        # すべて後手勝ちなので、先後を入れ替えた2局で1勝1敗になる。
+        for match in finished:
+            self.assertEqual(match.white_win, 4)
+            self.assertEqual(match.pairing.pentanomial, [0, 0, 2, 0, 0])
+
+        server.terminate()
+
+
+if __name__ == "__main__":
+    unittest.main()
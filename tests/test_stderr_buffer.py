@@ -0,0 +1,70 @@
+import asyncio
+import io
+import os
+import tempfile
+import unittest
+
+from src.engine.engine import UsiEngine
+from src.engine.stderr_buffer import MAX_LINE_BYTES, StderrBuffer
+
+# 本物の思考エンジンの代わりに用いるUSIエンジンもどき
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(__file__), "fake_usi_engine.py")
+
+
+class TestStderrBuffer(unittest.TestCase):
+    # 最後のmax_lines行だけを保持して、すべての行をファイルに追記する。
+    def test_ring(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "stderr.log")
+            buffer = StderrBuffer(3, path)
+            buffer.drain(io.BytesIO(b"a\nb\r\nc\n\xff\xfe\nlast"))
+            buffer.close()
+
+            self.assertEqual(buffer.get_lines(), ["c", "��", "last"])
+            self.assertEqual(buffer.total_lines, 5)
+            with open(path, encoding="utf-8") as f:
+                self.assertEqual(f.read().split("\n")[0:2], ["a", "b"])
+
+    # drain_async()もdrain()と同じく行に分割して、長すぎる行はMAX_LINE_BYTESごとに分割する。
+    def test_drain_async(self):
+        async def run():
+            stream = asyncio.StreamReader()
+            stream.feed_data(b"a\nb\r\n" + b"x" * (MAX_LINE_BYTES + 1) + b"\nlast")
+            stream.feed_eof()
+            buffer = StderrBuffer(10)
+            await buffer.drain_async(stream)
+            return buffer.get_lines()
+
+        lines = asyncio.run(run())
+        self.assertEqual(lines, ["a", "b", "x" * MAX_LINE_BYTES, "x", "last"])
+
+    # 標準エラー出力に大量に書き出すエンジンでも、pipeが詰まって止まらない。
+    def test_engine(self):
+        engine = UsiEngine()
+        engine.stderr_lines = 10
+        # 1手あたり約110KB。読み出さなければpipeのbuffer(64KB)が一杯になって止まる。
+        engine.set_engine_options({"StderrLines": "1000"})
+        engine.connect(FAKE_ENGINE_PATH)
+        try:
+            self.assertTrue(engine.wait_ready(10))
+            for ply in range(3):
+                engine.usi_position("startpos moves" + " 7g7f" * ply)
+                engine.usi_go("byoyomi 100")
+                with engine.state_changed_cv:
+                    self.assertTrue(
+                        engine.state_changed_cv.wait_for(
+                            lambda: engine.think_result.bestmove is not None, 10
+                        )
+                    )
+        finally:
+            engine.kill()
+
+        # 終了させたあとも、最後の行を参照できる。
+        lines = engine.get_stderr()
+        self.assertEqual(len(lines), 10)
+        self.assertTrue(lines[-1].startswith("warning ply 2 line 999 "))
+        self.assertEqual(engine.stderr_buffer.total_lines, 3000)
+
+
+if __name__ == "__main__":
+    unittest.main()